@@ -63,11 +63,10 @@ def parse_arguments():
                         help='Disable ANSI color escape sequences in output')
     parser.add_argument('--offset', type=int, default=16,
                         help=argparse.SUPPRESS)
-    # FIXME (theo) Add some documentation on the different search policy options
     parser.add_argument('--policy', type=str, default='random',
-                        help=("Search policy. random|adhoc|uncovered|dicount"
-                              "|icount|syscount|depth. (use + (max) or - (min)"
-                              " to specify order. e.g. +random)"))
+                        help=("State scheduling policy. random|depth|breadth|uncovered"
+                              "|constraints|newest. (use + (max) or - (min)"
+                              " to specify order. e.g. +constraints)"))
     parser.add_argument('argv', type=str, nargs='*', default=[],
                         help="Path to program, and arguments ('+' in arguments indicates symbolic byte).")
     parser.add_argument('-v', action='count', default=1,
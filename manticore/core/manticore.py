@@ -2,7 +2,6 @@ import itertools
 import logging
 import sys
 import time
-import random
 import weakref
 
 from contextlib import contextmanager
@@ -11,7 +10,9 @@ import functools
 import shlex
 
 from ..core.plugin import Plugin
+from ..core.policy import Policy, ReadyQueue
 from ..core.smtlib import Expression
+from ..core.smtlib.solver import consts as solver_consts
 from ..core.state import StateBase
 from ..core.workspace import ManticoreOutput
 from ..utils import config
@@ -19,7 +20,7 @@ from ..utils.log import set_verbosity
 from ..utils.event import Eventful
 from ..utils.helpers import PickleSerializer
 from ..utils.nointerrupt import WithKeyboardInterruptAs
-from .workspace import Workspace
+from .workspace import Workspace, Store
 from .worker import WorkerSingle, WorkerThread, WorkerProcess
 
 from multiprocessing.managers import SyncManager
@@ -215,12 +216,14 @@ class ManticoreBase(Eventful):
         :param initial_state: the initial root `State` object
         :type state: State
         :param workspace_url: workspace folder name
-        :param policy: scheduling policy
+        :param policy: scheduling policy. A policy name (see
+                       `Policy.all_policies()`), a `Policy` subclass or
+                       instance
         :param kwargs: other kwargs, e.g.
         """
         super().__init__()
 
-        if any(not hasattr(self, x) for x in ('_worker_type', '_lock', '_running', '_killed', '_ready_states', '_terminated_states', '_killed_states', '_busy_states', '_shared_context')):
+        if any(not hasattr(self, x) for x in ('_worker_type', '_lock', '_running', '_killed', '_ready_states', '_ready_queue', '_terminated_states', '_killed_states', '_busy_states', '_shared_context')):
             raise Exception('Need to instantiate one of: ManticoreNative, ManticoreThreads..')
 
         # The workspace and the output
@@ -240,6 +243,15 @@ class ManticoreBase(Eventful):
             workspace_url = f'fs:{self._workspace.uri}'
         self._output = ManticoreOutput(workspace_url)
 
+        # Store optionally sharing the solver query results of the workers
+        # (and of later runs). See Worker.run
+        if solver_consts.cache_store == 'workspace':
+            self._solver_cache_store = self._workspace._store
+        elif solver_consts.cache_store:
+            self._solver_cache_store = Store.fromdescriptor(solver_consts.cache_store)
+        else:
+            self._solver_cache_store = None
+
         # The set of registered plugins
         # The callback methods defined in the plugin object will be called when
         # the different type of events occur over an exploration.
@@ -247,6 +259,15 @@ class ManticoreBase(Eventful):
         # careful use of the shared context is needed.
         self.plugins = set()
 
+        # The scheduling policy decides which READY state is explored next
+        if isinstance(policy, str):
+            policy = Policy.from_string(policy, self)
+        elif isinstance(policy, type) and issubclass(policy, Policy):
+            policy = policy(self)
+        if not isinstance(policy, Policy):
+            raise TypeError(f'Invalid policy type: {type(policy).__name__}')
+        self._policy = policy
+
         # Set initial root state
         if not isinstance(initial_state, StateBase):
             raise TypeError(f'Invalid initial_state type: {type(initial_state).__name__}')
@@ -277,8 +298,13 @@ class ManticoreBase(Eventful):
         The optional setstate() function is supposed to set the concrete value
         in the child state.
 
-        Parent state is removed from the busy list and tht child states are added
-        to the ready list.
+        The parent state becomes the child of the last solution. Like its
+        siblings it gets a fresh state id and a `did_fork_state` event, and the
+        parent state id is removed from the busy list and the workspace. The
+        other child states are added to the ready list. If the scheduling
+        policy would not pick a ready state before it, the last child is
+        returned so the worker keeps running it without saving and loading it.
+        Otherwise it is saved to the ready list and None is returned.
 
         """
         assert isinstance(expression, Expression)
@@ -298,11 +324,13 @@ class ManticoreBase(Eventful):
 
         self._publish('will_fork_state', state, expression, solutions, policy)
 
-        # Build and enqueue a state for each solution
+        # Build and enqueue a state for each solution but the last one
         children = []
+        *solutions, last_value = solutions
         for new_value in solutions:
             with state as new_state:
                 new_state.constrain(expression == new_value)
+                new_state.context['fork_depth'] = state.context.get('fork_depth', 0) + 1
 
                 # and set the PC of the new state to the concrete pc-dest
                 # (or other register or memory address to concrete)
@@ -310,21 +338,43 @@ class ManticoreBase(Eventful):
 
                 # enqueue new_state, assign new state id
                 new_state_id = self._save(new_state, state_id=None)
+                priority = self._policy.priority(new_state_id, new_state)
                 with self._lock:
-                    self._ready_states.append(new_state_id)
+                    self._add_ready(new_state_id, priority)
                     self._lock.notify_all()  # Must notify one!
 
                 self._publish('did_fork_state', new_state, expression, new_value, policy)
                 # maintain a list of children for logging purpose
                 children.append(new_state_id)
 
+        # The parent state becomes the last child in place. It takes a fresh
+        # id without being saved and its old id is dropped as in any fork
+        parent_id = state.id
+        state.constrain(expression == last_value)
+        state.context['fork_depth'] = state.context.get('fork_depth', 0) + 1
+        setstate(state, last_value)
+        state._id = self._workspace.new_state_id()
         with self._lock:
-            self._busy_states.remove(state.id)
-            self._remove(state.id)
-            state._id = None
+            self._busy_states.remove(parent_id)
+            self._busy_states.append(state.id)
+            self._remove(parent_id)
             self._lock.notify_all()
 
-        logger.debug("Forking current state %r into states %r", state.id, children)
+        self._publish('did_fork_state', state, expression, last_value, policy)
+        children.append(state.id)
+        logger.debug("Forking current state %r into states %r", parent_id, children)
+
+        with self._lock:
+            best_priority = self._ready_queue.peek()
+        if self._policy.runs_before(state.id, state, best_priority):
+            return state
+
+        self._save(state, state_id=state.id)
+        with self._lock:
+            self._busy_states.remove(state.id)
+            self._add_ready(state.id, self._policy.priority(state.id, state))
+            self._lock.notify_all()
+        return None
 
     @staticmethod
     def verbosity(level):
@@ -394,12 +444,23 @@ class ManticoreBase(Eventful):
 
         """
         state_id = self._save(state, state_id=state.id)
+        priority = self._policy.priority(state_id, state)
         with self._lock:
             # Enqueue it in the ready state list for processing
-            self._ready_states.append(state_id)
+            self._add_ready(state_id, priority)
             self._lock.notify_all()
         return state_id
 
+    def _add_ready(self, state_id, priority=None):
+        """ Add state_id to the READY list and schedule it with priority.
+            If priority is None the policy is asked for one without loading
+            the state. Must be called with the lock held.
+        """
+        if priority is None:
+            priority = self._policy.priority(state_id)
+        self._ready_states.append(state_id)
+        self._ready_queue.push(state_id, priority)
+
     def _get_state(self, wait=False):
         """ Dequeue a state form the READY list and add it to the BUSY list """
         with self._lock:
@@ -427,8 +488,13 @@ class ManticoreBase(Eventful):
             assert self._ready_states
 
             # make the choice under exclusive access to the shared ready list
-            # state_id = self._policy.choice(list(self._ready_states)[0])
-            state_id = random.choice(list(self._ready_states))
+            # The queue may hold stale ids of states that left READY by other
+            # means, and states added straight to the list are not queued.
+            state_id = self._ready_queue.pop()
+            while state_id is not None and state_id not in self._ready_states:
+                state_id = self._ready_queue.pop()
+            if state_id is None:
+                state_id = self._ready_states[0]
 
             # Move from READY to BUSY
             self._ready_states.remove(state_id)
@@ -448,7 +514,7 @@ class ManticoreBase(Eventful):
         """
         # Move from BUSY to READY
         self._busy_states.remove(state_id)
-        self._ready_states.append(state_id)
+        self._add_ready(state_id)
         self._lock.notify_all()
 
     @sync
@@ -666,6 +732,10 @@ class ManticoreBase(Eventful):
         """
         assert plugin in self.plugins, "Plugin instance not registered"
         plugin.on_unregister()
+        for event_name in self._signals.copy():
+            callback = getattr(plugin, f'{event_name}_callback', None)
+            if callback is not None:
+                self.unsubscribe(event_name, callback)
         self.plugins.remove(plugin)
         plugin.manticore = None
 
@@ -834,7 +904,10 @@ class ManticoreBase(Eventful):
                 # move all READY to KILLED:
                 while self._ready_states:
                     self._killed_states.append(self._ready_states.pop())
+                self._ready_queue.clear()
 
+        # No worker is saving states now
+        self._workspace.remove_unreferenced()
         self._running.value = False
         self._publish('did_run')
         assert not self.is_running()
@@ -849,9 +922,11 @@ class ManticoreBase(Eventful):
             self._remove(state_id)
 
         del self._ready_states[:]
+        self._ready_queue.clear()
         del self._busy_states[:]
         del self._terminated_states[:]
         del self._killed_states[:]
+        self._workspace.remove_unreferenced()
 
     def finalize(self):
         """
@@ -904,6 +979,7 @@ class ManticoreSingle(ManticoreBase):
         self._running = ctypes.c_bool(False)
 
         self._ready_states = []
+        self._ready_queue = ReadyQueue()
         self._terminated_states = []
         self._busy_states = []
         self._killed_states = []
@@ -921,6 +997,7 @@ class ManticoreThreading(ManticoreBase):
         self._running = ctypes.c_bool(False)
 
         self._ready_states = []
+        self._ready_queue = ReadyQueue()
         self._terminated_states = []
         self._busy_states = []
         self._killed_states = []
@@ -930,13 +1007,20 @@ class ManticoreThreading(ManticoreBase):
         super().__init__(*args, **kwargs)
 
 
+class ManticoreManager(SyncManager):
+    """ A SyncManager that can also host the READY states priority queue """
+
+
+ManticoreManager.register('ReadyQueue', ReadyQueue)
+
+
 class ManticoreMultiprocessing(ManticoreBase):
     _worker_type = WorkerProcess
 
     def __init__(self, *args, **kwargs):
         # This is the global manager that will handle all shared memory access
         # See. https://docs.python.org/3/library/multiprocessing.html#multiprocessing.managers.SyncManager
-        self._manager = SyncManager()
+        self._manager = ManticoreManager()
         self._manager.start(
             lambda: signal.signal(signal.SIGINT, signal.SIG_IGN))
         # The main manticore lock. Acquire this for accessing shared objects
@@ -947,6 +1031,7 @@ class ManticoreMultiprocessing(ManticoreBase):
 
         # List of state ids of States on storage
         self._ready_states = self._manager.list()
+        self._ready_queue = self._manager.ReadyQueue()
         self._terminated_states = self._manager.list()
         self._busy_states = self._manager.list()
         self._killed_states = self._manager.list()
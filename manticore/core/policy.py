@@ -0,0 +1,240 @@
+"""
+State scheduling policies.
+
+A policy decides which READY state a worker will explore next. Each time a
+state is added to the READY list the policy computes a numeric priority for it
+and the state id is pushed into a `ReadyQueue`. `ManticoreBase._get_state`
+then pops the state with the lowest priority in O(log n) without copying the
+READY list.
+
+Policies are selected by name (see `Policy.from_string`). A name can be
+prefixed with '-' (explore lowest priority first, the default) or '+' (explore
+highest priority first). For example '+depth' is the same as 'breadth'.
+"""
+import heapq
+import itertools
+import logging
+import random
+import uuid
+
+from ..utils.helpers import issymbolic
+
+logger = logging.getLogger(__name__)
+
+
+class ReadyQueue:
+    """
+    A priority queue of READY state ids.
+
+    It is a binary heap of (priority, sequence, state_id) entries. Removal is
+    lazy: discarded entries stay in the heap and are skipped when popped. Ties
+    are broken in insertion order.
+
+    Only public methods are used so a `ReadyQueue` can live behind a
+    multiprocessing manager proxy.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def push(self, state_id, priority):
+        """ Add state_id with priority (or update its priority) """
+        self.discard(state_id)
+        entry = [priority, next(self._counter), state_id]
+        self._entries[state_id] = entry
+        heapq.heappush(self._heap, entry)
+
+    def discard(self, state_id):
+        """ Forget state_id if it is queued """
+        entry = self._entries.pop(state_id, None)
+        if entry is not None:
+            entry[-1] = None
+
+    def pop(self):
+        """ Remove and return the state id with the lowest priority or None """
+        while self._heap:
+            _, _, state_id = heapq.heappop(self._heap)
+            if state_id is not None:
+                del self._entries[state_id]
+                return state_id
+        return None
+
+    def peek(self):
+        """ Return the lowest priority of the queued states or None """
+        while self._heap and self._heap[0][-1] is None:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def clear(self):
+        self._heap = []
+        self._entries = {}
+
+    def size(self):
+        return len(self._entries)
+
+
+class Policy:
+    """
+    Base class for state scheduling policies.
+
+    Subclasses implement `_priority(state_id, state)`. The lower the value the
+    sooner the state will be explored. `state` may be None when a state id is
+    re-enqueued without loading it (e.g. revived states or states moved to
+    READY between EVM transactions); policies should then return a neutral value.
+    """
+    name = None
+
+    def __init__(self, manticore, reverse=False):
+        self._manticore = manticore
+        self._reverse = reverse
+
+    def __repr__(self):
+        return f"<{type(self).__name__}{' reversed' if self._reverse else ''}>"
+
+    def _priority(self, state_id, state):
+        raise NotImplementedError
+
+    def priority(self, state_id, state=None):
+        """ The priority used to schedule state_id """
+        value = self._priority(state_id, state)
+        return -value if self._reverse else value
+
+    def runs_before(self, state_id, state, best_priority):
+        """
+        Whether the in-memory `state` should be explored before the best
+        READY state, which is scheduled with `best_priority` (None if there
+        is no READY state). Ties favor the in-memory state, which avoids
+        saving and loading it.
+        """
+        return best_priority is None or self.priority(state_id, state) <= best_priority
+
+    @staticmethod
+    def all_policies():
+        """ Maps policy names to policy classes """
+        result = {}
+        todo = list(Policy.__subclasses__())
+        while todo:
+            cls = todo.pop()
+            todo.extend(cls.__subclasses__())
+            if cls.name is not None:
+                result[cls.name] = cls
+        return result
+
+    @staticmethod
+    def from_string(name, manticore):
+        """
+        Build a policy from its name. A leading '+' reverses the order of
+        exploration, a leading '-' is accepted and ignored.
+
+        :param str name: policy name. See `Policy.all_policies()`
+        :param manticore: the owner ManticoreBase instance
+        """
+        reverse = False
+        if name[:1] in ('+', '-'):
+            reverse = name[0] == '+'
+            name = name[1:]
+        policies = Policy.all_policies()
+        if name not in policies:
+            raise ValueError(f"Unknown policy {name}, must be one of {', '.join(sorted(policies))}")
+        return policies[name](manticore, reverse=reverse)
+
+
+class Random(Policy):
+    """ Explore READY states in random order """
+    name = 'random'
+
+    def _priority(self, state_id, state):
+        return random.random()
+
+
+class BreadthFirst(Policy):
+    """ Explore states with fewer forks in their history first """
+    name = 'breadth'
+
+    def _priority(self, state_id, state):
+        if state is None:
+            return 0
+        return state.context.get('fork_depth', 0)
+
+
+class DepthFirst(BreadthFirst):
+    """ Explore states with more forks in their history first """
+    name = 'depth'
+
+    def _priority(self, state_id, state):
+        return -super()._priority(state_id, state)
+
+
+class Newest(Policy):
+    """ Explore the most recently saved states first """
+    name = 'newest'
+
+    def _priority(self, state_id, state):
+        return -state_id
+
+
+class FewestConstraints(Policy):
+    """ Explore states with the smaller path condition first """
+    name = 'constraints'
+
+    def _priority(self, state_id, state):
+        if state is None:
+            return 0
+        return len(state.constraints)
+
+
+class Uncovered(Policy):
+    """
+    Coverage guided policy. States about to execute code that was not visited
+    yet are explored first.
+
+    Native coverage is read from the `Visited` plugin ('visited' in the
+    manticore context) and EVM coverage from 'evm.coverage'. Code replacing or
+    deleting the 'evm.coverage' list must delete 'evm.coverage_id' too.
+    """
+    name = 'uncovered'
+
+    def __init__(self, manticore, reverse=False):
+        super().__init__(manticore, reverse=reverse)
+        # Local copy of the append only 'evm.coverage' list, so that lookups
+        # are O(1). Only the locations appended since the last call are copied.
+        # 'evm.coverage_id' identifies the shared list that was copied, it
+        # changes when the list is reset (e.g. with the whole context)
+        self._evm_coverage = set()
+        self._evm_coverage_size = 0
+        self._evm_coverage_id = None
+
+    def _sync_evm_coverage(self):
+        with self._manticore.locked_context() as context:
+            coverage_id = context.get('evm.coverage_id')
+            if coverage_id is None:
+                coverage_id = context['evm.coverage_id'] = uuid.uuid4().hex
+            if coverage_id != self._evm_coverage_id:
+                self._evm_coverage, self._evm_coverage_size = set(), 0
+                self._evm_coverage_id = coverage_id
+            coverage = context.get('evm.coverage', ())
+            if len(coverage) != self._evm_coverage_size:
+                self._evm_coverage.update(coverage[self._evm_coverage_size:])
+                self._evm_coverage_size = len(coverage)
+
+    def _priority(self, state_id, state):
+        if state is None:
+            return 0
+
+        # EVMWorld, without importing the EVM platform here
+        if hasattr(state.platform, 'current_vm'):
+            vm = state.platform.current_vm
+            if vm is None:
+                return 0
+            tx = state.platform.current_transaction
+            location = (vm.address, vm.pc, tx is not None and tx.sort == 'CREATE')
+            self._sync_evm_coverage()
+            return int(location in self._evm_coverage)
+
+        cpu = getattr(state.platform, 'current', None)
+        if cpu is None or issymbolic(cpu.PC):
+            return 0
+        with self._manticore.locked_context() as context:
+            return int(cpu.PC in context.get('visited', ()))
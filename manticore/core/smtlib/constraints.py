@@ -1,5 +1,6 @@
 import itertools
 import sys
+import uuid
 
 from ...utils.helpers import PickleSerializer
 from .expression import BitVecVariable, BoolVariable, ArrayVariable, Array, Bool, BitVec, BoolConstant, ArrayProxy, BoolEq, Variable, Constant
@@ -22,6 +23,11 @@ class ConstraintSet:
         self._sid = 0
         self._declarations = {}
         self._child = None
+        # Dependency index of the constraints of this set (not the parents).
+        # Built when first needed, see _get_index()
+        self._index = None
+        # Identity used by _snapshot_id(), not pickled
+        self._uid = None
 
     def __reduce__(self):
         return (self.__class__, (), {'_parent': self._parent, '_constraints': self._constraints, '_sid': self._sid, '_declarations': self._declarations})
@@ -66,56 +72,110 @@ class ConstraintSet:
             if not constraint.value:
                 logger.info("Adding an impossible constant constraint")
                 self._constraints = [constraint]
+                self._index = None
+                self._uid = None
             else:
                 return
 
         self._constraints.append(constraint)
+        if self._index is not None:
+            self._add_to_index(self._index, constraint)
 
         if check:
             from ...core.smtlib import solver
             if not solver.check(self):
                 raise ValueError("Added an impossible constraint")
 
+    def _snapshot_id(self):
+        """
+        Returns an id for the current content of this set (not its parents).
+        Adding a constraint or a declaration gives a new id.
+        """
+        if self._uid is None:
+            self._uid = uuid.uuid4().hex
+        return f'{self._uid}_{len(self._constraints):x}_{len(self._declarations):x}'
+
     def _get_sid(self):
         """ Returns a unique id. """
         assert self._child is None
         self._sid += 1
         return self._sid
 
+    @staticmethod
+    def _add_to_index(index, constraint):
+        users, variables_of = index
+        if constraint in variables_of:
+            return
+        variables = get_variables(constraint)
+        variables_of[constraint] = variables
+        if isinstance(constraint, BoolConstant) and not constraint.value:
+            # Impossible constraints are related to everything
+            users.setdefault(None, []).append(constraint)
+        for var in variables:
+            users.setdefault(var, []).append(constraint)
+
+    def _get_index(self):
+        """
+        The dependency index of the constraints added to this set (not its
+        parents): a map from each variable to the constraints using it and a
+        map from each constraint to its variables.
+        """
+        if self._index is None:
+            index = ({}, {})
+            for constraint in self._constraints:
+                self._add_to_index(index, constraint)
+            self._index = index
+        return self._index
+
     def __get_related(self, related_to=None):
+        indexes = []
+        constraint_set = self
+        while constraint_set is not None:
+            indexes.append(constraint_set._get_index())
+            constraint_set = constraint_set._parent
+
         if related_to is not None:
-            number_of_constraints = len(self.constraints)
-            remaining_constraints = set(self.constraints)
-            related_variables = get_variables(related_to)
+            for users, _ in indexes:
+                if None in users:
+                    return set(), {users[None][0]}
+
+            # Follow variable -> constraints -> variables from related_to. Each
+            # related constraint and variable is visited once
+            if isinstance(related_to, (list, tuple)):
+                related_variables = get_variables(*related_to)
+            else:
+                related_variables = get_variables(related_to)
             related_constraints = set()
-
-            added = True
-            while added:
-                added = False
-                logger.debug('Related variables %r', [x.name for x in related_variables])
-                for constraint in list(remaining_constraints):
-                    if isinstance(constraint, BoolConstant):
-                        if constraint.value:
+            pending = list(related_variables)
+            while pending:
+                var = pending.pop()
+                for users, variables_of in indexes:
+                    for constraint in users.get(var, ()):
+                        if constraint in related_constraints:
                             continue
-                        else:
-                            related_constraints = {constraint}
-                            break
-
-                    variables = get_variables(constraint)
-                    if related_variables & variables:
-                        remaining_constraints.remove(constraint)
                         related_constraints.add(constraint)
-                        related_variables |= variables
-                        added = True
+                        for other in variables_of[constraint]:
+                            if other not in related_variables:
+                                related_variables.add(other)
+                                pending.append(other)
 
-            logger.debug('Reduced %d constraints!!', number_of_constraints - len(related_constraints))
+            logger.debug('Related constraints: %d', len(related_constraints))
         else:
             related_variables = set()
-            for constraint in self.constraints:
-                related_variables |= get_variables(constraint)
+            for users, _ in indexes:
+                related_variables.update(users)
+            related_variables.discard(None)
             related_constraints = set(self.constraints)
         return related_variables, related_constraints
 
+    def related_to(self, *expressions):
+        """
+        The constraints that share variables with expressions, directly or
+        through other constraints, in the order they were added
+        """
+        _, related_constraints = self.__get_related(list(expressions))
+        return [constraint for constraint in self.constraints if constraint in related_constraints]
+
     def to_string(self, related_to=None, replace_constants=True):
         related_variables, related_constraints = self.__get_related(related_to)
 
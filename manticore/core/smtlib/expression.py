@@ -1,10 +1,79 @@
-from functools import reduce
 import uuid
-
-
-class Expression:
+import weakref
+
+
+# Live immutable expressions indexed by structure. See ExpressionType.
+_interned = weakref.WeakValueDictionary()
+# Slot names of each Expression class, in MRO order
+_fields = {}
+
+
+def _get_fields(cls):
+    fields = _fields.get(cls)
+    if fields is None:
+        fields = tuple(name for klass in reversed(cls.__mro__)
+                       for name in klass.__dict__.get('__slots__', ())
+                       if name != '__weakref__')
+        _fields[cls] = fields
+    return fields
+
+
+def _intern(expression):
+    """
+    Return the live expression structurally equal to expression (or
+    expression itself if there is none).
+
+    Operands are compared by identity. As they are interned before the
+    operations using them, identity here is structural equality.
+    """
+    key = [type(expression)]
+    for name in _get_fields(type(expression)):
+        value = getattr(expression, name)
+        if isinstance(value, Expression):
+            value = id(value)
+        elif type(value) is tuple:
+            value = tuple(id(x) if isinstance(x, Expression) else x for x in value)
+        key.append(value)
+    try:
+        return _interned.setdefault(tuple(key), expression)
+    except TypeError:
+        # Some unhashable parameter
+        return expression
+
+
+def _rebuild(cls, state):
+    """ Unpickle an expression. Immutable expressions are interned again """
+    expression = object.__new__(cls)
+    for name, value in zip(_get_fields(cls), state):
+        object.__setattr__(expression, name, value)
+    if cls._hash_consed:
+        return _intern(expression)
+    return expression
+
+
+class ExpressionType(type):
+    """
+    Metaclass for expressions.
+
+    Constants and operations are immutable so they are hash-consed: building
+    one that is structurally equal to a live expression returns the existing
+    object. Duplicated subterms are then shared and visitor caches (keyed by
+    identity) hit across expressions.
+    """
+
+    def __call__(cls, *args, **kwargs):
+        expression = super().__call__(*args, **kwargs)
+        if cls._hash_consed:
+            return _intern(expression)
+        return expression
+
+
+class Expression(metaclass=ExpressionType):
     """ Abstract taintable Expression. """
 
+    __slots__ = ('_taint', '__weakref__')
+    _hash_consed = False
+
     def __init__(self, taint=()):
         if self.__class__ is Expression:
             raise TypeError
@@ -12,6 +81,20 @@ class Expression:
         super().__init__()
         self._taint = frozenset(taint)
 
+    def __reduce__(self):
+        cls = type(self)
+        return _rebuild, (cls, tuple(getattr(self, name) for name in _get_fields(cls)))
+
+    def _replace(self, **fields):
+        """
+        Build a copy of this expression with some of its fields replaced
+        (e.g. _operands or _taint). Hash-consed expressions are shared so
+        they must never be modified in place.
+        """
+        cls = type(self)
+        return _rebuild(cls, tuple(fields[name] if name in fields else getattr(self, name)
+                                   for name in _get_fields(cls)))
+
     def __repr__(self):
         return '<{:s} at {:x}{:s}>'.format(type(self).__name__, id(self), self.taint and '-T' or '')
 
@@ -25,6 +108,8 @@ class Expression:
 
 
 class Variable(Expression):
+    __slots__ = ()
+
     def __init__(self, name, *args, **kwargs):
         if self.__class__ is Variable:
             raise TypeError
@@ -51,6 +136,9 @@ class Variable(Expression):
 
 
 class Constant(Expression):
+    __slots__ = ()
+    _hash_consed = True
+
     def __init__(self, value, *args, **kwargs):
         if self.__class__ is Constant:
             raise TypeError
@@ -64,6 +152,9 @@ class Constant(Expression):
 
 
 class Operation(Expression):
+    __slots__ = ()
+    _hash_consed = True
+
     def __init__(self, *operands, **kwargs):
         if self.__class__ is Operation:
             raise TypeError
@@ -73,7 +164,11 @@ class Operation(Expression):
 
         # If taint was not forced by a keyword argument, calculate default
         if 'taint' not in kwargs:
-            kwargs['taint'] = reduce(lambda x, y: x.union(y.taint), operands, frozenset())
+            taint = frozenset()
+            for operand in operands:
+                if operand.taint:
+                    taint = taint.union(operand.taint)
+            kwargs['taint'] = taint
 
         super().__init__(**kwargs)
 
@@ -85,6 +180,8 @@ class Operation(Expression):
 ###############################################################################
 # Booleans
 class Bool(Expression):
+    __slots__ = ()
+
     def __init__(self, *operands, **kwargs):
         super().__init__(*operands, **kwargs)
 
@@ -132,6 +229,8 @@ class Bool(Expression):
 
 
 class BoolVariable(Bool, Variable):
+    __slots__ = ('_name',)
+
     def __init__(self, name, *args, **kwargs):
         super().__init__(name, *args, **kwargs)
 
@@ -141,6 +240,8 @@ class BoolVariable(Bool, Variable):
 
 
 class BoolConstant(Bool, Constant):
+    __slots__ = ('_value',)
+
     def __init__(self, value, *args, **kwargs):
         assert isinstance(value, bool)
         super().__init__(value, *args, **kwargs)
@@ -150,26 +251,36 @@ class BoolConstant(Bool, Constant):
 
 
 class BoolOperation(Operation, Bool):
+    __slots__ = ('_operands',)
+
     def __init__(self, *operands, **kwargs):
         super().__init__(*operands, **kwargs)
 
 
 class BoolNot(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, value, **kwargs):
         super().__init__(value, **kwargs)
 
 
 class BoolEq(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, **kwargs):
         super().__init__(a, b, **kwargs)
 
 
 class BoolAnd(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, **kwargs):
         super().__init__(a, b, **kwargs)
 
 
 class BoolOr(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, **kwargs):
         assert isinstance(a, Bool)
         assert isinstance(b, Bool)
@@ -177,11 +288,15 @@ class BoolOr(BoolOperation):
 
 
 class BoolXor(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, **kwargs):
         super().__init__(a, b, **kwargs)
 
 
 class BoolITE(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, cond, true, false, **kwargs):
         assert isinstance(true, Bool)
         assert isinstance(false, Bool)
@@ -192,6 +307,8 @@ class BoolITE(BoolOperation):
 class BitVec(Expression):
     """ This adds a bitsize to the Expression class """
 
+    __slots__ = ('size',)
+
     def __init__(self, size, *operands, **kwargs):
         super().__init__(*operands, **kwargs)
         self.size = size
@@ -385,6 +502,8 @@ class BitVec(Expression):
 
 
 class BitVecVariable(BitVec, Variable):
+    __slots__ = ('_name',)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -394,6 +513,8 @@ class BitVecVariable(BitVec, Variable):
 
 
 class BitVecConstant(BitVec, Constant):
+    __slots__ = ('_value',)
+
     def __init__(self, size, value, *args, **kwargs):
         assert isinstance(value, int)
         super().__init__(size, value, *args, **kwargs)
@@ -411,76 +532,106 @@ class BitVecConstant(BitVec, Constant):
 
 
 class BitVecOperation(BitVec, Operation):
+    __slots__ = ('_operands',)
+
     def __init__(self, size, *operands, **kwargs):
         super().__init__(size, *operands, **kwargs)
 
 
 class BitVecAdd(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecSub(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecMul(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecDiv(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecUnsignedDiv(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecMod(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecRem(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecUnsignedRem(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecShiftLeft(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecShiftRight(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecArithmeticShiftLeft(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecArithmeticShiftRight(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecAnd(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecOr(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         assert isinstance(a, BitVec)
         assert isinstance(b, BitVec)
@@ -489,68 +640,92 @@ class BitVecOr(BitVecOperation):
 
 
 class BitVecXor(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecNot(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, **kwargs):
         super().__init__(a.size, a, **kwargs)
 
 
 class BitVecNeg(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, *args, **kwargs):
         super().__init__(a.size, a, *args, **kwargs)
 
 
 # Comparing two bitvectors results in a Bool
 class LessThan(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a, b, *args, **kwargs)
 
 
 class LessOrEqual(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a, b, *args, **kwargs)
 
 
 class Equal(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         assert a.size == b.size
         super().__init__(a, b, *args, **kwargs)
 
 
 class GreaterThan(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         assert a.size == b.size
         super().__init__(a, b, *args, **kwargs)
 
 
 class GreaterOrEqual(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         assert a.size == b.size
         super().__init__(a, b, *args, **kwargs)
 
 
 class UnsignedLessThan(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a, b, *args, **kwargs)
         assert a.size == b.size
 
 
 class UnsignedLessOrEqual(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         assert a.size == b.size
         super().__init__(a, b, *args, **kwargs)
 
 
 class UnsignedGreaterThan(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         assert a.size == b.size
         super().__init__(a, b, *args, **kwargs)
 
 
 class UnsignedGreaterOrEqual(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         assert a.size == b.size
         super(UnsignedGreaterOrEqual,
@@ -560,6 +735,8 @@ class UnsignedGreaterOrEqual(BoolOperation):
 ###############################################################################
 # Array  BV32 -> BV8  or BV64 -> BV8
 class Array(Expression):
+    __slots__ = ('_index_bits', '_index_max', '_value_bits')
+
     def __init__(self, index_bits, index_max, value_bits, *operands, **kwargs):
         assert index_bits in (32, 64, 256)
         assert value_bits in (8, 16, 32, 64, 256)
@@ -755,6 +932,8 @@ class Array(Expression):
 
 
 class ArrayVariable(Array, Variable):
+    __slots__ = ('_name',)
+
     def __init__(self, index_bits, index_max, value_bits, name, *operands, **kwargs):
         super().__init__(index_bits, index_max, value_bits, name, **kwargs)
 
@@ -764,12 +943,16 @@ class ArrayVariable(Array, Variable):
 
 
 class ArrayOperation(Array, Operation):
+    __slots__ = ('_operands',)
+
     def __init__(self, array, *operands, **kwargs):
         assert isinstance(array, Array)
         super().__init__(array.index_bits, array.index_max, array.value_bits, array, *operands, **kwargs)
 
 
 class ArrayStore(ArrayOperation):
+    __slots__ = ()
+
     def __init__(self, array, index, value, *args, **kwargs):
         assert isinstance(array, Array)
         assert isinstance(index, BitVec) and index.size == array.index_bits
@@ -794,6 +977,8 @@ class ArrayStore(ArrayOperation):
 
 
 class ArraySlice(Array):
+    __slots__ = ('_array', '_slice_offset', '_slice_size')
+
     def __init__(self, array, offset, size, *args, **kwargs):
         if not isinstance(array, Array):
             raise ValueError("Array expected")
@@ -837,6 +1022,9 @@ class ArraySlice(Array):
 
 
 class ArrayProxy(Array):
+    # Proxies are mutable: not hash-consed and pickled with __getstate__
+    __reduce__ = object.__reduce__
+
     def __init__(self, array, default=None):
         assert isinstance(array, Array)
         self._default = default
@@ -1013,6 +1201,8 @@ class ArrayProxy(Array):
 
 
 class ArraySelect(BitVec, Operation):
+    __slots__ = ('_operands',)
+
     def __init__(self, array, index, *args, **kwargs):
         assert isinstance(array, Array)
         assert isinstance(index, BitVec) and index.size == array.index_bits
@@ -1031,6 +1221,8 @@ class ArraySelect(BitVec, Operation):
 
 
 class BitVecSignExtend(BitVecOperation):
+    __slots__ = ('extend',)
+
     def __init__(self, operand, size_dest, *args, **kwargs):
         assert isinstance(operand, BitVec)
         assert isinstance(size_dest, int)
@@ -1040,6 +1232,8 @@ class BitVecSignExtend(BitVecOperation):
 
 
 class BitVecZeroExtend(BitVecOperation):
+    __slots__ = ('extend',)
+
     def __init__(self, size_dest, operand, *args, **kwargs):
         assert isinstance(operand, BitVec)
         assert isinstance(size_dest, int)
@@ -1049,6 +1243,8 @@ class BitVecZeroExtend(BitVecOperation):
 
 
 class BitVecExtract(BitVecOperation):
+    __slots__ = ('_begining', '_end')
+
     def __init__(self, operand, offset, size, *args, **kwargs):
         assert isinstance(offset, int)
         assert isinstance(size, int)
@@ -1071,6 +1267,8 @@ class BitVecExtract(BitVecOperation):
 
 
 class BitVecConcat(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, size_dest, *operands, **kwargs):
         assert isinstance(size_dest, int)
         assert all(isinstance(x, BitVec) for x in operands)
@@ -1079,6 +1277,8 @@ class BitVecConcat(BitVecOperation):
 
 
 class BitVecITE(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, size, condition, true_value, false_value, *args, **kwargs):
         assert isinstance(true_value, BitVec)
         assert isinstance(false_value, BitVec)
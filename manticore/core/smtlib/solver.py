@@ -14,8 +14,11 @@
 # Once you Solver.check() it the status is changed to sat or unsat (or unknown+exception)
 # You can create new symbols operate on them. The declarations will be sent to the smtlib process when needed.
 # You can add new constraints. A new constraint may change the state from {None, sat} to {sat, unsat, unknown}
+import ast
+import hashlib
 import os
 import threading
+import uuid
 import collections
 import shlex
 import time
@@ -36,6 +39,12 @@ consts.add('memory', default=16384, description='Max memory for Z3 to use (in Me
 consts.add('maxsolutions', default=10000, description='Maximum solutions to provide when solving for all values')
 consts.add('z3_bin', default='z3', description='Z3 binary to use')
 consts.add('defaultunsat', default=True, description='Consider solver timeouts as unsat core')
+consts.add('incremental', default=True, description='Keep the constraints already asserted in the solver between queries and only send the new ones')
+consts.add('max_frames', default=64, description='Maximum number of nested scopes kept by an incremental solver session before it is restarted')
+consts.add('cache', default=True, description='Memoize the results of solver queries')
+consts.add('cache_size', default=10000, description='Maximum number of solver query results kept in memory by each worker')
+consts.add('pool_size', default=1, description='Number of z3 processes used to answer batches of independent feasibility checks (e.g. SAMPLED concretization) concurrently. 1 disables the pool')
+consts.add('cache_store', default='', description="Store used to share solver query results between workers and runs: 'workspace', a store descriptor (e.g. fs:/tmp/smtcache) or empty (the default) to keep them in memory only")
 
 
 # Regular expressions used by the solver
@@ -56,6 +65,102 @@ class SingletonMixin(object):
         return cls.__singleton_instances[(pid, tid)]
 
 
+class SolverCache:
+    """
+    Memoizes solver query results.
+
+    A query is identified by a digest of its kind, its arguments and the
+    normalized (sorted) smtlib of the related constraints. Results are kept in
+    an in-process LRU. If a store is attached the results it holds are read
+    at once, and new ones are written to it in batches, so sibling workers
+    and later runs over the same code can reuse them.
+    """
+    _prefix = '.smt_'
+    #: Number of new results written to the attached store at once
+    batch_size = 1000
+
+    def __init__(self, max_size):
+        self._data = collections.OrderedDict()
+        self._max_size = max_size
+        self._store = None
+        self._unsaved = {}
+        self.hits = 0
+        self.misses = 0
+
+    def attach(self, store):
+        """Share query results through store, or stop sharing if it is None"""
+        self.flush()
+        self._store = store
+        if store is None:
+            return
+        for key in store.ls(f'{self._prefix}*'):
+            if not key.startswith(self._prefix):
+                continue
+            try:
+                results = ast.literal_eval(store.load_value(key))
+            except (OSError, ValueError, SyntaxError):
+                # Unreadable (e.g. being written)
+                continue
+            for digest, value in results.items():
+                self._remember(digest, value)
+
+    def flush(self):
+        """Write the results not saved yet to the attached store"""
+        if self._store is None or not self._unsaved:
+            return
+        try:
+            self._store.save_value(f'{self._prefix}{uuid.uuid4().hex}', repr(self._unsaved))
+        except OSError as e:
+            logger.debug("Could not save solver results: %s", e)
+        self._unsaved = {}
+
+    @staticmethod
+    def key(query, constraints, *args):
+        """
+        :param str query: the query kind
+        :param str constraints: smtlib of the constraints the query depends on
+        :param args: query arguments. Expressions are translated to smtlib
+        """
+        digest = hashlib.sha256(query.encode())
+        for arg in args:
+            if isinstance(arg, Expression):
+                declarations = sorted(var.declaration for var in get_variables(arg))
+                arg = ' '.join(declarations + [translate_to_smtlib(arg, use_bindings=True)])
+            digest.update(f'\0{arg}'.encode())
+        for line in sorted(set(constraints.splitlines())):
+            digest.update(f'\n{line}'.encode())
+        return digest.hexdigest()
+
+    def get(self, key, default=None):
+        if key is None:
+            return default
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        if key is None:
+            return value
+        self._remember(key, value)
+        if self._store is not None:
+            self._unsaved[key] = value
+            if len(self._unsaved) >= self.batch_size:
+                self.flush()
+        return value
+
+    def _remember(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
 class Solver(SingletonMixin):
     def __init__(self):
         pass
@@ -84,6 +189,10 @@ class Solver(SingletonMixin):
         solutions = self.get_all_values(constraints, expression, maxcnt=2, silent=True)
         return solutions == [True]
 
+    def can_be_true_all(self, constraints, expressions) -> list:
+        """Check each one of expressions independently. Returns a list of bools"""
+        return [self.can_be_true(constraints, expression) for expression in expressions]
+
     def get_all_values(self, constraints, x, maxcnt=10000, silent=False):
         """Returns a list with all the possible values for the symbol x"""
         raise Exception("Abstract method not implemented")
@@ -134,6 +243,18 @@ class Z3Solver(Solver):
         """
         super().__init__()
         self._proc: Popen = None
+        # Incremental session. Each frame is the set of smtlib commands sent
+        # inside one (push) scope and _loaded is the union of all frames.
+        # An extra scope on top of them holds the query specific commands
+        # (_query) when _query_scope is True.
+        self._frames = []
+        self._loaded = set()
+        self._query = set()
+        self._query_scope = False
+        self._cache = SolverCache(consts.cache_size)
+        # Number of checks answered with unknown (i.e. timeouts). Results
+        # computed while it changes are degraded and never cached
+        self._unknowns = 0
 
         self._command = f'{consts.z3_bin} -t:{consts.timeout*1000} -memory:{consts.memory} -smt2 -in'
 
@@ -195,6 +316,8 @@ class Z3Solver(Solver):
             # Z3 was removed from the system in the middle of operation
             raise Z3NotFoundError  # TODO(mark) don't catch this exception in two places
 
+        self._forget()
+
         # run solver specific initializations
         for cfg in self._init:
             self._send(cfg)
@@ -248,11 +371,19 @@ class Z3Solver(Solver):
 
     def _reset(self, constraints=None):
         """Auxiliary method to reset the smtlib external solver to initial defaults"""
+        if self._proc is not None and self._proc.poll() is not None:
+            # z3 died (e.g. killed by the OOM killer). Start a new one
+            logger.info("Z3 exited with code %d, restarting it", self._proc.returncode)
+            self._stop_proc()
         if self._proc is None:
             self._start_proc()
+        elif consts.incremental and constraints is not None and len(self._frames) < consts.max_frames:
+            # _load() will keep whatever was already asserted
+            pass
         else:
             if self.support_reset:
                 self._send("(reset)")
+                self._forget()
 
                 for cfg in self._init:
                     self._send(cfg)
@@ -260,7 +391,65 @@ class Z3Solver(Solver):
                 self._stop_proc()
                 self._start_proc()
         if constraints is not None:
-            self._send(constraints)
+            self._load(f'{constraints}')
+
+    def _forget(self):
+        """Forget the incremental session. The solver has no scopes now"""
+        self._frames = []
+        self._loaded = set()
+        self._query = set()
+        self._query_scope = False
+
+    def _load(self, constraints: str):
+        """
+        Make the solver state match the constraints text reusing the commands
+        already asserted in previous queries.
+
+        Scopes holding commands that are not part of the new text are popped.
+        The remaining commands are sent in a new scope. Finally an empty scope
+        is pushed for the query itself (extra asserts, declarations) so it can
+        be discarded by the next _load().
+
+        :param constraints: smtlib commands, one per line as produced by
+                            ConstraintSet.to_string()
+        """
+        if self._query_scope:
+            self._pop()
+            self._query = set()
+            self._query_scope = False
+
+        commands = [command for command in constraints.splitlines() if command]
+        wanted = set(commands)
+
+        keep = 0
+        for frame in self._frames:
+            if not frame <= wanted:
+                break
+            keep += 1
+        while len(self._frames) > keep:
+            self._loaded -= self._frames.pop()
+            self._pop()
+
+        delta = []
+        for command in commands:
+            if command not in self._loaded:
+                self._loaded.add(command)
+                delta.append(command)
+
+        if delta:
+            self._push()
+            self._frames.append(set(delta))
+            self._send('\n'.join(delta))
+
+        self._push()
+        self._query_scope = True
+
+    def _send_once(self, command: str):
+        """Send a declaration to the solver unless it was already sent"""
+        if command in self._loaded or command in self._query:
+            return
+        self._query.add(command)
+        self._send(command)
 
     def _send(self, cmd: str):
         """
@@ -291,6 +480,8 @@ class Z3Solver(Solver):
 
         #logger.debug('<%s', buf)
         if '(error' in bufl[0]:
+            # The solver state is unknown now. Start from scratch next time
+            self._stop_proc()
             raise Exception(f"Error in smtlib: {bufl[0]}")
         return buf
 
@@ -310,8 +501,14 @@ class Z3Solver(Solver):
         self._send('(check-sat)')
         status = self._recv()
         logger.debug("Check took %s seconds (%s)", time.time() - start, status)
+        return self._sat_status(status)
+
+    def _sat_status(self, status: str) -> bool:
+        """Interpret the answer to a (check-sat)"""
         if status not in ('sat', 'unsat', 'unknown'):
             raise SolverError(status)
+        if status == 'unknown':
+            self._unknowns += 1
         if consts.defaultunsat:
             if status == 'unknown':
                 logger.info('Found an unknown core, probably a solver timeout')
@@ -323,9 +520,12 @@ class Z3Solver(Solver):
         return status == 'sat'
 
     def _assert(self, expression: Bool):
-        """Auxiliary method to send an assert"""
+        """Auxiliary method to send an assert. The variables used in
+        expression are declared if needed"""
         assert isinstance(expression, Bool)
-        smtlib = translate_to_smtlib(expression)
+        for var in get_variables(expression):
+            self._send_once(var.declaration)
+        smtlib = translate_to_smtlib(expression, use_bindings=True)
         self._send('(assert %s)' % smtlib)
 
     def _getvalue(self, expression):
@@ -371,21 +571,71 @@ class Z3Solver(Solver):
         """Recall the last pushed constraint store and state."""
         self._send('(pop 1)')
 
-    def can_be_true(self, constraints, expression):
-        """Check if two potentially symbolic values can be equal"""
+    def attach_cache_store(self, store):
+        """Share the query results of this solver through store, or stop if it is None"""
+        self._cache.attach(store)
+
+    def _cache_put(self, key, value, unknowns):
+        """Cache a query result unless a check answered unknown since unknowns was read"""
+        if self._unknowns != unknowns:
+            return value
+        return self._cache.put(key, value)
+
+    def _cache_key(self, query, related, *args):
+        """Key for the results cache. Queries with a None key are not cached"""
+        if not consts.cache:
+            return None
+        if any(isinstance(arg, Array) for arg in args):
+            # Array expressions (i.e. slices) may not have a smtlib translation
+            return None
+        return SolverCache.key(query, related, *args)
+
+    @staticmethod
+    def _can_be_true_query(constraints, expression):
+        """
+        Normalize a can_be_true query.
+
+        :return: the expression to check and the smtlib of its related
+                 constraints, or None if expression is concretely False
+        """
         if isinstance(expression, bool):
             if not expression:
-                return expression
-            else:
-                # if True check if constraints are feasible
-                self._reset(constraints)
-                return self._is_sat()
+                return None
+            # if True check if constraints are feasible
+            return BoolConstant(True), constraints.to_string()
         assert isinstance(expression, Bool)
+        expression = simplify(expression)
+        return expression, constraints.to_string(related_to=expression)
+
+    def _start_check(self, related: str, expression: Bool):
+        """Send a satisfiability check without waiting for the answer"""
+        # The constraints already loaded in the solver are kept; the query
+        # itself goes to a scope of its own
+        self._reset(related)
+        self._assert(expression)
+        self._send('(check-sat)')
 
-        with constraints as temp_cs:
-            temp_cs.add(expression)
-            self._reset(temp_cs.to_string(related_to=expression))
-            return self._is_sat()
+    def can_be_true(self, constraints, expression):
+        """Check if two potentially symbolic values can be equal"""
+        query = self._can_be_true_query(constraints, expression)
+        if query is None:
+            return False
+        expression, related = query
+
+        key = self._cache_key('can_be_true', related, expression)
+        result = self._cache.get(key)
+        if result is None:
+            unknowns = self._unknowns
+            self._reset(related)
+            self._assert(expression)
+            result = self._is_sat()
+            self._cache_put(key, result, unknowns)
+        return result
+
+    def can_be_true_all(self, constraints, expressions):
+        if consts.pool_size > 1 and len(expressions) > 1:
+            return SolverPool.instance().can_be_true_all(constraints, expressions)
+        return super().can_be_true_all(constraints, expressions)
 
     # get-all-values min max minmax
     def get_all_values(self, constraints, expression, maxcnt=None, silent=False):
@@ -398,6 +648,13 @@ class Z3Solver(Solver):
         if maxcnt is None:
             maxcnt = consts.maxsolutions
 
+        related = constraints.to_string(related_to=expression)
+        key = self._cache_key('get_all_values', related, expression, maxcnt, silent)
+        result = self._cache.get(key)
+        if result is not None:
+            return list(result)
+
+        unknowns = self._unknowns
         with constraints as temp_cs:
             if isinstance(expression, Bool):
                 var = temp_cs.new_bool()
@@ -408,8 +665,8 @@ class Z3Solver(Solver):
             else:
                 raise NotImplementedError(f"get_all_values only implemented for {type(expression)} expression type.")
 
-            temp_cs.add(var == expression)
-            self._reset(temp_cs.to_string(related_to=var))
+            self._reset(related)
+            self._assert(var == expression)
 
             result = []
 
@@ -428,6 +685,7 @@ class Z3Solver(Solver):
                     else:
                         raise TooManySolutions(result)
 
+            self._cache_put(key, list(result), unknowns)
             return result
 
     def optimize(self, constraints: ConstraintSet, x: BitVec, goal: str, M=10000):
@@ -442,14 +700,24 @@ class Z3Solver(Solver):
         """
         assert goal in ('maximize', 'minimize')
         assert isinstance(x, BitVec)
+
+        related = constraints.to_string(related_to=x)
+        key = self._cache_key('optimize', related, x, goal)
+        result = self._cache.get(key)
+        if result is None:
+            unknowns = self._unknowns
+            result = self._cache_put(key, self._optimize(constraints, x, goal, M, related), unknowns)
+        return result
+
+    def _optimize(self, constraints: ConstraintSet, x: BitVec, goal: str, M, related: str):
         operation = {'maximize': Operators.UGE, 'minimize': Operators.ULE}[goal]
 
         with constraints as temp_cs:
             X = temp_cs.new_bitvec(x.size)
-            temp_cs.add(X == x)
             aux = temp_cs.new_bitvec(X.size, name='optimized_')
-            self._reset(temp_cs.to_string(related_to=X))
-            self._send(aux.declaration)
+            self._reset(related)
+            self._assert(X == x)
+            self._send_once(aux.declaration)
 
             if getattr(self, f'support_{goal}'):
                 self._push()
@@ -478,8 +746,9 @@ class Z3Solver(Solver):
                         return int(value)
                 finally:
                     self._pop()
-                    self._reset(temp_cs)
-                    self._send(aux.declaration)
+                    self._reset(related)
+                    self._assert(X == x)
+                    self._send_once(aux.declaration)
 
             operation = {'maximize': Operators.UGT, 'minimize': Operators.ULT}[goal]
             self._assert(aux == X)
@@ -502,6 +771,16 @@ class Z3Solver(Solver):
         if not issymbolic(expression):
             return expression
         assert isinstance(expression, (Bool, BitVec, Array))
+
+        related = constraints.to_string()
+        key = self._cache_key('get_value', related, expression)
+        result = self._cache.get(key)
+        if result is None:
+            unknowns = self._unknowns
+            result = self._cache_put(key, self._get_value(constraints, expression, related), unknowns)
+        return result
+
+    def _get_value(self, constraints, expression, related: str):
         with constraints as temp_cs:
             if isinstance(expression, Bool):
                 var = temp_cs.new_bool()
@@ -513,9 +792,10 @@ class Z3Solver(Solver):
                 for i in range(expression.index_max):
                     subvar = temp_cs.new_bitvec(expression.value_bits)
                     var.append(subvar)
-                    temp_cs.add(subvar == simplify(expression[i]))
 
-                self._reset(temp_cs)
+                self._reset(related)
+                for i in range(expression.index_max):
+                    self._assert(var[i] == simplify(expression[i]))
                 if not self._is_sat():
                     raise SolverError('Model is not available')
 
@@ -529,9 +809,8 @@ class Z3Solver(Solver):
                     result.append(int(value, base))
                 return bytes(result)
 
-            temp_cs.add(var == expression)
-
-            self._reset(temp_cs)
+            self._reset(related)
+            self._assert(var == expression)
 
         if not self._is_sat():
             raise SolverError('Model is not available')
@@ -549,3 +828,91 @@ class Z3Solver(Solver):
             expr, value = m.group('expr'), m.group('value')
             return int(value, base)
         raise NotImplementedError("get_value only implemented for Bool and BitVec")
+
+
+class SolverPool(SingletonMixin):
+    """
+    A set of warm z3 processes answering independent queries concurrently.
+
+    Every query of a batch is written to its own z3 process before any answer
+    is read, so the processes work in parallel while the calling thread waits
+    on the first answer. No extra threads are involved: expressions are
+    translated in the caller as usual.
+
+    A process that crashed is restarted and its query retried once. A process
+    that timed out is restarted before its next query, and its answer is not
+    cached.
+    """
+
+    def __init__(self, size=None):
+        self._size = max(1, consts.pool_size if size is None else size)
+        self._solvers = []
+        self._cache = SolverCache(consts.cache_size)
+
+    def _solver(self, index):
+        while len(self._solvers) <= index:
+            self._solvers.append(Z3Solver())
+        return self._solvers[index]
+
+    @staticmethod
+    def _answer(solver):
+        """:return: whether the check was sat, or None if z3 answered unknown"""
+        status = solver._recv()
+        if status == 'unknown':
+            # Probably a timeout, don't reuse whatever z3 has learned so far
+            solver._stop_proc()
+            return None
+        return solver._sat_status(status)
+
+    def _check(self, solver, related, expression, started):
+        """Wait for the answer of a started check, retrying on a fresh process if z3 crashed"""
+        try:
+            if started:
+                return self._answer(solver)
+        except SolverError as e:
+            logger.info("Z3 failed (%s), retrying the query", e)
+        solver._stop_proc()
+        solver._start_check(related, expression)
+        return self._answer(solver)
+
+    def can_be_true_all(self, constraints, expressions):
+        """
+        Check each one of expressions independently
+
+        :param constraints: constraints that the expressions must fulfil
+        :param expressions: list of Bool expressions (or bools)
+        :return: a list with a bool for each expression
+        """
+        results = [False] * len(expressions)
+        pending = []
+        for index, expression in enumerate(expressions):
+            query = Z3Solver._can_be_true_query(constraints, expression)
+            if query is None:
+                continue
+            expression, related = query
+            key = SolverCache.key('can_be_true', related, expression) if consts.cache else None
+            result = self._cache.get(key)
+            if result is None:
+                pending.append((index, key, related, expression))
+            else:
+                results[index] = result
+
+        for start in range(0, len(pending), self._size):
+            batch = [(self._solver(i), query) for i, query in enumerate(pending[start:start + self._size])]
+
+            started = []
+            for solver, (_, _, related, expression) in batch:
+                try:
+                    solver._start_check(related, expression)
+                    started.append(True)
+                except SolverError:
+                    started.append(False)
+
+            for (solver, (index, key, related, expression)), was_started in zip(batch, started):
+                result = self._check(solver, related, expression, was_started)
+                if result is None:
+                    results[index] = solver._sat_status('unknown')
+                else:
+                    results[index] = self._cache.put(key, result)
+
+        return results
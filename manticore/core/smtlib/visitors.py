@@ -1,3 +1,4 @@
+import hashlib
 from ...utils.helpers import CacheDict
 from .expression import *
 from functools import lru_cache
@@ -30,11 +31,30 @@ class Visitor:
 
     """
 
+    # (visitor class, expression class) -> visit_ functions to try in order
+    _dispatch_tables = {}
+
     def __init__(self, cache=None, **kwargs):
         super().__init__()
         self._stack = []
         self._cache = {} if cache is None else cache
 
+    def _visit_methods(self, expression_type):
+        """
+        The visit_ functions this visitor implements for expression_type,
+        following its __mro__. Computed once per (visitor class, expression class)
+        """
+        key = (type(self), expression_type)
+        methods = Visitor._dispatch_tables.get(key)
+        if methods is None:
+            methods = []
+            for cls in expression_type.__mro__:
+                method = getattr(type(self), f'visit_{cls.__name__}', None)
+                if method is not None:
+                    methods.append(method)
+            methods = Visitor._dispatch_tables[key] = tuple(methods)
+        return methods
+
     def push(self, value):
         assert value is not None
         self._stack.append(value)
@@ -51,15 +71,11 @@ class Visitor:
         return self._stack[-1]
 
     def _method(self, expression, *args):
-        assert expression.__class__.__mro__[-1] is object
-        for cls in expression.__class__.__mro__:
-            sort = cls.__name__
-            methodname = 'visit_%s' % sort
-            if hasattr(self, methodname):
-                value = getattr(self, methodname)(expression, *args)
-                if value is not None:
-                    assert isinstance(value, Expression)
-                    return value
+        for method in self._visit_methods(type(expression)):
+            value = method(self, expression, *args)
+            if value is not None:
+                assert isinstance(value, Expression)
+                return value
         return self._rebuild(expression, args)
 
     def visit(self, node, use_fixed_point=False):
@@ -106,14 +122,25 @@ class Visitor:
                 new_value = self.pop()
             self.push(new_value)
 
+    def visit_all(self, nodes, use_fixed_point=False):
+        """
+        Visit several expressions sharing the cache between them.
+
+        :param nodes: iterable of expressions to explore
+        :param use_fixed_point: see visit()
+        :return: the list of results, one for each node
+        """
+        results = []
+        for node in nodes:
+            self.visit(node, use_fixed_point=use_fixed_point)
+            results.append(self.pop())
+        return results
+
     @staticmethod
     def _rebuild(expression, operands):
         if isinstance(expression, Operation):
             if any(x is not y for x, y in zip(expression.operands, operands)):
-                import copy
-                aux = copy.copy(expression)
-                aux._operands = operands
-                return aux
+                return expression._replace(_operands=tuple(operands))
         return expression
 
 
@@ -125,14 +152,10 @@ class Translator(Visitor):
         #Special case. Need to get the unsleeved version of the array
         if isinstance(expression, ArrayProxy):
             expression = expression.array
-        assert expression.__class__.__mro__[-1] is object
-        for cls in expression.__class__.__mro__:
-            sort = cls.__name__
-            methodname = f'visit_{sort:s}'
-            if hasattr(self, methodname):
-                value = getattr(self, methodname)(expression, *args)
-                if value is not None:
-                    return value
+        for method in self._visit_methods(type(expression)):
+            value = method(self, expression, *args)
+            if value is not None:
+                return value
         raise Exception(f"No translation for this {expression}")
 
 
@@ -199,15 +222,9 @@ class PrettyPrinter(Visitor):
         Overload Visitor._method because we want to stop to iterate over the
         visit_ functions as soon as a valid visit_ function is found
         """
-        assert expression.__class__.__mro__[-1] is object
-        for cls in expression.__class__.__mro__:
-            sort = cls.__name__
-            methodname = 'visit_%s' % sort
-            method = getattr(self, methodname, None)
-            if method is not None:
-                method(expression, *args)
-                return
-        return
+        methods = self._visit_methods(type(expression))
+        if methods:
+            methods[0](self, expression, *args)
 
     def visit_Operation(self, expression, *operands):
         self._print(expression.__class__.__name__, expression)
@@ -616,8 +633,6 @@ def simplify(expression):
 class TranslatorSmtlib(Translator):
     """ Simple visitor to translate an expression to its smtlib representation
     """
-    unique = 0
-
     def __init__(self, use_bindings=False, *args, **kw):
         assert 'bindings' not in kw
         super().__init__(*args, **kw)
@@ -632,12 +647,14 @@ class TranslatorSmtlib(Translator):
         if smtlib in self._bindings_cache:
             return self._bindings_cache[smtlib]
 
-        TranslatorSmtlib.unique += 1
-        name = 'a_%d' % TranslatorSmtlib.unique
+        # The name depends only on the bound term so the same binding gets the
+        # same name on every translation. Incremental solver sessions rely on
+        # this to recognize already declared bindings.
+        name = 'a_%s' % hashlib.md5(smtlib.encode()).hexdigest()
 
         self._bindings.append((name, expression, smtlib))
 
-        self._bindings_cache[expression] = name
+        self._bindings_cache[smtlib] = name
         return name
 
     @property
@@ -783,7 +800,15 @@ def simplify_array_select(array_exp):
     return simplifier.stores
 
 
-def get_variables(expression):
+def _unproxied(expression):
+    # Proxies and slices are not operations, look into the arrays behind them
+    while isinstance(expression, (ArrayProxy, ArraySlice)):
+        expression = expression._array
+    return expression
+
+
+def get_variables(*expressions):
+    """ The variables used by any of the expressions """
     visitor = GetDeclarations()
-    visitor.visit(expression)
+    visitor.visit_all(map(_unproxied, expressions))
     return visitor.result
@@ -246,11 +246,12 @@ class StateBase(Eventful):
                 if self._solver.can_be_true(self._constraints, symbolic == (m + M) // 2):
                     vals.append((m + M) // 2)
             if M - m > 100:
-                for i in (0, 1, 2, 5, 32, 64, 128, 320):
-                    if self._solver.can_be_true(self._constraints, symbolic == m + i):
-                        vals.append(m + i)
-                    if maxcount <= len(vals):
-                        break
+                # Only as many values as are still missing are checked at once
+                samples = [m + i for i in (0, 1, 2, 5, 32, 64, 128, 320)]
+                while samples and maxcount > len(vals):
+                    batch, samples = samples[:maxcount - len(vals)], samples[maxcount - len(vals):]
+                    feasible = self._solver.can_be_true_all(self._constraints, [symbolic == value for value in batch])
+                    vals += [value for value, can_be_true in zip(batch, feasible) if can_be_true]
             if M - m > 1000 and maxcount > len(vals):
                 vals += self._solver.get_all_values(self._constraints, symbolic,
                                                     maxcnt=maxcount - len(vals), silent=True)
@@ -284,6 +285,11 @@ class StateBase(Eventful):
         expr = self.migrate_expression(expr)
         return self._solver.can_be_true(self._constraints, expr)
 
+    def can_be_true_all(self, exprs):
+        """ Check each one of exprs independently (potentially in parallel) """
+        exprs = [self.migrate_expression(expr) for expr in exprs]
+        return self._solver.can_be_true_all(self._constraints, exprs)
+
     def can_be_false(self, expr):
         expr = self.migrate_expression(expr)
         return self._solver.can_be_true(self._constraints, expr == False)
@@ -311,6 +317,29 @@ class StateBase(Eventful):
             value = bytes(value)
         return value
 
+    def solve_one_n(self, *exprs, constrain=False):
+        """
+        Concretize several symbolic expressions into one solution each, all of
+        them taken from the same model.
+
+        :param exprs: Symbolic values to concretize
+        :param bool constrain: If True, constrain each expr to its concretized value
+        :return: Concrete values, in the order of `exprs`
+        :rtype: list
+        """
+        exprs = [self.migrate_expression(expr) for expr in exprs]
+        values = []
+        with self._constraints as temp_cs:
+            for expr in exprs:
+                value = self._solver.get_value(temp_cs, expr)
+                temp_cs.add(expr == value)
+                values.append(value)
+        if constrain:
+            for expr, value in zip(exprs, values):
+                self.constrain(expr == value)
+        #Include forgiveness here
+        return [bytes(value) if isinstance(value, bytearray) else value for value in values]
+
     def solve_n(self, expr, nsolves):
         """
         Concretize a symbolic :class:`~manticore.core.smtlib.expression.Expression` into
@@ -1,4 +1,5 @@
 from ..utils.nointerrupt import WithKeyboardInterruptAs
+from .smtlib import Z3Solver
 from .state import Concretize, TerminateState
 import logging
 import multiprocessing
@@ -62,6 +63,9 @@ class Worker:
         m._is_main = False  # This will mark our copy of manticore
         current_state = None
         m._publish("will_start_worker", self.id)
+        # Only the solver of this worker uses the cache store of its manticore
+        solver = Z3Solver.instance()
+        solver.attach_cache_store(m._solver_cache_store)
 
         # If CTRL+C is received at any worker lets abort exploration via m.kill()
         # kill will set m._killed flag to true and then each worker will slowly
@@ -88,8 +92,10 @@ class Worker:
                         # Raises an Exception if manticore gets cancelled
                         # while waiting or if there are no more potential states
                         logger.debug("[%r] Waiting for states", self.id)
-                        # If at STANDBY wait for any change
-                        current_state = m._get_state(wait=True)
+                        # If at STANDBY wait for any change. A state kept
+                        # by the last fork is explored right away
+                        if current_state is None:
+                            current_state = m._get_state(wait=True)
 
                         # there are no more states to process
                         # states can come from the ready list or by forking
@@ -123,13 +129,11 @@ class Worker:
                     except Concretize as exc:
                         logger.debug("[%r] Debug %r", self.id, exc)
                         # The fork() method can decides which state to keep
-                        # exploring. For example when the fork results in a
-                        # single state it is better to just keep going.
-                        # Though, normally fork() saves the spawned childs,
-                        # returns a None and let _get_state choose what to explore
-                        # next
-                        m._fork(current_state, exc.expression, exc.policy, exc.setstate)
-                        current_state = None
+                        # exploring. It saves the spawned childs but one and
+                        # returns it if the scheduler would pick it next.
+                        # Otherwise it returns None and lets _get_state choose
+                        # what to explore next
+                        current_state = m._fork(current_state, exc.expression, exc.policy, exc.setstate)
 
                     except TerminateState as exc:
                         logger.debug("[%r] Debug State %r %r", self.id, current_state, exc)
@@ -165,9 +169,16 @@ class Worker:
                         current_state = None
                     break
 
+            # A state kept by the last fork goes back to the READY list
+            if current_state is not None:
+                m._save(current_state, state_id=current_state.id)
+                m._revive_state(current_state.id)
+                current_state = None
+
             # Getting out.
             # At KILLED
             logger.debug("[%r] Getting out of the mainloop", self.id)
+            solver.attach_cache_store(None)
             m._publish("did_terminate_worker", self.id)
 
 
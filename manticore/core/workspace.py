@@ -26,8 +26,10 @@ import time
 import os
 import errno
 import threading
+import weakref
 from ..utils import config
-from ..utils.helpers import PickleSerializer
+from ..utils.helpers import PickleSerializer, Page
+from .smtlib.expression import Variable
 from .smtlib.solver import Z3Solver
 from .state import StateBase
 
@@ -67,7 +69,21 @@ class Store:
      * Implement either save_value/load_value, or save_stream/load_stream, or both.
      * Define a `store_type` class variable of type str.
        * This is used as a prefix for a store descriptor
+
+    States share the constraints of their ancestors. When a state is saved
+    the parent constraint sets of its `ConstraintSet` are saved once, under
+    `.constraints_<snapshot id>` keys, and the state only holds its own
+    constraints plus references to them. Sibling states reference the same
+    segments and loading them in the same process yields the same objects.
+
+    Likewise memory pages (see :class:`~manticore.utils.helpers.Page`) are
+    saved once per distinct content under `.page_<digest>` keys.
+
+    The segments and pages a state uses are listed under `.refs_<state key>`.
+    :meth:`remove_unreferenced` deletes the ones no saved state lists.
     """
+    #: Number of recently loaded pages kept in memory
+    page_cache_size = 1024
 
     @classmethod
     def fromdescriptor(cls, desc):
@@ -99,6 +115,15 @@ class Store:
         else:
             raise NotImplementedError(f"Pickling method '{state_serialization_method}' not supported.")
 
+        # Snapshot ids of the constraint segments known to be in the store
+        self._saved_constraints = set()
+        self._loaded_constraints = weakref.WeakValueDictionary()
+        # Keeps the last loaded chain of segments alive for its siblings
+        self._last_constraints = None
+        # Digests of the pages known to be in the store
+        self._saved_pages = set()
+        self._loaded_pages = {}
+
     # save_value/load_value and save_stream/load_stream are implemented in terms of each other. A backing store
     # can choose the pair it's best optimized for.
     def save_value(self, key, value):
@@ -155,8 +180,25 @@ class Store:
         :param str key:
         :return:
         """
+        constraints_id = self._constraints_persistent_id(state.constraints)
+        refs = set()
+        constraints = state.constraints._parent
+        while constraints is not None:
+            refs.add(f'.constraints_{constraints._snapshot_id()}')
+            constraints = constraints._parent
+
+        def persistent_id(obj):
+            if type(obj) is Page:
+                digest = self._save_page(obj)
+                refs.add(f'.page_{digest}')
+                return ('page', digest)
+            if constraints_id is not None:
+                return constraints_id(obj)
+            return None
+
         with self.save_stream(key, binary=True) as f:
-            self._serializer.serialize(state, f)
+            self._serializer.serialize(state, f, persistent_id)
+        self.save_value(f'.refs_{key}', '\n'.join(sorted(refs)))
 
     def load_state(self, key, delete=True):
         """
@@ -166,13 +208,122 @@ class Store:
         :rtype: manticore.core.StateBase
         """
 
+        # The segments are only weakly cached. Hold the ones this state uses
+        # until it references them, so every reference gets the same objects
+        pinned = []
         with self.load_stream(key, binary=True) as f:
-            state = self._serializer.deserialize(f)
+            state = self._serializer.deserialize(f, lambda pid: self._persistent_load(pid, pinned))
             if delete:
                 self.rm(key)
 
+            self._last_constraints = state.constraints._parent
             return state
 
+    def _constraints_persistent_id(self, root):
+        """
+        Save the ancestors of the `root` constraint set and return a
+        persistent_id function that pickles them (and the variables they
+        declare) as references.
+        """
+        ancestors = []
+        constraints = root._parent
+        while constraints is not None and constraints._snapshot_id() not in self._saved_constraints:
+            ancestors.append(constraints)
+            constraints = constraints._parent
+        # Oldest first so each segment only references saved segments
+        for constraints in reversed(ancestors):
+            snapshot_id = constraints._snapshot_id()
+            key = f'.constraints_{snapshot_id}'
+            # Other workers may be loading it, never rewrite it
+            if not self.exists(key):
+                f = io.BytesIO()
+                self._serializer.serialize(constraints, f, self._constraints_persistent_id(constraints))
+                self.save_value(key, f.getvalue())
+            self._saved_constraints.add(snapshot_id)
+
+        base = root._parent
+        if base is None:
+            return None
+        base_id = base._snapshot_id()
+
+        def persistent_id(obj):
+            if obj is base:
+                return ('constraints', base_id)
+            if isinstance(obj, Variable) and base._declarations.get(obj.name) is obj:
+                return ('variable', base_id, obj.name)
+            return None
+
+        return persistent_id
+
+    def _save_page(self, page):
+        if page.digest not in self._saved_pages:
+            key = f'.page_{page.digest}'
+            if not self.exists(key):
+                self.save_value(key, bytes(page.data))
+            self._saved_pages.add(page.digest)
+        return page.digest
+
+    def _load_page(self, digest):
+        page = self._loaded_pages.get(digest)
+        if page is None:
+            page = Page(self.load_value(f'.page_{digest}', binary=True), digest)
+            if len(self._loaded_pages) >= self.page_cache_size:
+                del self._loaded_pages[next(iter(self._loaded_pages))]
+            self._loaded_pages[digest] = page
+            self._saved_pages.add(digest)
+        return page
+
+    def _persistent_load(self, pid, pinned):
+        if pid[0] == 'page':
+            return self._load_page(pid[1])
+        return self._constraints_persistent_load(pid, pinned)
+
+    def _constraints_persistent_load(self, pid, pinned):
+        kind, snapshot_id, *name = pid
+        constraints = self._load_constraints(snapshot_id, pinned)
+        if kind == 'variable':
+            return constraints._declarations[name[0]]
+        return constraints
+
+    def _load_constraints(self, snapshot_id, pinned):
+        constraints = self._loaded_constraints.get(snapshot_id)
+        if constraints is None:
+            with self.load_stream(f'.constraints_{snapshot_id}', binary=True) as f:
+                constraints = self._serializer.deserialize(f, lambda pid: self._constraints_persistent_load(pid, pinned))
+            constraints._uid = snapshot_id.split('_', 1)[0]
+            self._loaded_constraints[snapshot_id] = constraints
+            self._saved_constraints.add(snapshot_id)
+        pinned.append(constraints)
+        return constraints
+
+    def remove_unreferenced(self):
+        """
+        Remove the constraint segments and pages that no saved state uses.
+        Must not run while states are being saved.
+        """
+        live = set()
+        keys = self.ls('.*')
+        for key in keys:
+            if not key.startswith('.refs_'):
+                continue
+            if self.exists(key[len('.refs_'):]):
+                live.update(self.load_value(key).split())
+            else:
+                self.rm(key)
+
+        for key in keys:
+            if key.startswith(('.constraints_', '.page_')) and key not in live:
+                self.rm(key)
+        self._saved_constraints = {id_ for id_ in self._saved_constraints if f'.constraints_{id_}' in live}
+        self._saved_pages = {digest for digest in self._saved_pages if f'.page_{digest}' in live}
+
+    def exists(self, key):
+        """
+        :param str key: The key to look for
+        :return: whether a value is saved under `key`
+        """
+        return key in self.ls(key)
+
     def rm(self, key):
         """
         Remove value identified by `key` from storage.
@@ -250,18 +401,42 @@ class FilesystemStore(Store):
                 yield f
 
     @contextmanager
-    def save_stream(self, key, binary=False, lock=False):
+    def save_stream(self, key, binary=False, lock=False, atomic=False):
         """
         Yield a file object representing `key`
 
         :param str key: The file to save to
         :param bool binary: Whether we should treat it as binary
         :param lock: exclusive access if True
+        :param bool atomic: write to a temporary file that replaces `key` when done,
+                            so concurrent readers never see a partial file
         :return:
         """
         mode = 'wb' if binary else 'w'
-        with self.stream(key, mode, lock) as f:
-            yield f
+        if not atomic:
+            with self.stream(key, mode, lock) as f:
+                yield f
+            return
+
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', dir=self.uri)
+        try:
+            with os.fdopen(fd, mode) as f:
+                yield f
+            os.replace(tmp_path, os.path.join(self.uri, key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def save_value(self, key, value):
+        """
+        Save an arbitrary, serializable `value` under `key`. The file is
+        replaced atomically.
+
+        :param str key: A string identifier under which to store the value.
+        :param value: A serializable value
+        """
+        with self.save_stream(key, binary=isinstance(value, bytes), atomic=True) as s:
+            s.write(value)
 
     @contextmanager
     def load_stream(self, key, binary=False, lock=False):
@@ -275,6 +450,9 @@ class FilesystemStore(Store):
         with self.stream(key, mode, lock) as f:
             yield f
 
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.uri, key))
+
     def rm(self, key):
         """
         Remove file identified by `key`.
@@ -318,6 +496,9 @@ class MemoryStore(Store):
     def load_value(self, key, binary=False):
         return self._data.get(key)
 
+    def exists(self, key):
+        return key in self._data
+
     def rm(self, key):
         del self._data[key]
 
@@ -404,6 +585,8 @@ class Workspace:
         self._serializer = PickleSerializer()
         self._prefix = 'state_'
         self._suffix = '.pkl'
+        # Ids handed out by new_state_id() that have no saved state yet
+        self._reserved_ids = set()
 
     @property
     def uri(self):
@@ -441,6 +624,16 @@ class Workspace:
                 f.flush()
         return last_id
 
+    def new_state_id(self):
+        """
+        Reserve a fresh state id without saving a state under it.
+
+        :rtype: int
+        """
+        state_id = self._get_id()
+        self._reserved_ids.add(state_id)
+        return state_id
+
     def load_state(self, state_id, delete=True):
         """
         Load a state from storage identified by `state_id`.
@@ -463,6 +656,8 @@ class Workspace:
         assert isinstance(state, StateBase)
         if state_id is None:
             state_id = self._get_id()
+        elif state_id in self._reserved_ids:
+            self._reserved_ids.remove(state_id)
         else:
             self.rm_state(state_id)
 
@@ -475,8 +670,19 @@ class Workspace:
 
         :param state_id: The state reference of what to load
         """
+        if state_id in self._reserved_ids:
+            # Nothing was saved under it yet
+            self._reserved_ids.remove(state_id)
+            return
         return self._store.rm(f'{self._prefix}{state_id:08x}{self._suffix}')
 
+    def remove_unreferenced(self):
+        """
+        Remove the shared constraints and pages no saved state uses anymore.
+        Must not run while states are being saved.
+        """
+        self._store.remove_unreferenced()
+
 
 class ManticoreOutput:
     """
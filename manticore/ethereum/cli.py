@@ -47,7 +47,7 @@ def choose_detectors(args):
 
 
 def ethereum_main(args, logger):
-    m = ManticoreEVM(workspace_url=args.workspace)
+    m = ManticoreEVM(workspace_url=args.workspace, policy=args.policy)
     with WithKeyboardInterruptAs(m.kill):
 
         if args.verbose_trace:
@@ -35,6 +35,13 @@ class Detector(Plugin):
     def get_findings(self, state):
         return state.context.setdefault('{:s}.findings'.format(self.name), list())
 
+    def owns_context_key(self, key):
+        """
+        Whether the detector keeps its per-state data (findings, locations,
+        ...) under `key` in the state context
+        """
+        return key.startswith('{:s}.'.format(self.name))
+
     @contextmanager
     def locked_global_findings(self):
         with self.manticore.locked_context('{:s}.global_findings'.format(self.name), list) as global_findings:
@@ -603,21 +610,34 @@ class DetectUninitializedMemory(Detector):
     IMPACT = DetectorClassification.MEDIUM
     CONFIDENCE = DetectorClassification.HIGH
 
-    def did_evm_read_memory_callback(self, state, offset, value):
+    def did_evm_read_memory_word_callback(self, state, offset, value, size):
         initialized_memory = state.context.get('{:s}.initialized_memory'.format(self.name), set())
-        cbu = True  # Can be unknown
         current_contract = state.platform.current_vm.address
-        for known_contract, known_offset in initialized_memory:
-            if current_contract == known_contract:
-                cbu = Operators.AND(cbu, offset != known_offset)
-        if state.can_be_true(cbu):
-            self.add_finding_here(state, "Potentially reading uninitialized memory at instruction (address: %r, offset %r)" % (current_contract, offset))
-
-    def did_evm_write_memory_callback(self, state, offset, value):
+        known_offsets = [known_offset for known_contract, known_offset in initialized_memory
+                         if current_contract == known_contract]
+        if not issymbolic(offset) and not any(map(issymbolic, known_offsets)):
+            # Plain lookups, no solver queries
+            known_offsets = set(known_offsets)
+            uninitialized = [offset + i for i in range(size) if offset + i not in known_offsets]
+        else:
+            uninitialized = []
+            for i in range(size):
+                cbu = True  # Can be unknown
+                for known_offset in known_offsets:
+                    cbu = Operators.AND(cbu, offset + i != known_offset)
+                if state.can_be_true(cbu):
+                    uninitialized.append(offset + i)
+
+        for byte_offset in uninitialized:
+            self.add_finding_here(state, "Potentially reading uninitialized memory at instruction (address: %r, offset %r)" % (current_contract, byte_offset))
+
+    def did_evm_write_memory_word_callback(self, state, offset, value, size):
         current_contract = state.platform.current_vm.address
 
         # concrete or symbolic write
-        state.context.setdefault('{:s}.initialized_memory'.format(self.name), set()).add((current_contract, offset))
+        initialized_memory = state.context.setdefault('{:s}.initialized_memory'.format(self.name), set())
+        for i in range(size):
+            initialized_memory.add((current_contract, offset + i))
 
 
 class DetectUninitializedStorage(Detector):
@@ -708,6 +728,9 @@ class DetectRaceCondition(Detector):
 
         return in_function
 
+    def owns_context_key(self, key):
+        return super().owns_context_key(key) or key.startswith(self.TAINT)
+
     def did_evm_write_storage_callback(self, state, storage_address, offset, value):
         world = state.platform
         curr_tx = world.current_transaction
@@ -1,22 +1,22 @@
 import binascii
+import functools
 import json
 import logging
 import string
-from multiprocessing import Queue, Process
-from queue import Empty as EmptyQueue
+from multiprocessing import Pool
 from subprocess import check_output, Popen, PIPE
 from typing import Dict, Optional, Union
 
 import io
 import os
-import pyevmasm as EVMAsm
 import random
 import re
 import sha3
 import tempfile
 
 from ..core.manticore import ManticoreBase
-from ..core.smtlib import ConstraintSet, Array, ArrayProxy, BitVec, Operators, BoolConstant, BoolOperation, Expression
+from ..core.smtlib import ConstraintSet, Array, ArrayProxy, BitVec, Operators, BoolConstant, BoolOperation, Expression, Constant, simplify
+from ..core.smtlib.visitors import replace
 from ..core.state import TerminateState, AbandonState
 from .account import EVMContract, EVMAccount, ABI
 from .detectors import Detector
@@ -31,6 +31,9 @@ logger = logging.getLogger(__name__)
 
 cfg = config.get_group('evm')
 cfg.add('defaultgas', 3000000, 'Default gas value for ethereum transactions.')
+cfg.add('merge_states', False, 'Merge the states that end a human transaction with the same world state, taints and detectors state. Their path conditions are joined in a disjunction.')
+cfg.add('skip_duplicate_states', False, 'Do not run further transactions on a state whose world state, taints and detectors state, up to renaming of the variables, was already reached by another state.')
+cfg.add('finalize_worker_states', 256, 'Testcases generated by each finalize worker process before it is replaced by a fresh one.')
 
 
 def flagged(flag):
@@ -57,8 +60,8 @@ def write_findings(method, lead_space, address, pc, at_init=""):
 def calculate_coverage(runtime_bytecode, seen):
     """ Calculates what percentage of runtime_bytecode has been seen """
     count, total = 0, 0
-    bytecode = SolidityMetadata._without_metadata(runtime_bytecode)
-    for i in EVMAsm.disassemble_all(bytecode):
+    bytecode = SolidityMetadata._without_metadata(bytes(runtime_bytecode))
+    for i in evm.CodeAnalysis.get(bytecode).instructions:
         if i.pc in seen:
             count += 1
         total += 1
@@ -69,6 +72,84 @@ def calculate_coverage(runtime_bytecode, seen):
     return count * 100.0 / total
 
 
+#: The ManticoreEVM finalized by a finalize worker process
+_finalizing = None
+
+
+def _init_finalize_worker(manticore):
+    global _finalizing
+    _finalizing = manticore
+
+
+def _finalize_state(state_id):
+    try:
+        _finalizing._finalize_state(state_id)
+    except Exception:
+        logger.exception("Error generating testcase for state_id %d", state_id)
+    return state_id
+
+
+class KnownSha3:
+    """
+    Index of the concrete SHA3 (data, hash) pairs seen so far, bucketed by
+    data length.
+
+    Every worker keeps its own index and brings it up to date from a shared
+    append-only log of pairs, so the shared context lock is only held while
+    reading or appending the new pairs.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._count = 0
+        self._synced = 0
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for bucket in self._buckets.values():
+            yield from bucket.items()
+
+    def _add(self, data, value):
+        data = bytes(data)
+        bucket = self._buckets.setdefault(len(data), {})
+        if data in bucket:
+            return False
+        bucket[data] = value
+        self._count += 1
+        return True
+
+    def sync(self, shared_log):
+        """ Add the pairs appended to the shared log since the last sync """
+        for data, value in shared_log[self._synced:]:
+            self._add(data, value)
+        self._synced = len(shared_log)
+
+    def add(self, shared_log, data, value):
+        """ Add a pair to the index and to the shared log if it is new """
+        self.sync(shared_log)
+        if self._add(data, value):
+            shared_log.append((data, value))
+            self._synced += 1
+
+    def candidates(self, data):
+        """
+        The known pairs whose data can be equal to the symbolic buffer `data`:
+        same length and matching its concrete bytes
+        """
+        bucket = self._buckets.get(len(data))
+        if not bucket:
+            return []
+        concrete = []
+        for i in range(len(data)):
+            byte = simplify(data[i])
+            if isinstance(byte, Constant):
+                concrete.append((i, byte.value))
+        return [(key, value) for key, value in bucket.items()
+                if all(key[i] == byte for i, byte in concrete)]
+
+
 class ManticoreEVM(ManticoreBase):
     """ Manticore EVM manager
 
@@ -393,9 +474,9 @@ class ManticoreEVM(ManticoreBase):
         self.metadata: Dict[int, SolidityMetadata] = {}
 
         # The following should go to manticore.context so we can use multiprocessing
+        self._known_sha3 = KnownSha3()
         with self.locked_context('ethereum', dict) as context:
             context['_sha3_states'] = dict()
-            context['_known_sha3'] = set()
 
     @property
     def world(self):
@@ -1098,73 +1179,159 @@ class ManticoreEVM(ManticoreBase):
         # 'ethereum.saved_states'
         # Move successfully terminated states to ready states
         with self.locked_context('ethereum.saved_states', list) as saved_states:
+            state_ids = []
             while saved_states:
-                state_id = saved_states.pop()
+                state_ids.append(saved_states.pop())
+
+        if cfg.merge_states:
+            state_ids = self._merge_states(state_ids)
+
+        with self._lock:
+            for state_id in state_ids:
                 self._terminated_states.remove(state_id)
-                self._ready_states.append(state_id)
+                self._add_ready(state_id)
+
+    @staticmethod
+    def _merge_constraints(constraint_sets):
+        """
+        Returns a ConstraintSet satisfied by the models of any of
+        constraint_sets: the constraints common to all of them and the
+        disjunction of the rest. Variables are matched by name and the
+        constraints are rewritten over the variables of the first set. None if
+        they declare different variables under the same name.
+        """
+        merged = ConstraintSet()
+        all_constraints = []
+        for constraints in constraint_sets:
+            bindings = {}
+            for var in constraints.get_declared_variables():
+                declared = merged.get_variable(var.name)
+                if declared is None:
+                    merged._declare(var)
+                elif declared is not var:
+                    if declared.declaration != var.declaration:
+                        return None
+                    bindings[var] = declared
+            all_constraints.append([replace(constraint, bindings) for constraint in constraints.constraints])
+
+        common = set(all_constraints[0]).intersection(*all_constraints[1:])
+        for constraint in all_constraints[0]:
+            if constraint in common:
+                merged.add(constraint)
+
+        paths = []
+        for constraints in all_constraints:
+            path = [constraint for constraint in constraints if constraint not in common]
+            if not path:
+                # One of the paths is implied by the common constraints
+                return merged
+            paths.append(functools.reduce(Operators.AND, path))
+        merged.add(functools.reduce(Operators.OR, paths))
+        return merged
+
+    def _detectors_context(self, state):
+        """
+        The (key, value) entries of the state context kept by the registered
+        detectors, sorted by key. Empty entries are left out.
+        """
+        detectors = list(self.detectors.values())
+        return [(key, value) for key, value in sorted(state.context.items())
+                if value and any(detector.owns_context_key(key) for detector in detectors)]
+
+    def _merge_states(self, state_ids):
+        """
+        Merge the terminated states that have the same world state and the
+        same detectors state. The first state of each group keeps the joined
+        path condition and the others are removed. Returns the ids of the
+        states left.
+        """
+        groups = {}
+        for state_id in state_ids:
+            state = self._load(state_id)
+            fingerprint = state.platform.fingerprint(self._detectors_context(state))
+            groups.setdefault(fingerprint, []).append(state_id)
+
+        result = []
+        for group in groups.values():
+            result.append(group[0])
+            if len(group) == 1:
+                continue
+            states = [self._load(state_id) for state_id in group]
+            constraints = self._merge_constraints([state.constraints for state in states])
+            if constraints is None:
+                result.extend(group[1:])
+                continue
+            states[0].constraints = constraints
+            self._save(states[0], state_id=group[0])
+            with self._lock:
+                for state_id in group[1:]:
+                    self._terminated_states.remove(state_id)
+                    self._remove(state_id)
+            logger.info("Merged %d states with the same world state into state %d", len(group), group[0])
+        return result
 
     # Callbacks
     def _on_symbolic_sha3_callback(self, state, data, known_hashes):
         """ INTERNAL USE """
         assert issymbolic(data), 'Data should be symbolic here!'
-        with self.locked_context('ethereum') as context:
-            known_sha3 = context.get('_known_sha3', None)
-            if known_sha3 is None:
-                known_sha3 = set()
-
-            sha3_states = context.get('_sha3_states', [])
-            results = []
-            # If know_hashes is true then there is a _known_ solution for the hash
-            known_hashes_cond = False
-            for key, value in known_sha3:
-                assert not issymbolic(key), "Saved sha3 data,hash pairs should be concrete"
-                cond = key == data
-                #TODO consider disabling this solver query.
-                if not state.can_be_true(cond):
-                    continue
-                results.append((key, value))
-                known_hashes_cond = Operators.OR(cond, known_hashes_cond)
-
-            # adding a single random example so we can explore further
-            if not results or state.can_be_true(known_hashes_cond == False):
-                with state as temp:
-                    temp.constrain(known_hashes_cond == False)
-                    data_concrete = temp.solve_one(data)
-                #data_concrete = state.solve_one(data)
-                data_hash = int(sha3.keccak_256(data_concrete).hexdigest(), 16)
-                results.append((data_concrete, data_hash))
-                known_hashes_cond = Operators.OR(data_concrete == data, known_hashes_cond)
-                known_sha3.add((data_concrete, data_hash))
-
-            not_known_hashes_cond = Operators.NOT(known_hashes_cond)
-
-            # We need to fork/save the state
-            #################################
-            # save the state to secondary storage
-            # Build and enqueue a state for each solution
-            with state as temp_state:
-                if temp_state.can_be_true(not_known_hashes_cond):
-                    temp_state.constrain(not_known_hashes_cond)
-                    state_id = self._workspace.save_state(temp_state)
-                    sha3_states[state_id] = [hsh for buf, hsh in known_sha3]
-            context['_sha3_states'] = sha3_states
-            context['_known_sha3'] = known_sha3
-
-            if not state.can_be_true(known_hashes_cond):
-                raise TerminateState("There is no matching sha3 pair, bailing out")
-            state.constrain(known_hashes_cond)
-
-            #send known hashes to evm
-            known_hashes.update(results)
+        with self.locked_context('ethereum.known_sha3', list) as known_sha3:
+            self._known_sha3.sync(known_sha3)
+            candidates = self._known_sha3.candidates(data)
+
+        # The known data are different concrete buffers so at most one of them
+        # is equal to data. One query enumerates the feasible ones, and
+        # len(candidates) if data may be none of them.
+        conds = [key == data for key, value in candidates]
+        selector = len(candidates)
+        for index in reversed(range(len(candidates))):
+            selector = Operators.ITEBV(256, conds[index], index, selector)
+        feasible = state.solve_n(selector, len(candidates) + 1)
+
+        results = []
+        # If know_hashes is true then there is a _known_ solution for the hash
+        known_hashes_cond = False
+        for index in sorted(feasible):
+            if index < len(candidates):
+                results.append(candidates[index])
+                known_hashes_cond = Operators.OR(conds[index], known_hashes_cond)
+
+        # adding a single random example so we can explore further
+        if len(candidates) in feasible:
+            with state as temp:
+                temp.constrain(known_hashes_cond == False)
+                data_concrete = temp.solve_one(data)
+            data_hash = int(sha3.keccak_256(data_concrete).hexdigest(), 16)
+            results.append((data_concrete, data_hash))
+            known_hashes_cond = Operators.OR(data_concrete == data, known_hashes_cond)
+            with self.locked_context('ethereum.known_sha3', list) as known_sha3:
+                self._known_sha3.add(known_sha3, data_concrete, data_hash)
+
+        not_known_hashes_cond = Operators.NOT(known_hashes_cond)
+
+        # We need to fork/save the state
+        #################################
+        # save the state to secondary storage
+        # Build and enqueue a state for each solution
+        with state as temp_state:
+            if temp_state.can_be_true(not_known_hashes_cond):
+                temp_state.constrain(not_known_hashes_cond)
+                state_id = self._workspace.save_state(temp_state)
+                with self.locked_context('ethereum', dict) as context:
+                    sha3_states = context.get('_sha3_states', {})
+                    sha3_states[state_id] = [hsh for buf, hsh in self._known_sha3]
+                    context['_sha3_states'] = sha3_states
+
+        if not results:
+            raise TerminateState("There is no matching sha3 pair, bailing out")
+        state.constrain(known_hashes_cond)
+
+        #send known hashes to evm
+        known_hashes.update(results)
 
     def _on_concrete_sha3_callback(self, state, buf, value):
         """ INTERNAL USE """
-        with self.locked_context('ethereum', dict) as ethereum_context:
-            known_sha3 = ethereum_context.get('_known_sha3', None)
-            if known_sha3 is None:
-                known_sha3 = set()
-            known_sha3.add((buf, value))
-            ethereum_context['_known_sha3'] = known_sha3
+        with self.locked_context('ethereum.known_sha3', list) as known_sha3:
+            self._known_sha3.add(known_sha3, buf, value)
 
     def _terminate_state_callback(self, state, e):
         """ INTERNAL USE
@@ -1203,6 +1370,14 @@ class ManticoreEVM(ManticoreBase):
         if tx.result in {'SELFDESTRUCT', 'REVERT', 'THROW', 'TXERROR'}:
             pass
         elif tx.result in {'RETURN', 'STOP'}:
+            if cfg.skip_duplicate_states:
+                world_hash = world.world_hash(self._detectors_context(state))
+                with self.locked_context('ethereum.world_hashes', dict) as world_hashes:
+                    first = world_hashes.setdefault(world_hash, state.id)
+                if first != state.id:
+                    logger.debug("State %d reached the world state of state %d. Not saving it for further transactions", state.id, first)
+                    return
+
             # if not a revert, we save the state for further transactions
             with self.locked_context('ethereum.saved_states', list) as saved_states:
                 saved_states.append(state.id)
@@ -1349,53 +1524,55 @@ class ManticoreEVM(ManticoreBase):
                         findings.write(src.replace('\n', '\n    ').strip())
                         findings.write('\n')
 
-        with testcase.open_stream('summary') as stream:
-            is_something_symbolic = state.platform.dump(stream, state, self, message)
+        # Every value reported below is pinned as soon as it is solved, so the
+        # summary, the transactions and the logs all describe the same model.
+        with state as temp_state:
+            with testcase.open_stream('summary') as stream:
+                is_something_symbolic = temp_state.platform.dump(stream, temp_state, self, message)
 
-            with self.locked_context('ethereum') as context:
-                known_sha3 = context.get('_known_sha3', None)
-                if known_sha3:
-                    stream.write("Known hashes:\n")
-                    for key, value in known_sha3:
-                        stream.write('%s::%x\n' % (binascii.hexlify(key), value))
+                with self.locked_context('ethereum.known_sha3', list) as known_sha3:
+                    if known_sha3:
+                        stream.write("Known hashes:\n")
+                        for key, value in known_sha3:
+                            stream.write('%s::%x\n' % (binascii.hexlify(key), value))
 
-            if is_something_symbolic:
-                stream.write('\n\n(*) Example solution given. Value is symbolic and may take other values\n')
-
-        # Transactions
+                if is_something_symbolic:
+                    stream.write('\n\n(*) Example solution given. Value is symbolic and may take other values\n')
 
-        with testcase.open_stream('tx') as tx_summary:
-            with testcase.open_stream('tx.json') as txjson:
-                txlist = []
-                is_something_symbolic = False
+            # Transactions
 
-                for sym_tx in blockchain.human_transactions:  # external transactions
-                    tx_summary.write("Transactions No. %d\n" % blockchain.transactions.index(sym_tx))
+            with testcase.open_stream('tx') as tx_summary:
+                with testcase.open_stream('tx.json') as txjson:
+                    txlist = []
+                    is_something_symbolic = False
 
-                    conc_tx = sym_tx.concretize(state)
-                    txlist.append(conc_tx.to_dict(self))
+                    for sym_tx in blockchain.human_transactions:  # external transactions
+                        tx_summary.write("Transactions No. %d\n" % blockchain.transactions.index(sym_tx))
 
-                    is_something_symbolic = sym_tx.dump(tx_summary, state, self, conc_tx=conc_tx)
+                        conc_tx = sym_tx.concretize(temp_state, constrain=True)
+                        txlist.append(conc_tx.to_dict(self))
 
-                if is_something_symbolic:
-                    tx_summary.write('\n\n(*) Example solution given. Value is symbolic and may take other values\n')
+                        is_something_symbolic = sym_tx.dump(tx_summary, temp_state, self, conc_tx=conc_tx)
 
-                json.dump(txlist, txjson)
+                    if is_something_symbolic:
+                        tx_summary.write('\n\n(*) Example solution given. Value is symbolic and may take other values\n')
 
-        # logs
-        with testcase.open_stream('logs') as logs_summary:
-            is_something_symbolic = False
-            for log_item in blockchain.logs:
-                is_log_symbolic = issymbolic(log_item.memlog)
-                is_something_symbolic = is_log_symbolic or is_something_symbolic
-                solved_memlog = state.solve_one(log_item.memlog)
-                printable_bytes = ''.join([c for c in map(chr, solved_memlog) if c in string.printable])
+                    json.dump(txlist, txjson)
 
-                logs_summary.write("Address: %x\n" % log_item.address)
-                logs_summary.write("Memlog: %s (%s) %s\n" % (binascii.hexlify(solved_memlog).decode(), printable_bytes, flagged(is_log_symbolic)))
-                logs_summary.write("Topics:\n")
-                for i, topic in enumerate(log_item.topics):
-                    logs_summary.write("\t%d) %x %s" % (i, state.solve_one(topic), flagged(issymbolic(topic))))
+            # logs
+            with testcase.open_stream('logs') as logs_summary:
+                is_something_symbolic = False
+                for log_item in blockchain.logs:
+                    is_log_symbolic = issymbolic(log_item.memlog)
+                    is_something_symbolic = is_log_symbolic or is_something_symbolic
+                    solved_memlog = temp_state.solve_one(log_item.memlog, constrain=True)
+                    printable_bytes = ''.join([c for c in map(chr, solved_memlog) if c in string.printable])
+
+                    logs_summary.write("Address: %x\n" % log_item.address)
+                    logs_summary.write("Memlog: %s (%s) %s\n" % (binascii.hexlify(solved_memlog).decode(), printable_bytes, flagged(is_log_symbolic)))
+                    logs_summary.write("Topics:\n")
+                    for i, topic in enumerate(log_item.topics):
+                        logs_summary.write("\t%d) %x %s" % (i, temp_state.solve_one(topic, constrain=True), flagged(issymbolic(topic))))
 
         with testcase.open_stream('constraints') as smt_summary:
             smt_summary.write(str(state.constraints))
@@ -1428,43 +1605,36 @@ class ManticoreEVM(ManticoreBase):
                     global_findings.add((address, pc, finding, at_init))
         return global_findings
 
+    def _finalize_state(self, state_id):
+        st = self._load(state_id)
+        logger.debug("Generating testcase for state_id %d", state_id)
+        last_tx = st.platform.last_transaction
+        message = last_tx.result if last_tx else 'NO STATE RESULT (?)'
+        self.generate_testcase(st, message=message)
+
     @ManticoreBase.at_not_running
-    def finalize(self, procs=10):
+    def finalize(self, procs=None):
         """
         Terminate and generate testcases for all currently alive states (contract
         states that cleanly executed to a STOP or RETURN in the last symbolic
         transaction).
 
-        :param procs: nomber of local processes to use in the reporting generation
+        :param procs: number of local processes to use in the reporting generation.
+                      Defaults to the number of CPUs
         """
-
-        logger.debug("Finalizing %d states.", self.count_states())
-
-        def finalizer(state_id):
-            st = self._load(state_id)
-            logger.debug("Generating testcase for state_id %d", state_id)
-            last_tx = st.platform.last_transaction
-            message = last_tx.result if last_tx else 'NO STATE RESULT (?)'
-            self.generate_testcase(st, message=message)
-
-        def worker_finalize(q):
-            try:
-                while True:
-                    finalizer(q.get_nowait())
-            except EmptyQueue:
-                pass
-
-        q = Queue()
-        for state_id in self._all_states:
-            #we need to remove -1 state before forking because it may be in memory
-            q.put(state_id)
-
-        report_workers = [Process(target=worker_finalize, args=(q,)) for _ in range(procs)]
-        for proc in report_workers:
-            proc.start()
-
-        for proc in report_workers:
-            proc.join()
+        state_ids = self._all_states
+        logger.debug("Finalizing %d states.", len(state_ids))
+
+        # States are streamed to a pool of forked workers. Each worker is
+        # replaced after some testcases so its memory stays bounded
+        if state_ids:
+            procs = min(procs or os.cpu_count() or 1, len(state_ids))
+            with Pool(procs, initializer=_init_finalize_worker, initargs=(self,),
+                      maxtasksperchild=cfg.finalize_worker_states) as pool:
+                step = max(1, len(state_ids) // 10)
+                for done, _ in enumerate(pool.imap_unordered(_finalize_state, state_ids), 1):
+                    if done % step == 0 or done == len(state_ids):
+                        logger.info("Generated testcases for %d/%d states", done, len(state_ids))
 
         # global summary
         with self._output.save_stream('global.findings') as global_findings_stream:
@@ -1501,9 +1671,10 @@ class ManticoreEVM(ManticoreBase):
 
             with self._output.save_stream('global_%s.runtime_asm' % md.name) as global_runtime_asm, self.locked_context('runtime_coverage') as seen:
 
+                seen = set(seen)
                 runtime_bytecode = md.runtime_bytecode
                 count, total = 0, 0
-                for i in EVMAsm.disassemble_all(runtime_bytecode):
+                for i in evm.CodeAnalysis.get(bytes(runtime_bytecode)).instructions:
                     if (address, i.pc) in seen:
                         count += 1
                         global_runtime_asm.write('*')
@@ -1514,8 +1685,9 @@ class ManticoreEVM(ManticoreBase):
                     total += 1
 
             with self._output.save_stream('global_%s.init_asm' % md.name) as global_init_asm, self.locked_context('init_coverage') as seen:
+                seen = set(seen)
                 count, total = 0, 0
-                for i in EVMAsm.disassemble_all(md.init_bytecode):
+                for i in evm.CodeAnalysis.get(bytes(md.init_bytecode)).instructions:
                     if (address, i.pc) in seen:
                         count += 1
                         global_init_asm.write('*')
@@ -1546,16 +1718,20 @@ class ManticoreEVM(ManticoreBase):
             states.
         """
         account_address = int(account)
-        runtime_bytecode = None
-        #Search one state in which the account_address exists
-        for state in self.all_states:
-            world = state.platform
-            if account_address in world:
-                code = world.get_code(account_address)
-                runtime_bytecode = state.solve_one(code)
-                break
+        md = self.get_metadata(account_address)
+        if md is not None:
+            runtime_bytecode = md.runtime_bytecode
         else:
-            return 0.0
+            #Search one state in which the account_address exists
+            for state_id in self._all_states:
+                state = self._load(state_id)
+                world = state.platform
+                if account_address in world:
+                    code = world.get_code(account_address)
+                    runtime_bytecode = state.solve_one(code)
+                    break
+            else:
+                return 0.0
         with self.locked_context('evm.coverage') as coverage:
             seen = {off for addr, off, init in coverage if addr == account_address and not init}
         return calculate_coverage(runtime_bytecode, seen)
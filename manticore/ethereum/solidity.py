@@ -1,4 +1,7 @@
 
+import bisect
+import struct
+from collections.abc import Mapping as MappingABC
 from typing import Any, Dict, Mapping, Optional, Sequence, Iterable, Tuple
 import pyevmasm as EVMAsm
 
@@ -6,6 +9,57 @@ from .abi import ABI
 from ..utils.deprecated import deprecated
 
 
+class SourceMap(MappingABC):
+    """
+    Read only mapping from bytecode offset to the (byte offset, length, file
+    index, jump type) of its source range.
+
+    Entries are fixed size records in a single buffer indexed by bytecode
+    offset, so lookups are O(1) and the map pickles as one bytes object
+    instead of a dict of tuples. Records also keep the source line where the
+    range begins.
+    """
+    _record = struct.Struct('<iiiiB')  # begin, length, file index, line, jump type code
+    _jump_types = (None, 'i', 'o', '-')  # jump type code - 1, 0 marks offsets without an entry
+
+    def __init__(self, entries, source_code=''):
+        newlines = [i for i, c in enumerate(source_code) if c == '\n']
+        size = max(entries) + 1 if entries else 0
+        data = bytearray(size * self._record.size)
+        for offset, (begin, length, file_index, jump_type) in entries.items():
+            line = bisect.bisect_left(newlines, begin) + 1
+            self._record.pack_into(data, offset * self._record.size, begin, length, file_index, line,
+                                   self._jump_types.index(jump_type) + 1)
+        self._data = bytes(data)
+        self._size = size
+        self._count = len(entries)
+
+    def _unpack(self, offset):
+        if not isinstance(offset, int) or not 0 <= offset < self._size:
+            raise KeyError(offset)
+        *fields, jump = self._record.unpack_from(self._data, offset * self._record.size)
+        if not jump:
+            raise KeyError(offset)
+        return fields, self._jump_types[jump - 1]
+
+    def __getitem__(self, offset):
+        (begin, length, file_index, _), jump_type = self._unpack(offset)
+        return begin, length, file_index, jump_type
+
+    def line(self, offset):
+        """ Line of the source where the range of bytecode offset begins """
+        (_, _, _, line), _ = self._unpack(offset)
+        return line
+
+    def __iter__(self):
+        for offset in range(self._size):
+            if self._data[offset * self._record.size + self._record.size - 1]:
+                yield offset
+
+    def __len__(self):
+        return self._count
+
+
 class SolidityMetadata:
 
     @staticmethod
@@ -115,7 +169,7 @@ class SolidityMetadata:
 
                 new_srcmap[pos_to_offset[asm_pos]] = (byte_offset, source_len, file_index, jump_type)
 
-        return new_srcmap
+        return SourceMap(new_srcmap, self.source_code or '')
 
     @property
     def runtime_bytecode(self):
@@ -140,7 +194,7 @@ class SolidityMetadata:
             return ''
 
         output = ''
-        nl = self.source_code[:beg].count('\n') + 1
+        nl = srcmap.line(asm_offset)
         snippet = self.source_code[beg:beg + size]
         for l in snippet.split('\n'):
             output += '    %s  %s\n' % (nl, l)
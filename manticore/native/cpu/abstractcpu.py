@@ -481,6 +481,8 @@ class Cpu(Eventful):
         self._regfile = regfile
         self._memory = memory
         self._instruction_cache = {}
+        # Pages holding the instructions in _instruction_cache
+        self._instruction_pages = set()
         self._icount = 0
         self._last_pc = None
         self._concrete = kwargs.pop("concrete", False)
@@ -633,11 +635,41 @@ class Cpu(Eventful):
         assert size in SANE_SIZES
         self._publish('will_write_memory', where, expression, size)
 
-        data = [Operators.CHR(Operators.EXTRACT(expression, offset, 8)) for offset in range(0, size, 8)]
+        if issymbolic(expression):
+            data = [Operators.CHR(Operators.EXTRACT(expression, offset, 8)) for offset in range(0, size, 8)]
+        else:
+            data = (expression & ((1 << size) - 1)).to_bytes(size // 8, 'little')
         self._memory.write(where, data, force)
 
         self._publish('did_write_memory', where, expression, size)
 
+    def _invalidate_instructions(self, where, size):
+        """
+        Drops the decoded instructions overlapping the `size` bytes changed
+        at `where`. Memory calls it on every write, unmap and protection
+        change. Only the pages instructions were decoded from are looked at.
+        """
+        if not self._instruction_cache:
+            return
+        if issymbolic(where):
+            self._instruction_cache.clear()
+            self._instruction_pages.clear()
+            return
+        first, last = self.memory._page(where), self.memory._page(where + size - 1)
+        if last - first < len(self._instruction_pages):
+            if self._instruction_pages.isdisjoint(range(first, last + 1)):
+                return
+        elif not any(first <= page <= last for page in self._instruction_pages):
+            return
+        start, end = where - self.max_instr_width + 1, where + size
+        if end - start > len(self._instruction_cache):
+            # Large ranges (e.g. munmap) go over the cache instead
+            for pc in [pc for pc in self._instruction_cache if start <= pc < end]:
+                del self._instruction_cache[pc]
+        else:
+            for pc in range(start, end):
+                self._instruction_cache.pop(pc, None)
+
     def _raw_read(self, where: int, size=1) -> bytes:
         """
         Selects bytes from memory. Attempts to do so faster than via read_bytes.
@@ -665,7 +697,7 @@ class Cpu(Eventful):
                 data += map._overlay[offset]
             data += raw_data[len(data):]
 
-        elif mapType is AnonMap:
+        elif mapType is AnonMap and not map._overlay:
             data = bytes(map._data[start:start + size])
         else:
             data = b''.join(self.memory[where:where + size])
@@ -687,9 +719,13 @@ class Cpu(Eventful):
         assert size in SANE_SIZES
         self._publish('will_read_memory', where, size)
 
-        data = self._memory.read(where, size // 8, force)
-        assert (8 * len(data)) == size
-        value = Operators.CONCAT(size, *map(Operators.ORD, reversed(data)))
+        data = self._memory.read_raw(where, size // 8, force)
+        if data is not None:
+            value = int.from_bytes(data, 'little')
+        else:
+            data = self._memory.read(where, size // 8, force)
+            assert (8 * len(data)) == size
+            value = Operators.CONCAT(size, *map(Operators.ORD, reversed(data)))
 
         self._publish('did_read_memory', where, value, size)
         return value
@@ -703,28 +739,23 @@ class Cpu(Eventful):
         :type data: str or list
         :param force: whether to ignore memory permissions
         """
-
-        mp = self.memory.map_containing(where)
-        # TODO (ehennenfent) - fast write can have some yet-unstudied unintended side effects.
-        # At the very least, using it in non-concrete mode will break the symbolic strcmp/strlen models. The 1024 byte
-        # minimum is intended to minimize the potential effects of this by ensuring that if there _are_ any other
-        # issues, they'll only crop up when we're doing very large writes, which are fairly uncommon.
-        can_write_raw = type(mp) is AnonMap and \
-            isinstance(data, (str, bytes)) and \
-            (mp.end - mp.start + 1) >= len(data) >= 1024 and \
-            not issymbolic(data) and \
-            self._concrete
-
-        if can_write_raw:
-            logger.debug("Using fast write")
-            offset = mp._get_offset(where)
-            if isinstance(data, str):
-                data = bytes(data.encode('utf-8'))
-            mp._data[offset:offset + len(data)] = data
-            self._publish('did_write_memory', where, data, 8 * len(data))
+        if not len(data):
+            return
+        if isinstance(data, (bytes, bytearray)):
+            raw = bytes(data)
+        elif not any(issymbolic(c) for c in data):
+            raw = bytes(Operators.ORD(c) & 0xff for c in data)
         else:
+            raw = None
+
+        # Concrete data is written at once unless someone listens to the per
+        # byte events, which must interleave with the writes
+        if raw is None or self._has_subscribers('will_write_memory') or self._has_subscribers('did_write_memory'):
             for i in range(len(data)):
                 self.write_int(where + i, Operators.ORD(data[i]), 8, force)
+            return
+
+        self._memory.write(where, raw, force)
 
     def read_bytes(self, where, size, force=False):
         """
@@ -736,10 +767,20 @@ class Cpu(Eventful):
         :return: data
         :rtype: list[int or Expression]
         """
-        result = []
-        for i in range(size):
-            result.append(Operators.CHR(self.read_int(where + i, 8, force)))
-        return result
+        raw = self._memory.read_raw(where, size, force) if size else b''
+        if raw is None:
+            result = []
+            for i in range(size):
+                result.append(Operators.CHR(self.read_int(where + i, 8, force)))
+            return result
+
+        # Concrete data is read at once. The per byte events are only built
+        # for their subscribers
+        if self._has_subscribers('will_read_memory') or self._has_subscribers('did_read_memory'):
+            for i, value in enumerate(raw):
+                self._publish('will_read_memory', where + i, 8)
+                self._publish('did_read_memory', where + i, value, 8)
+        return [bytes([value]) for value in raw]
 
     def write_string(self, where, string, max_length=None, force=False):
         """
@@ -841,20 +882,14 @@ class Cpu(Eventful):
         """
         raise NotImplementedError
 
-    def decode_instruction(self, pc):
+    def _read_instruction_bytes(self, pc):
         """
-        This will decode an instruction from memory pointed by `pc`
+        Reads up to `max_instr_width` executable bytes at `pc` one at a time,
+        concretizing the symbolic ones.
 
         :param int pc: address of the instruction
         """
-        # No dynamic code!!! #TODO!
-        # Check if instruction was already decoded
-        if pc in self._instruction_cache:
-            return self._instruction_cache[pc]
-
         text = b''
-
-        # Read Instruction from memory
         for address in range(pc, pc + self.max_instr_width):
             # This reads a byte from memory ignoring permissions
             # and concretize it if symbolic
@@ -880,6 +915,25 @@ class Cpu(Eventful):
                                            size=8 * self.max_instr_width,
                                            policy='INSTRUCTION')
             text += c
+        return text
+
+    def decode_instruction(self, pc):
+        """
+        This will decode an instruction from memory pointed by `pc`
+
+        :param int pc: address of the instruction
+        """
+        # Check if instruction was already decoded. Writes to the code drop
+        # the instructions they overlap
+        if pc in self._instruction_cache:
+            return self._instruction_cache[pc]
+
+        # Read Instruction from memory, at once if it is concrete
+        text = None
+        if self.memory.access_ok(slice(pc, pc + self.max_instr_width), 'x'):
+            text = self.memory.read_raw(pc, self.max_instr_width, force=True)
+        if text is None:
+            text = self._read_instruction_bytes(pc)
 
         # Pad potentially incomplete instruction with zeroes
         code = text.ljust(self.max_instr_width, b'\x00')
@@ -897,6 +951,7 @@ class Cpu(Eventful):
 
         insn.operands = self._wrap_operands(insn.operands)
         self._instruction_cache[pc] = insn
+        self._instruction_pages.update((self.memory._page(pc), self.memory._page(pc + insn.size - 1)))
         return insn
 
     @property
@@ -1,4 +1,5 @@
 from abc import abstractmethod
+from collections import OrderedDict
 
 import capstone as cs
 
@@ -59,6 +60,13 @@ class Disasm:
 
 
 class CapstoneDisasm(Disasm):
+    #: Instructions decoded by any instance, by (arch, mode, pc, code). The
+    #: code bytes are part of the key so rewritten code is decoded again.
+    #: Least recently used first.
+    _decoded = OrderedDict()
+    #: Maximum number of instructions kept in `_decoded`
+    cache_size = 0x10000
+
     def __init__(self, arch, mode):
         try:
             cap = cs.Cs(arch, mode)
@@ -74,7 +82,20 @@ class CapstoneDisasm(Disasm):
         :param str code: binary blob to be disassembled
         :param long pc: program counter
         """
-        return next(self.disasm.disasm(code, pc))
+        key = (self.disasm.arch, self.disasm.mode, pc, code)
+        insn = self._decoded.get(key)
+        if insn is None:
+            insn = next(self.disasm.disasm(code, pc))
+            self._decoded[key] = insn
+            if len(self._decoded) > self.cache_size:
+                self._decoded.popitem(last=False)
+        else:
+            self._decoded.move_to_end(key)
+        # Callers wrap the operands of the instruction they get, so hand out
+        # a shallow copy and keep the cached one untouched
+        copy = object.__new__(type(insn))
+        copy.__dict__.update(insn.__dict__)
+        return copy
 
 
 def init_disassembler(disassembler, arch, mode, view=None):
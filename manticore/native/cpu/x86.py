@@ -451,6 +451,8 @@ class AMD64RegFile(RegisterFile):
             self._registers[reg] = 0
 
         self._cache = {}
+        # Flags not computed yet, by name. See `write_lazy_flags`
+        self._lazy_flags = {}
         for name in ('AF', 'CF', 'DF', 'IF', 'OF', 'PF', 'SF', 'ZF'):
             self.write(name, False)
 
@@ -553,10 +555,77 @@ class AMD64RegFile(RegisterFile):
         for flag, offset in self._flags.items():
             self.write(flag, Operators.EXTRACT(res, offset, 1))
 
+    @staticmethod
+    def parity_flag(res):
+        """ PF for the result `res`: set if its least significant byte has an even number of bits set """
+        return (res ^ res >> 1 ^ res >> 2 ^ res >> 3 ^ res >> 4 ^ res >> 5 ^ res >> 6 ^ res >> 7) & 1 == 0
+
+    def write_lazy_flags(self, flags, operation, size, res, *operands):
+        """
+        Records the arithmetic or logic operation that sets `flags` instead of
+        computing them. Each flag is built from the record the first time it
+        is read, and most of them are overwritten before that.
+
+        :param flags: names of the flags set by the operation
+        :param str operation: one of 'ADD', 'SUB', 'INC', 'DEC' or 'LOGIC'
+        :param int size: size in bits of the operation
+        :param res: result of the operation
+        :param operands: operands of the operation (and the carry in for 'ADD')
+        """
+        record = (operation, size, res, operands)
+        for flag in flags:
+            self._lazy_flags[flag] = record
+            self._cache.pop(flag, None)
+        self._cache.pop('EFLAGS', None)
+        self._cache.pop('RFLAGS', None)
+
+    def _materialize_flag(self, flag):
+        """ Computes a lazy flag from its record, see `write_lazy_flags` """
+        operation, size, res, operands = self._lazy_flags[flag]
+        sign_mask = 1 << (size - 1)
+        if flag == 'ZF':
+            value = res == 0
+        elif flag == 'SF':
+            value = (res & sign_mask) != 0
+        elif flag == 'PF':
+            value = self.parity_flag(res)
+        elif operation == 'LOGIC':
+            # CF, AF and OF are cleared
+            value = False
+        elif flag == 'AF':
+            arg0, arg1 = operands[:2]
+            value = ((arg0 ^ arg1) ^ res) & 0x10 != 0
+        elif operation in ('INC', 'DEC'):
+            assert flag == 'OF'
+            value = res == sign_mask
+        elif operation == 'SUB':
+            arg0, arg1 = operands
+            if flag == 'CF':
+                value = Operators.ULT(arg0, arg1)
+            else:
+                sign0 = (arg0 & sign_mask) == sign_mask
+                sign1 = (arg1 & sign_mask) == sign_mask
+                signr = (res & sign_mask) == sign_mask
+                value = Operators.AND(sign0 ^ sign1, sign0 ^ signr)
+        else:
+            assert operation == 'ADD'
+            arg0, arg1, carry = operands
+            if flag == 'CF':
+                mask = (1 << size) - 1
+                value = Operators.OR(Operators.ULT(res, arg0 & mask), Operators.ULT(res, arg1 & mask))
+                if carry is not None:
+                    # case of 0xFFFFFFFF + 0xFFFFFFFF + CF(1)
+                    value = Operators.OR(value, Operators.AND(res == mask, carry))
+            else:
+                value = (((arg0 ^ arg1 ^ sign_mask) & (res ^ arg1)) & sign_mask) != 0
+        self.write(flag, value)
+
     def write(self, name, value):
         name = self._alias(name)
         if name in ('ST0', 'ST1', 'ST2', 'ST3', 'ST4', 'ST5', 'ST6', 'ST7'):
             name = f'FP{((self.read("TOP") + int(name[2])) & 7)}'
+        if self._lazy_flags:
+            self._lazy_flags.pop(name, None)
 
         # Special EFLAGS/RFLAGS case
         if 'FLAGS' in name:
@@ -586,6 +655,12 @@ class AMD64RegFile(RegisterFile):
         name = str(self._alias(name))
         if name in ('ST0', 'ST1', 'ST2', 'ST3', 'ST4', 'ST5', 'ST6', 'ST7'):
             name = f'FP{((self.read("TOP") + int(name[2])) & 7)}'
+        if self._lazy_flags:
+            if name in self._lazy_flags:
+                self._materialize_flag(name)
+            elif 'FLAGS' in name:
+                for flag in list(self._lazy_flags):
+                    self._materialize_flag(flag)
         if name in self._cache:
             return self._cache[name]
         if 'FLAGS' in name:
@@ -779,29 +854,25 @@ class X86Cpu(Cpu):
     # Instruction Implementations
     #
 
+    def _write_flags(self, flags, operation, size, res, *operands):
+        """
+        Sets `flags` from the result of an arithmetic or logic operation. They
+        are only computed when read (see `AMD64RegFile.write_lazy_flags`),
+        unless someone listens to the register writes.
+        """
+        self.regfile.write_lazy_flags(flags, operation, size, res, *operands)
+        if self._has_subscribers('will_write_register') or self._has_subscribers('did_write_register'):
+            for flag in flags:
+                self.write_register(flag, self.regfile.read(flag))
+
     def _calculate_CMP_flags(self, size, res, arg0, arg1):
-        SIGN_MASK = 1 << (size - 1)
-        self.CF = Operators.ULT(arg0, arg1)
-        self.AF = ((arg0 ^ arg1) ^ res) & 0x10 != 0
-        self.ZF = res == 0
-        self.SF = (res & SIGN_MASK) != 0
-        sign0 = (arg0 & SIGN_MASK) == SIGN_MASK
-        sign1 = (arg1 & SIGN_MASK) == SIGN_MASK
-        signr = (res & SIGN_MASK) == SIGN_MASK
-        self.OF = Operators.AND(sign0 ^ sign1, sign0 ^ signr)
-        self.PF = self._calculate_parity_flag(res)
+        self._write_flags(('CF', 'AF', 'ZF', 'SF', 'OF', 'PF'), 'SUB', size, res, arg0, arg1)
 
     def _calculate_parity_flag(self, res):
-        return (res ^ res >> 1 ^ res >> 2 ^ res >> 3 ^ res >> 4 ^ res >> 5 ^ res >> 6 ^ res >> 7) & 1 == 0
+        return AMD64RegFile.parity_flag(res)
 
     def _calculate_logic_flags(self, size, res):
-        SIGN_MASK = 1 << (size - 1)
-        self.CF = False  # cleared
-        self.AF = False
-        self.ZF = res == 0
-        self.SF = (res & SIGN_MASK) != 0
-        self.OF = False  # cleared
-        self.PF = self._calculate_parity_flag(res)
+        self._write_flags(('CF', 'AF', 'ZF', 'SF', 'OF', 'PF'), 'LOGIC', size, res)
 
     #####################################################
     # Instructions
@@ -927,11 +998,7 @@ class X86Cpu(Cpu):
         """
         # Defined Flags: szp
         temp = src1.read() & src2.read()
-        cpu.SF = (temp & (1 << (src1.size - 1))) != 0
-        cpu.ZF = temp == 0
-        cpu.PF = cpu._calculate_parity_flag(temp)
-        cpu.CF = False
-        cpu.OF = False
+        cpu._write_flags(('SF', 'ZF', 'PF', 'CF', 'OF'), 'LOGIC', src1.size, temp)
 
     @instruction
     def NOT(cpu, dest):
@@ -1225,7 +1292,6 @@ class X86Cpu(Cpu):
 
     def _ADD(cpu, dest, src, carry=False):
         MASK = (1 << dest.size) - 1
-        SIGN_MASK = 1 << (dest.size - 1)
         arg0 = dest.read()
         if src.size < dest.size:
             arg1 = Operators.SEXTEND(src.read(), src.size, dest.size)
@@ -1233,24 +1299,16 @@ class X86Cpu(Cpu):
             arg1 = src.read()
 
         to_add = arg1
+        carry_in = None
         if carry:
-            cv = Operators.ITEBV(dest.size, cpu.CF, 1, 0)
+            carry_in = cpu.CF
+            cv = Operators.ITEBV(dest.size, carry_in, 1, 0)
             to_add = arg1 + cv
 
         res = dest.write((arg0 + to_add) & MASK)
 
         # Affected flags: oszapc
-        tempCF = Operators.OR(Operators.ULT(res, arg0 & MASK), Operators.ULT(res, arg1 & MASK))
-        if carry:
-            # case of 0xFFFFFFFF + 0xFFFFFFFF + CF(1)
-            tempCF = Operators.OR(tempCF, Operators.AND(res == MASK, cpu.CF))
-
-        cpu.CF = tempCF
-        cpu.AF = ((arg0 ^ arg1) ^ res) & 0x10 != 0
-        cpu.ZF = res == 0
-        cpu.SF = (res & SIGN_MASK) != 0
-        cpu.OF = (((arg0 ^ arg1 ^ SIGN_MASK) & (res ^ arg1)) & SIGN_MASK) != 0
-        cpu.PF = cpu._calculate_parity_flag(res)
+        cpu._write_flags(('CF', 'AF', 'ZF', 'SF', 'OF', 'PF'), 'ADD', dest.size, res, arg0, arg1, carry_in)
 
     @instruction
     def CMP(cpu, src1, src2):
@@ -1519,12 +1577,7 @@ class X86Cpu(Cpu):
         res = dest.write(arg0 - 1)
         # Affected Flags o..szapc
         res &= (1 << dest.size) - 1
-        SIGN_MASK = 1 << (dest.size - 1)
-        cpu.AF = ((arg0 ^ 1) ^ res) & 0x10 != 0
-        cpu.ZF = res == 0
-        cpu.SF = (res & SIGN_MASK) != 0
-        cpu.OF = res == SIGN_MASK
-        cpu.PF = cpu._calculate_parity_flag(res)
+        cpu._write_flags(('AF', 'ZF', 'SF', 'OF', 'PF'), 'DEC', dest.size, res, arg0, 1)
 
     @instruction
     def DIV(cpu, src):
@@ -1875,12 +1928,7 @@ class X86Cpu(Cpu):
         arg0 = dest.read()
         res = dest.write(arg0 + 1)
         res &= (1 << dest.size) - 1
-        SIGN_MASK = 1 << (dest.size - 1)
-        cpu.AF = ((arg0 ^ 1) ^ res) & 0x10 != 0
-        cpu.ZF = res == 0
-        cpu.SF = (res & SIGN_MASK) != 0
-        cpu.OF = res == SIGN_MASK
-        cpu.PF = cpu._calculate_parity_flag(res)
+        cpu._write_flags(('AF', 'ZF', 'SF', 'OF', 'PF'), 'INC', dest.size, res, arg0, 1)
 
     @instruction
     def MUL(cpu, src):
@@ -2042,7 +2090,6 @@ class X86Cpu(Cpu):
         :param src: source operand.
         """
         MASK = (1 << dest.size) - 1
-        SIGN_MASK = 1 << (dest.size - 1)
 
         arg0 = dest.read()
         arg1 = src.read()
@@ -2051,13 +2098,7 @@ class X86Cpu(Cpu):
         dest.write(temp)
 
         # Affected flags: oszapc
-        tempCF = Operators.OR(Operators.ULT(temp, arg0), Operators.ULT(temp, arg1))
-        cpu.CF = tempCF
-        cpu.AF = ((arg0 ^ arg1) ^ temp) & 0x10 != 0
-        cpu.ZF = temp == 0
-        cpu.SF = (temp & SIGN_MASK) != 0
-        cpu.OF = (((arg0 ^ arg1 ^ SIGN_MASK) & (temp ^ arg1)) & SIGN_MASK) != 0
-        cpu.PF = cpu._calculate_parity_flag(temp)
+        cpu._write_flags(('CF', 'AF', 'ZF', 'SF', 'OF', 'PF'), 'ADD', dest.size, temp, arg0, arg1, None)
 
 
 ########################################################################################
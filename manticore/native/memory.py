@@ -1,9 +1,9 @@
 from abc import ABCMeta, abstractmethod
-from weakref import WeakValueDictionary
 from ..core.smtlib import Operators, ConstraintSet, arithmetic_simplify, Z3Solver, TooManySolutions, BitVec, BitVecConstant, expression
 from ..native.mappings import mmap, munmap
-from ..utils.helpers import issymbolic, interval_intersection
+from ..utils.helpers import issymbolic, interval_intersection, Page
 
+import bisect
 import functools
 import logging
 
@@ -240,9 +240,29 @@ class Map(object, metaclass=ABCMeta):
         :param address: The address at which to split the Map.
         """
 
+    def read_raw(self, start, stop):
+        """
+        Reads the range of addresses [start:stop) as bytes.
+
+        :return: the bytes, or None if some of them are symbolic.
+        :rtype: bytes or None
+        """
+        data = self[start:stop]
+        if any(issymbolic(c) for c in data):
+            return None
+        return b''.join(map(_normalize, data))
+
 
 class AnonMap(Map):
-    """ A concrete anonymous memory map """
+    """
+    A concrete anonymous memory map
+
+    Concrete data is pickled as a list of `Page` so states forked from the
+    same process share the pages they did not write (see `Store.save_state`).
+    Symbolic bytes are kept in a sparse overlay on top of the concrete data.
+    """
+    #: Granularity of the pages shared between pickled maps
+    page_size = 0x1000
 
     def __init__(self, start, size, perms, data_init=None, name=None, **kwargs):
         """
@@ -255,6 +275,8 @@ class AnonMap(Map):
         """
         super().__init__(start, size, perms, name, **kwargs)
         self._data = bytearray(size)
+        # Symbolic bytes by offset, they shadow the same offsets of _data
+        self._overlay = {}
         if data_init is not None:
             assert len(data_init) <= size, 'More initial data than reserved memory'
             # check that the values this slice points to are ints
@@ -262,9 +284,34 @@ class AnonMap(Map):
                 self._data[0:len(data_init)] = data_init
             else:
                 self._data[0:len(data_init)] = [ord(s) for s in data_init]
+        # Digest of each page of _data, None if it was written since computed
+        self._digests = [None] * ((size + self.page_size - 1) // self.page_size)
 
     def __reduce__(self):
-        return (self.__class__, (self.start, len(self), self.perms, self._data, self.name))
+        args = (self.start, len(self), self.perms, None, self.name)
+        return (self.__class__, args, {'_pages': self._pages(), '_overlay': self._overlay})
+
+    def __setstate__(self, state):
+        pages = state['_pages']
+        self._data = bytearray().join(page.data for page in pages)
+        self._digests = [page.digest for page in pages]
+        self._overlay = state['_overlay']
+
+    def _pages(self):
+        """ Returns the concrete data as a list of `Page` """
+        view = memoryview(self._data)
+        pages = []
+        for i, offset in enumerate(range(0, len(self._data), self.page_size)):
+            page = Page(view[offset:offset + self.page_size], self._digests[i])
+            self._digests[i] = page.digest
+            pages.append(page)
+        return pages
+
+    def _symbols_in(self, start, stop):
+        """ Returns the offsets of the overlay in [start:stop) """
+        if len(self._overlay) < stop - start:
+            return [offset for offset in self._overlay if start <= offset < stop]
+        return [offset for offset in range(start, stop) if offset in self._overlay]
 
     def split(self, address):
         if address <= self.start:
@@ -273,8 +320,14 @@ class AnonMap(Map):
             return self, None
 
         assert address > self.start and address < self.end
-        head = AnonMap(self.start, address - self.start, self.perms, self[self.start:address])
-        tail = AnonMap(address, self.end - address, self.perms, self[address:self.end])
+        offset = address - self.start
+        head = AnonMap(self.start, offset, self.perms, self._data[:offset])
+        tail = AnonMap(address, self.end - address, self.perms, self._data[offset:])
+        for i, value in self._overlay.items():
+            if i < offset:
+                head._overlay[i] = value
+            else:
+                tail._overlay[i - offset] = value
         return head, tail
 
     def __setitem__(self, index, value):
@@ -282,22 +335,48 @@ class AnonMap(Map):
             len(value) == index.stop - index.start
         index = self._get_offset(index)
 
-        if issymbolic(value[0]) and isinstance(self._data, bytearray):
-            self._data = [Operators.ORD(b) for b in self._data]  # completely convert everything to a list if we need to store some symbolic data, just copying fpse
-
         if isinstance(index, slice):
-            if not isinstance(value[0], int):
-                value = [Operators.ORD(n) for n in value]
-            self._data[index] = value
+            if isinstance(value, (bytes, bytearray)) or not any(issymbolic(c) for c in value):
+                if not isinstance(value[0], int):
+                    value = [Operators.ORD(n) for n in value]
+                self._data[index] = value
+                for offset in self._symbols_in(index.start, index.stop):
+                    del self._overlay[offset]
+            else:
+                for offset, c in enumerate(map(Operators.ORD, value), index.start):
+                    if issymbolic(c):
+                        self._overlay[offset] = c
+                    else:
+                        self._data[offset] = c
+                        self._overlay.pop(offset, None)
+            first, last = index.start // self.page_size, (index.stop - 1) // self.page_size
+            self._digests[first:last + 1] = [None] * (last + 1 - first)
         else:
-            self._data[index] = Operators.ORD(value)
+            value = Operators.ORD(value)
+            if issymbolic(value):
+                self._overlay[index] = value
+            else:
+                self._data[index] = value
+                self._overlay.pop(index, None)
+                self._digests[index // self.page_size] = None
 
     def __getitem__(self, index):
         index = self._get_offset(index)
         if isinstance(index, slice):
-            return [Operators.CHR(i) for i in self._data[index]]
+            data = [Operators.CHR(i) for i in self._data[index]]
+            for offset in self._symbols_in(index.start, index.stop):
+                data[offset - index.start] = self._overlay[offset]
+            return data
+        if index in self._overlay:
+            return self._overlay[index]
         return Operators.CHR(self._data[index])
 
+    def read_raw(self, start, stop):
+        index = self._get_offset(slice(start, stop))
+        if self._symbols_in(index.start, index.stop):
+            return None
+        return bytes(self._data[index])
+
 
 class ArrayMap(Map):
     def __init__(self, address, size, perms, index_bits, backing_array=None, name=None, **kwargs):
@@ -491,6 +570,9 @@ class StubCPU:
     def _publish(self, *args, **kwargs):
         return None
 
+    def _invalidate_instructions(self, where, size):
+        return None
+
 
 class Memory(object, metaclass=ABCMeta):
     """
@@ -508,12 +590,19 @@ class Memory(object, metaclass=ABCMeta):
         else:
             self._maps = set(maps)
         self.cpu = cpu
-        self._page2map = WeakValueDictionary()  # {page -> ref{MAP}}
+        # The maps sorted by start address, and their start addresses. Maps
+        # usually do not overlap so an address can only be in the last map
+        # starting at or below it
+        self._sorted_maps = sorted(self._maps, key=lambda m: m.start)
+        self._starts = [m.start for m in self._sorted_maps]
+        # Number of neighbours in _sorted_maps that overlap, e.g. maps stacked
+        # at the same address by LazySMemory.mmapFile. Any overlap makes some
+        # neighbours overlap, so lookups look at every earlier map only while
+        # this is not 0
+        self._overlaps = sum(map(self._overlap, self._sorted_maps, self._sorted_maps[1:]))
+        # Last map found by _lookup. Most accesses hit the same map
+        self._last_map = None
         self._recording_stack = []
-        for m in self._maps:
-            for i in range(self._page(m.start), self._page(m.end)):
-                assert i not in self._page2map
-                self._page2map[i] = m
 
     def __reduce__(self):
         return (self.__class__, (self._maps, self.cpu))
@@ -577,42 +666,35 @@ class Memory(object, metaclass=ABCMeta):
         """
         return address >> self.page_bit_size
 
-    def _search(self, size, start=None, counter=0):
+    def _search(self, size, start=None):
         """
-        Recursively searches the address space for enough free space to allocate C{size} bytes.
+        Searches the address space for enough free space to allocate C{size} bytes.
+        The highest free address not above C{start} is chosen. If there is none,
+        the search goes on downwards from the top of the address space.
 
         :param size: the size in bytes to allocate.
         :param start: an address from where to start the search.
-        :param counter: internal parameter to know if all the memory was already scanned.
         :return: the address of an available space to map C{size} bytes.
         :raises MemoryException: if there is no space available to allocate the desired memory.
         :rtype: int
-
-
-        todo: Document what happens when you try to allocate something that goes round the address 32/64 bit representation.
         """
         assert size & self.page_mask == 0
         if start is None:
             end = {32: 0xf8000000, 64: 0x0000800000000000}[self.memory_bit_size]
             start = end - size
-        else:
-            if start > self.memory_size - size:
-                start = self.memory_size - size
-            end = start + size
-
-        consecutive_free = 0
-        for p in range(self._page(end - 1), -1, -1):
-            if p not in self._page2map:
-                consecutive_free += 0x1000
-            else:
-                consecutive_free = 0
-            if consecutive_free >= size:
-                return p << self.page_bit_size
-            counter += 1
-            if counter >= self.memory_size // self.page_size:
-                raise MemoryException('Not enough memory')
+        elif start > self.memory_size - size:
+            start = self.memory_size - size
+
+        for candidate in (start, self.memory_size - size):
+            # Jump below the lowest map overlapping [candidate, candidate + size)
+            # until the range is free
+            while candidate >= 0:
+                overlapping = self._overlapping(candidate, candidate + size)
+                if not overlapping:
+                    return candidate
+                candidate = overlapping[0].start - size
 
-        return self._search(size, self.memory_size - size, counter)
+        raise MemoryException('Not enough memory')
 
     def mmapFile(self, addr, size, perms, filename, offset=0):
         """
@@ -651,8 +733,7 @@ class Memory(object, metaclass=ABCMeta):
         addr = self._search(size, addr)
 
         # It should not be allocated
-        for i in range(self._page(addr), self._page(addr + size)):
-            assert i not in self._page2map, 'Map already used'
+        assert not self._overlapping(addr, addr + size), 'Map already used'
 
         # Create the map
         m = FileMap(addr, size, perms, filename, offset)
@@ -699,8 +780,7 @@ class Memory(object, metaclass=ABCMeta):
         addr = self._search(size, addr)
 
         # It should not be allocated
-        for i in range(self._page(addr), self._page(addr + size)):
-            assert i not in self._page2map, 'Map already used'
+        assert not self._overlapping(addr, addr + size), 'Map already used'
 
         # Create the anonymous map
         m = AnonMap(start=addr, size=size, perms=perms, data_init=data_init, name=name)
@@ -713,24 +793,81 @@ class Memory(object, metaclass=ABCMeta):
         self.cpu._publish('did_map_memory', addr, size, perms, None, None, addr)
         return addr
 
+    @staticmethod
+    def _overlap(before, after):
+        """ 1 if two maps sorted by start address overlap, 0 otherwise """
+        return int(before is not None and after is not None and before.end > after.start)
+
+    def _neighbours(self, i):
+        """ The maps before and at position i of _sorted_maps, or None """
+        before = self._sorted_maps[i - 1] if i > 0 else None
+        after = self._sorted_maps[i] if i < len(self._sorted_maps) else None
+        return before, after
+
     def _add(self, m):
         assert isinstance(m, Map)
         assert m not in self._maps
         assert m.start & self.page_mask == 0
         assert m.end & self.page_mask == 0
         self._maps.add(m)
-        # updating the page to map translation
-        for i in range(self._page(m.start), self._page(m.end)):
-            self._page2map[i] = m
+        # After the maps starting at the same address, so the newest one is found
+        i = bisect.bisect_right(self._starts, m.start)
+        before, after = self._neighbours(i)
+        self._overlaps += self._overlap(before, m) + self._overlap(m, after) - self._overlap(before, after)
+        self._starts.insert(i, m.start)
+        self._sorted_maps.insert(i, m)
+        self._last_map = None
 
     def _del(self, m):
         assert isinstance(m, Map)
         assert m in self._maps
-        # remove m pages from the page2maps..
-        for p in range(self._page(m.start), self._page(m.end)):
-            del self._page2map[p]
-        # remove m from the maps set
+        i = bisect.bisect_left(self._starts, m.start)
+        while self._sorted_maps[i] is not m:
+            i += 1
+        del self._starts[i]
+        del self._sorted_maps[i]
+        before, after = self._neighbours(i)
+        self._overlaps += self._overlap(before, after) - self._overlap(before, m) - self._overlap(m, after)
         self._maps.remove(m)
+        if self._last_map is m:
+            self._last_map = None
+
+    def _lookup(self, address):
+        """
+        Returns the map containing the concrete address or None
+        """
+        if not isinstance(address, int):
+            return None
+        m = self._last_map
+        if m is not None and m.start <= address < m.end:
+            return m
+        i = bisect.bisect_right(self._starts, address) - 1
+        if i < 0:
+            return None
+        m = self._sorted_maps[i]
+        if address >= m.end:
+            if not self._overlaps:
+                return None
+            # The newest of the maps stacked at a start comes last
+            for m in reversed(self._sorted_maps[:i]):
+                if address < m.end:
+                    break
+            else:
+                return None
+        if not self._overlaps:
+            self._last_map = m
+        return m
+
+    def _overlapping(self, start, end):
+        """
+        Returns the sorted list of the maps that overlap with [start:end)
+        """
+        if self._overlaps:
+            i = 0
+        else:
+            i = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        j = bisect.bisect_left(self._starts, end)
+        return [m for m in self._sorted_maps[i:j] if m.end > start]
 
     def map_containing(self, address):
         """
@@ -741,10 +878,10 @@ class Memory(object, metaclass=ABCMeta):
 
         @todo: symbolic address
         """
-        page_offset = self._page(address)
-        if page_offset not in self._page2map:
+        m = self._lookup(address)
+        if m is None:
             raise MemoryException("Page not mapped", address)
-        return self._page2map[page_offset]
+        return m
 
     def mappings(self):
         """
@@ -754,7 +891,7 @@ class Memory(object, metaclass=ABCMeta):
         :rtype: list
         """
         result = []
-        for m in self.maps:
+        for m in self._sorted_maps:
             if isinstance(m, AnonMap):
                 result.append((m.start, m.end, m.perms, 0, ''))
             elif isinstance(m, FileMap):
@@ -762,7 +899,7 @@ class Memory(object, metaclass=ABCMeta):
             else:
                 result.append((m.start, m.end, m.perms, 0, m.name))
 
-        return sorted(result)
+        return result
 
     def __str__(self):
         return '\n'.join([f'{start:016x}-{end:016x} {p:>4s} {offset:08x} {name or ""}' for start, end, p, offset, name in self.mappings()])
@@ -771,16 +908,8 @@ class Memory(object, metaclass=ABCMeta):
         """
         Generates the list of maps that overlaps with the range [start:end]
         """
-
-        # Search for the first matching map
-        addr = start
-        while addr < end:
-            if addr not in self:
-                addr += self.page_size
-            else:
-                m = self._page2map[self._page(addr)]
-                yield m
-                addr = m.end
+        # The list is taken before yielding so callers can add and delete maps
+        yield from self._overlapping(start, end)
 
     def munmap(self, start, size):
         """
@@ -806,6 +935,7 @@ class Memory(object, metaclass=ABCMeta):
             if tail:
                 self._add(tail)
 
+        self.cpu._invalidate_instructions(start, end - start)
         self.cpu._publish('did_unmap_memory', start, size)
         logger.debug(f'Unmap memory @{start:x} size:{size:x}')
 
@@ -831,11 +961,12 @@ class Memory(object, metaclass=ABCMeta):
             if tail:
                 self._add(tail)
 
+        self.cpu._invalidate_instructions(start, end - start)
         self.cpu._publish('did_protect_memory', start, size, perms)
 
     # Permissions
     def __contains__(self, address):
-        return self._page(address) in self._page2map
+        return self._lookup(address) is not None
 
     def perms(self, index):
         # not happy with this interface.
@@ -886,6 +1017,34 @@ class Memory(object, metaclass=ABCMeta):
 
         return result
 
+    def read_raw(self, addr, size, force=False):
+        """
+        Reads size concrete bytes at addr. This is the fast path for concrete
+        memory: no per byte objects are built.
+
+        :return: the bytes, or None if some of them are symbolic. Callers fall
+                 back to `read` then.
+        :rtype: bytes or None
+        """
+        if not self.access_ok(slice(addr, addr + size), 'r', force):
+            raise InvalidMemoryAccess(addr, 'r')
+
+        chunks = []
+        stop = addr + size
+        p = addr
+        while p < stop:
+            m = self.map_containing(p)
+            end = min(m.end, stop)
+            chunk = m.read_raw(p, end)
+            if chunk is None:
+                return None
+            chunks.append(chunk)
+            p = end
+
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
+
     def push_record_writes(self):
         """
         Begin recording all writes. Retrieve all writes with `pop_record_writes()`
@@ -936,6 +1095,7 @@ class Memory(object, metaclass=ABCMeta):
             m[addr:addr + size] = buf[addr - start:addr - start + size]
             addr += size
         assert addr == stop
+        self.cpu._invalidate_instructions(start, stop - start)
 
     def _get_size(self, size):
         return size
@@ -959,11 +1119,8 @@ class Memory(object, metaclass=ABCMeta):
         """
         Iterate all valid addresses
         """
-        for page_addr in sorted(self._page2map.keys()):
-            start = page_addr * self.page_size
-            end = start + self.page_size
-            for addr in range(start, end):
-                yield addr
+        for m in list(self._sorted_maps):
+            yield from range(m.start, m.end)
 
 
 class SMemory(Memory):
@@ -1097,6 +1254,13 @@ class SMemory(Memory):
                             result[offset] = Operators.ITEBV(8, condition, Operators.ORD(value), result[offset])
             return list(map(Operators.CHR, result))
 
+    def read_raw(self, address, size, force=False):
+        if issymbolic(address):
+            return None
+        if self._symbols and any(address + offset in self._symbols for offset in range(size)):
+            return None
+        return super().read_raw(address, size, force)
+
     def write(self, address, value, force=False):
         """
         Write a value at address.
@@ -1115,6 +1279,13 @@ class SMemory(Memory):
                 for base in solutions:
                     condition = base == address
                     self._symbols.setdefault(base + offset, []).append((condition, value[offset]))
+            self.cpu._invalidate_instructions(address, size)
+        elif isinstance(value, (bytes, bytearray)):
+            # Concrete bytes are written at once
+            if self._symbols:
+                for offset in range(size):
+                    self._symbols.pop(address + offset, None)
+            super().write(address, value, force)
         else:
 
             for offset in range(size):
@@ -1127,6 +1298,7 @@ class SMemory(Memory):
                     if address + offset in self._symbols:
                         del self._symbols[address + offset]
                     super().write(address + offset, [value[offset]], force)
+            self.cpu._invalidate_instructions(address, size)
 
     def _try_get_solutions(self, address, size, access, max_solutions=0x1000, force=False):
         """
@@ -1314,6 +1486,10 @@ class LazySMemory(SMemory):
 
         return retvals
 
+    def read_raw(self, address, size, force=False):
+        # Reads may come from the backing array, so the generic path is used
+        return None
+
     def write(self, address, value, force=False):
 
         size = len(value)
@@ -1327,6 +1503,7 @@ class LazySMemory(SMemory):
 
             for addr, byte in zip(addrs_to_access, value):
                 self.backing_array[addr] = Operators.ORD(byte)
+            self.cpu._invalidate_instructions(address, size)
         else:
             self.backed_by_symbolic_store -= set(addrs_to_access)
             Memory.write(self, address, value)
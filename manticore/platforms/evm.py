@@ -4,15 +4,15 @@ import random
 import io
 import copy
 import inspect
-from functools import wraps
-from typing import List, Set, Tuple, Union
+from functools import wraps, lru_cache
+from typing import List, Set, Tuple
 from ..utils.helpers import issymbolic, get_taints, taint_with, istainted
 from ..platforms.platform import *
-from ..core.smtlib import Z3Solver, BitVec, Array, ArrayProxy, Operators, Constant, ArrayVariable, ArrayStore, BitVecConstant, translate_to_smtlib, to_constant, simplify
+from ..core.smtlib import Z3Solver, Expression, BitVec, Array, ArrayProxy, Operators, Constant, BitVecConstant, translate_to_smtlib, to_constant, simplify
 from ..core.state import Concretize, TerminateState
 from ..utils.event import Eventful
 from ..utils import config
-from ..core.smtlib.visitors import simplify
+from ..core.smtlib.visitors import simplify, TranslatorSmtlib
 from ..exceptions import EthereumError
 import pyevmasm as EVMAsm
 import logging
@@ -41,6 +41,7 @@ consts.add('oog', default='pedantic', description=(
     'Default behavior for symbolic gas.'
     'pedantic: Fully faithful. Test at every instruction. Forks.'
     'complete: Mostly faithful. Test at BB limit. Forks.'
+    'block: Mostly faithful. Charge the static cost of a whole BB at its start. Forks at most once per BB plus dynamic fees.'
     'concrete: Incomplete. Concretize gas to MIN/MAX values. Forks.'
     'optimistic: Try to not fail due to OOG. If it can be enough gas use it. Ignore the path to OOG. Wont fork'
     'pesimistic: Try OOG asap. Fail soon. Ignore the path with enough gas.'
@@ -85,13 +86,14 @@ class Transaction:
         self.gas = gas
         self.set_result(result, return_data)
 
-    def concretize(self, state):
-        conc_caller = state.solve_one(self.caller)
-        conc_address = state.solve_one(self.address)
-        conc_value = state.solve_one(self.value)
-        conc_gas = state.solve_one(self.gas)
-        conc_data = state.solve_one(self.data)
-        conc_return_data = state.solve_one(self.return_data)
+    def concretize(self, state, constrain=False):
+        """
+        :param state: a manticore state
+        :param bool constrain: If True, constrain the transaction fields to the concretized values
+        :return: a Transaction with every field solved from one model of `state`
+        """
+        conc_caller, conc_address, conc_value, conc_gas, conc_data, conc_return_data = state.solve_one_n(
+            self.caller, self.address, self.value, self.gas, self.data, self.return_data, constrain=constrain)
 
         return Transaction(self.sort, conc_address, self.price, conc_data, conc_caller, conc_value, conc_gas,
                            depth=self.depth, result=self.result, return_data=bytearray(conc_return_data))
@@ -455,6 +457,324 @@ def concretized_args(**policies):
     return concretizer
 
 
+BasicBlock = namedtuple("BasicBlock", ['start', 'end', 'gas'])
+
+
+class CodeAnalysis:
+    """
+    Static analysis of some bytecode: decoded instructions, valid jump
+    destinations and basic blocks with their static gas.
+
+    Use `CodeAnalysis.get(bytecode)` so every VM running the same concrete
+    bytecode shares the analysis.
+    """
+
+    def __init__(self, bytecode):
+        self._bytecode = bytecode
+        self._instructions = {}
+        self.jumpdests = set()
+        #: Basic blocks of the linear disassembly by start pc. The block ends
+        #: at a terminator or before a JUMPDEST. Its gas is the sum of the
+        #: static fees of its instructions.
+        self.blocks = {}
+
+        # Linear disassembly. Symbolic bytes are decoded as 0
+        def extend_with_zeroes(b):
+            try:
+                for x in b:
+                    x = to_constant(x)
+                    if isinstance(x, int):
+                        yield(x)
+                    else:
+                        yield(0)
+                for _ in range(32):
+                    yield(0)
+            except Exception as e:
+                return
+
+        block = []
+        code_size = len(bytecode)
+        for i in EVMAsm.disassemble_all(extend_with_zeroes(bytecode), fork=DEFAULT_FORK):
+            if i.pc >= code_size:
+                break
+            if isinstance(bytecode, bytes):
+                self._instructions[i.pc] = i
+            if i.mnemonic == 'JUMPDEST':
+                self.jumpdests.add(i.pc)
+                self._add_block(block)
+                block = []
+            block.append(i)
+            if i.is_terminator:
+                self._add_block(block)
+                block = []
+        self._add_block(block)
+
+    def _add_block(self, instructions):
+        if instructions:
+            start, end = instructions[0].pc, instructions[-1].pc
+            self.blocks[start] = BasicBlock(start, end, sum(i.fee for i in instructions))
+
+    @staticmethod
+    def get(bytecode):
+        """ Returns the analysis of bytecode, cached for concrete bytecode """
+        if isinstance(bytecode, bytes):
+            return CodeAnalysis._get_cached(bytecode)
+        return CodeAnalysis(bytecode)
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _get_cached(bytecode):
+        return CodeAnalysis(bytecode)
+
+    @property
+    def instructions(self):
+        """ The instructions of the linear disassembly in pc order (concrete bytecode only) """
+        return self._instructions.values()
+
+    def instruction(self, pc):
+        """ Returns the instruction decoded at pc """
+        instruction = self._instructions.get(pc)
+        if instruction is None:
+            def getcode():
+                bytecode = self._bytecode
+                if isinstance(bytecode, bytes):
+                    yield from bytecode[pc:]
+                else:
+                    for pc_i in range(pc, len(bytecode)):
+                        yield simplify(bytecode[pc_i]).value
+                while True:
+                    yield 0
+            instruction = EVMAsm.disassemble_one(getcode(), pc=pc, fork=DEFAULT_FORK)
+            self._instructions[pc] = instruction
+        return instruction
+
+
+class EVMMemory:
+    """
+    The memory of an EVM.
+
+    Bytes written at concrete offsets are kept in a bytearray, or in a dict
+    when they are symbolic. The first access at a symbolic offset, or a
+    slice holding symbolic bytes, copies the content into a symbolic array
+    that is used from then on.
+    """
+    #: Memory beyond this size is only handled by the symbolic array
+    MAX_CONCRETE_SIZE = 1 << 24
+
+    def __init__(self, array):
+        """
+        :param ArrayProxy array: an empty array (default 0) to use if the memory becomes symbolic
+        """
+        self._array = array
+        self._symbolic_array = False
+        self._concrete = bytearray()
+        self._symbolic = {}
+
+    @property
+    def is_symbolic(self):
+        """ True if the memory is handled by the symbolic array """
+        return self._symbolic_array
+
+    def _to_array(self):
+        if not self._symbolic_array:
+            array = self._array
+            for offset, value in enumerate(self._concrete):
+                if value:
+                    array[offset] = value
+            for offset, value in self._symbolic.items():
+                array[offset] = value
+            self._concrete = None
+            self._symbolic = None
+            self._symbolic_array = True
+        return self._array
+
+    def _is_concrete_access(self, offset, size):
+        return not self._symbolic_array and \
+            not issymbolic(offset) and not issymbolic(size) and \
+            offset + size <= self.MAX_CONCRETE_SIZE
+
+    def _has_symbolic(self, offset, size):
+        symbolic = self._symbolic
+        if not symbolic:
+            return False
+        if len(symbolic) < size:
+            return any(offset <= i < offset + size for i in symbolic)
+        return any(i in symbolic for i in range(offset, offset + size))
+
+    def read_BE(self, offset, size):
+        if not self._is_concrete_access(offset, size):
+            return self._to_array().read_BE(offset, size)
+        data = self._concrete[offset:offset + size]
+        if not self._has_symbolic(offset, size):
+            return int.from_bytes(data, 'big') << (8 * (size - len(data)))
+        data += bytes(size - len(data))
+        return Operators.CONCAT(size * 8, *(self._symbolic.get(offset + i, data[i]) for i in range(size)))
+
+    def write_BE(self, offset, value, size):
+        if not self._is_concrete_access(offset, size):
+            self._to_array().write_BE(offset, value, size)
+            return
+
+        if len(self._concrete) < offset + size:
+            self._concrete.extend(bytes(offset + size - len(self._concrete)))
+        if isinstance(value, Constant) and not value.taint:
+            value = value.value
+        if isinstance(value, int):
+            self._concrete[offset:offset + size] = (value & ((1 << (size * 8)) - 1)).to_bytes(size, 'big')
+            if self._symbolic:
+                for i in range(offset, offset + size):
+                    self._symbolic.pop(i, None)
+            return
+
+        if value.size < size * 8:
+            value = Operators.ZEXTEND(value, size * 8)
+        for i in range(size):
+            byte = simplify(Operators.EXTRACT(value, (size - 1 - i) * 8, 8))
+            if isinstance(byte, Constant) and not byte.taint:
+                byte = byte.value
+            if isinstance(byte, int):
+                self._concrete[offset + i] = byte
+                self._symbolic.pop(offset + i, None)
+            else:
+                self._symbolic[offset + i] = byte
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop = index.start, index.stop
+            if issymbolic(start) or issymbolic(stop) or \
+               not self._is_concrete_access(start, stop - start) or \
+               self._has_symbolic(start, stop - start):
+                return self._to_array()[index]
+            data = self._concrete[start:stop]
+            return bytes(data) + bytes(stop - start - len(data))
+        return self.read_BE(index, 1)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            for i, byte in enumerate(value):
+                self.write_BE(index.start + i, Operators.ORD(byte), 1)
+        else:
+            self.write_BE(index, Operators.ORD(value), 1)
+
+
+class EVMStorage:
+    """
+    The storage of an account.
+
+    Words written at concrete keys are kept in a dict. Writes at symbolic
+    keys go to a separate log and are only merged, as ITE chains, into the
+    reads that may alias them. Unwritten keys are read from the initial
+    storage array.
+    """
+
+    def __init__(self, array, items=None):
+        """
+        :param ArrayProxy array: the initial storage
+        :param dict items: initial concrete words
+        """
+        self._array = array
+        self._array_written = bool(array.written)
+        # Reading a key never written to the array gives its default, if any
+        self._default = None
+        if not self._array_written:
+            default = simplify(array.get(0))
+            if isinstance(default, Constant):
+                self._default = default.value
+        #: concrete key -> (value, write sequence number)
+        self._concrete = {}
+        #: [(write sequence number, symbolic key, value), ...] in write order
+        self._symbolic = []
+        self._count = 0
+        if items:
+            for key, value in items.items():
+                self[key] = value
+
+    def __copy__(self):
+        other = EVMStorage.__new__(EVMStorage)
+        other.__dict__.update(self.__dict__)
+        other._concrete = dict(self._concrete)
+        other._symbolic = list(self._symbolic)
+        return other
+
+    @staticmethod
+    def _key(key):
+        if isinstance(key, BitVec):
+            key = simplify(key)
+            if isinstance(key, Constant):
+                key = key.value
+        return key
+
+    def _writes(self):
+        """ All the (sequence number, key, value) writes in write order """
+        writes = [(count, key, value) for key, (value, count) in self._concrete.items()]
+        writes.extend(self._symbolic)
+        writes.sort(key=lambda write: write[0])
+        return writes
+
+    def _initial(self, key):
+        if self._default is not None:
+            return self._default
+        return self._array.get(key)
+
+    def get(self, key, default=None):
+        """ Read the word at `key` """
+        key = self._key(key)
+        if issymbolic(key):
+            value = self._initial(key)
+            for _, written_key, written_value in self._writes():
+                value = Operators.ITEBV(256, key == written_key, written_value, value)
+            return value
+
+        value, count = self._concrete.get(key, (None, -1))
+        if value is None:
+            value = self._initial(key)
+        # Only symbolic writes after the last concrete one may alias the key
+        for written_count, written_key, written_value in self._symbolic:
+            if written_count > count:
+                value = Operators.ITEBV(256, key == written_key, written_value, value)
+        return value
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        key = self._key(key)
+        if issymbolic(key):
+            self._symbolic.append((self._count, key, value))
+        else:
+            self._concrete[key] = (value, self._count)
+        self._count += 1
+
+    def items(self):
+        """ The written (key, value) pairs, newest first. Keys may be symbolic """
+        return [(key, value) for _, key, value in reversed(self._writes())]
+
+    def is_written(self):
+        """ True if something has been written to the storage """
+        return self._array_written or bool(self._concrete) or bool(self._symbolic)
+
+    def fingerprint(self, names=None):
+        """
+        A canonical rendering of the content. Storages with equal
+        fingerprints hold the same words. See _render for names
+        """
+        if self._symbolic:
+            # The order of the writes matters if some key is symbolic
+            writes = [(key, value) for _, key, value in self._writes()]
+        else:
+            writes = sorted((key, value) for key, (value, _) in self._concrete.items()
+                            if not (self._default == 0 and isinstance(value, int) and value == 0))
+        return _render(self._array.array, writes, names=names)
+
+    @property
+    def array(self):
+        """ The storage as an array expression """
+        array = copy.copy(self._array)
+        for _, key, value in self._writes():
+            array[key] = value
+        return array.array
+
+
 class EVM(Eventful):
     """
     Machine State. The machine state is defined as
@@ -466,8 +786,8 @@ class EVM(Eventful):
     """
     _published_events = {'evm_execute_instruction',
                          'evm_read_storage', 'evm_write_storage',
-                         'evm_read_memory',
-                         'evm_write_memory',
+                         'evm_read_memory', 'evm_read_memory_word',
+                         'evm_write_memory', 'evm_write_memory_word',
                          'evm_read_code',
                          'decode_instruction', 'concrete_sha3', 'symbolic_sha3'}
 
@@ -526,17 +846,12 @@ class EVM(Eventful):
         :param gas: gas budget for this transaction
         """
         super().__init__(**kwargs)
+        # Concrete data and bytecode are kept as bytes
         if data is not None and not issymbolic(data):
-            data_size = len(data)
-            data_symbolic = constraints.new_array(index_bits=256, value_bits=8, index_max=data_size, name=f'DATA_{address:x}', avoid_collisions=True, default=0)
-            data_symbolic[0:data_size] = data
-            data = data_symbolic
+            data = self._to_buffer(constraints, data, f'DATA_{address:x}')
 
         if bytecode is not None and not issymbolic(bytecode):
-            bytecode_size = len(bytecode)
-            bytecode_symbolic = constraints.new_array(index_bits=256, value_bits=8, index_max=bytecode_size, name=f'BYTECODE_{address:x}', avoid_collisions=True, default=0)
-            bytecode_symbolic[0:bytecode_size] = bytecode
-            bytecode = bytecode_symbolic
+            bytecode = self._to_buffer(constraints, bytecode, f'BYTECODE_{address:x}')
 
         #TODO: Handle the case in which bytecode is symbolic (This happens at
         # CREATE instructions that has the arguments appended to the bytecode)
@@ -544,25 +859,7 @@ class EVM(Eventful):
         # We should simply not allow to jump to unconstrained(*) symbolic code.
         # (*) bytecode that could take more than a single value
         self._check_jumpdest = False
-        self._valid_jumpdests = set()
-
-        #Compile the list of valid jumpdests via linear dissassembly
-        def extend_with_zeroes(b):
-            try:
-                for x in b:
-                    x = to_constant(x)
-                    if isinstance(x, int):
-                        yield(x)
-                    else:
-                        yield(0)
-                for _ in range(32):
-                    yield(0)
-            except Exception as e:
-                return
-
-        for i in EVMAsm.disassemble_all(extend_with_zeroes(bytecode)):
-            if i.mnemonic == 'JUMPDEST':
-                self._valid_jumpdests.add(i.pc)
+        self._code_analysis = CodeAnalysis.get(bytecode)
 
         #A no code VM is used to execute transactions to normal accounts.
         #I'll execute a STOP and close the transaction
@@ -570,7 +867,7 @@ class EVM(Eventful):
         #    raise EVMException("Need code")
         self._constraints = constraints
         # Uninitialized values in memory are 0 by spec
-        self.memory = constraints.new_array(index_bits=256, value_bits=8, name=f'EMPTY_MEMORY_{address:x}', avoid_collisions=True, default=0)
+        self.memory = EVMMemory(constraints.new_array(index_bits=256, value_bits=8, name=f'EMPTY_MEMORY_{address:x}', avoid_collisions=True, default=0))
         self.address = address
         self.caller = caller  # address of the account that is directly responsible for this execution
         self.data = data
@@ -600,6 +897,23 @@ class EVM(Eventful):
         self._calldata_size = len(self.data)
         self._valid_jmpdests = set()
 
+    @staticmethod
+    def _to_buffer(constraints, data, name):
+        """
+        Returns data as bytes, or as an array if it holds symbolic bytes
+
+        :param data: a str, bytes-like or sequence of bytes
+        """
+        if isinstance(data, str):
+            return data.encode('latin-1')
+        if isinstance(data, (bytes, bytearray)):
+            return bytes(data)
+        if not any(issymbolic(c) for c in data):
+            return bytes(Operators.ORD(c) for c in data)
+        data_symbolic = constraints.new_array(index_bits=256, value_bits=8, index_max=len(data), name=name, avoid_collisions=True, default=0)
+        data_symbolic[0:len(data)] = data
+        return data_symbolic
+
     @property
     def bytecode(self):
         return self._bytecode
@@ -611,7 +925,6 @@ class EVM(Eventful):
     @constraints.setter
     def constraints(self, constraints):
         self._constraints = constraints
-        self.memory.constraints = constraints
 
     @property
     def gas(self):
@@ -638,7 +951,6 @@ class EVM(Eventful):
         state['_published_pre_instruction_events'] = self._published_pre_instruction_events
         state['_used_calldata_size'] = self._used_calldata_size
         state['_calldata_size'] = self._calldata_size
-        state['_valid_jumpdests'] = self._valid_jumpdests
         state['_check_jumpdest'] = self._check_jumpdest
         return state
 
@@ -662,7 +974,7 @@ class EVM(Eventful):
         self.suicides = state['suicides']
         self._used_calldata_size = state['_used_calldata_size']
         self._calldata_size = state['_calldata_size']
-        self._valid_jumpdests = state['_valid_jumpdests']
+        self._code_analysis = CodeAnalysis.get(self._bytecode)
         self._check_jumpdest = state['_check_jumpdest']
         super().__setstate__(state)
 
@@ -734,27 +1046,10 @@ class EVM(Eventful):
         #    return InvalidOpcode('Code out of range')
         # if self.pc in self.invalid:
         #    raise InvalidOpcode('Opcode inside a PUSH immediate')
-        try:
-            _decoding_cache = getattr(self, '_decoding_cache')
-        except Exception:
-            _decoding_cache = self._decoding_cache = {}
-
         pc = self.pc
         if isinstance(pc, Constant):
             pc = pc.value
-
-        if pc in _decoding_cache:
-            return _decoding_cache[pc]
-
-        def getcode():
-            bytecode = self.bytecode
-            for pc_i in range(pc, len(bytecode)):
-                yield simplify(bytecode[pc_i]).value
-            while True:
-                yield 0
-        instruction = EVMAsm.disassemble_one(getcode(), pc=pc, fork=DEFAULT_FORK)
-        _decoding_cache[pc] = instruction
-        return instruction
+        return self._code_analysis.instruction(pc)
 
     # auxiliary funcs
     # Stack related
@@ -799,9 +1094,16 @@ class EVM(Eventful):
         elif isinstance(fee, BitVec):
             if fee.size != 512:
                 raise ValueError("Fees should be 512 bit long")
+
+        # block: nothing to charge inside a basic block for static cost instructions
+        if consts.oog == 'block' and not issymbolic(fee) and fee == 0:
+            return
+
         # This configuration variable allows the user to control and perhaps relax the gas calculation
         # pedantic: gas is faithfully accounted and checked at instruction level. State may get forked in OOG/NoOOG
         # complete: gas is faithfully accounted and checked at basic blocks limits. State may get forked in OOG/NoOOG
+        # block: the static cost of a basic block is charged and checked at its first instruction. Only dynamic fees
+        #        (memory expansion, SSTORE, CALL...) are charged inside the block. State may get forked in OOG/NoOOG
         # concrete: Concretize gas. If the fee to be consumed gets to be symbolic. Choose some potential values and fork on those.
         # optimistic: Try not to OOG. If it may be enough gas we ignore the OOG case. A constraint is added to assert the gas is enough and the OOG state is ignored.
         # pesimistic: OOG soon. If it may NOT be enough gas we ignore the normal case. A constraint is added to assert the gas is NOT enough and the other state is ignored.
@@ -820,9 +1122,9 @@ class EVM(Eventful):
                 self._mgas = reps, m - fee
                 return
 
-        if consts.oog in ('pedantic', 'complete'):
+        if consts.oog in ('pedantic', 'complete', 'block'):
             # gas is faithfully accounted and ogg checked at instruction/BB level.
-            if consts.oog == 'pedantic' or self.instruction.is_terminator:
+            if consts.oog != 'complete' or self.instruction.is_terminator:
                 # explore both options / fork
 
                 # FIXME if gas can be both enough and insufficient this will
@@ -926,12 +1228,23 @@ class EVM(Eventful):
             assert instruction.pushes == 0
             assert result is None
 
+    def _static_fee(self):
+        """ Static part of the fee of the current instruction """
+        if consts.oog != 'block':
+            return self.instruction.fee
+        # The static fee of a whole basic block is paid at its first instruction.
+        # Jumps can only land on a JUMPDEST, which always starts a block
+        block = self._code_analysis.blocks.get(self.pc)
+        if block is None:
+            return 0
+        return block.gas
+
     def _calculate_gas(self, *arguments):
         current = self.instruction
         implementation = getattr(self, f"{current.semantics}_gas", None)
         if implementation is None:
-            return current.fee
-        return current.fee + implementation(*arguments)
+            return self._static_fee()
+        return self._static_fee() + implementation(*arguments)
 
     def _handler(self, *arguments):
         current = self.instruction
@@ -947,7 +1260,8 @@ class EVM(Eventful):
             if not self._published_pre_instruction_events:
                 self._published_pre_instruction_events = True
                 self._publish('will_decode_instruction', self.pc)
-                self._publish('will_evm_execute_instruction', self.instruction, self._top_arguments())
+                if self._has_subscribers('will_evm_execute_instruction'):
+                    self._publish('will_evm_execute_instruction', self.instruction, self._top_arguments())
 
             pc = self.pc
             instruction = self.instruction
@@ -1002,7 +1316,7 @@ class EVM(Eventful):
 
         if should_check_jumpdest:
             pc = self.pc.value if isinstance(self.pc, Constant) else self.pc
-            if pc not in self._valid_jumpdests:
+            if pc not in self._code_analysis.jumpdests:
                 raise InvalidOpcode()
 
     def _advance(self, result=None, exception=False):
@@ -1132,15 +1446,19 @@ class EVM(Eventful):
         except Exception:
             pass
 
-        for i in range(size):
-            self._publish('did_evm_read_memory', offset + i, Operators.EXTRACT(value, (size - i - 1) * 8, 8))
+        self._publish('did_evm_read_memory_word', offset, value, size)
+        if self._has_subscribers('did_evm_read_memory'):
+            for i in range(size):
+                self._publish('did_evm_read_memory', offset + i, Operators.EXTRACT(value, (size - i - 1) * 8, 8))
         return value
 
     def _store(self, offset, value, size=1):
         """Stores value in memory as a big endian"""
         self.memory.write_BE(offset, value, size)
-        for i in range(size):
-            self._publish('did_evm_write_memory', offset + i, Operators.EXTRACT(value, (size - i - 1) * 8, 8))
+        self._publish('did_evm_write_memory_word', offset, value, size)
+        if self._has_subscribers('did_evm_write_memory'):
+            for i in range(size):
+                self._publish('did_evm_write_memory', offset + i, Operators.EXTRACT(value, (size - i - 1) * 8, 8))
 
     def safe_add(self, a, b):
         a = Operators.ZEXTEND(a, 512)
@@ -1952,7 +2270,7 @@ class EVMWorld(Platform):
         super().__init__(path="NOPATH", **kwargs)
         self._world_state = {} if storage is None else storage
         self._constraints = constraints
-        self._callstack: List[Tuple[Transaction, List[EVMLog], Set[int], Union[bytearray, ArrayProxy], EVM]] = []
+        self._callstack: List[Tuple[Transaction, List[EVMLog], Set[int], EVMStorage, EVM]] = []
         self._deleted_accounts: Set[int] = set()
         self._logs: List[EVMLog] = list()
         self._pending_transaction = None
@@ -2089,6 +2407,45 @@ class EVMWorld(Platform):
         if self.depth == 0:
             raise TerminateState(tx.result)
 
+    def fingerprint(self, context=()):
+        """
+        A digest of the world state: nonce, balance, code and storage of every
+        account, the logs and the transactions results. Worlds with equal
+        fingerprints only differ in their constraints. Taints are part of the
+        values.
+
+        :param context: other values of the state to include (e.g. detectors state)
+        """
+        accounts = []
+        for address in sorted(self._world_state):
+            account = self._world_state[address]
+            accounts.append((address, account['nonce'], account['balance'],
+                             account['code'], account['storage'].fingerprint()))
+        logs = [(log.address, log.memlog, log.topics) for log in self._logs]
+        transactions = [(tx.sort, tx.address, tx.result) for tx in self.all_transactions]
+        world = _render(accounts, logs, transactions, sorted(self._deleted_accounts), context)
+        return sha3.keccak_256(world.encode()).hexdigest()
+
+    def world_hash(self, context=()):
+        """
+        A digest of the accounts (nonce, balance, code and storage) and of the
+        constraints on the variables they use, up to renaming of the
+        variables. Worlds with equal hashes behave the same way in any further
+        transaction, whatever their history. Taints are part of the values.
+
+        :param context: other values of the state to include (e.g. detectors state)
+        """
+        names = {}
+        accounts = []
+        for address in sorted(self._world_state):
+            account = self._world_state[address]
+            accounts.append((address, account['nonce'], account['balance'],
+                             account['code'], account['storage'].fingerprint(names)))
+        world = _render(accounts, sorted(self._deleted_accounts), context, names=names)
+        constraints = self.constraints.related_to(*names)
+        world += _render(constraints, names=names)
+        return sha3.keccak_256(world.encode()).hexdigest()
+
     @property
     def all_transactions(self):
         txs = tuple(self._transactions)
@@ -2201,7 +2558,7 @@ class EVMWorld(Platform):
         :return: the value
         :rtype: int or BitVec
         """
-        value = self._world_state[storage_address]['storage'].get(offset, 0)
+        value = self._world_state[storage_address]['storage'].get(offset)
         return simplify(value)
 
     def set_storage_data(self, storage_address, offset, value):
@@ -2224,13 +2581,7 @@ class EVMWorld(Platform):
         :return: all items in account storage. items are tuple of (index, value). value can be symbolic
         :rtype: list[(storage_index, storage_value)]
         """
-        storage = self._world_state[address]['storage']
-        items = []
-        array = storage.array
-        while not isinstance(array, ArrayVariable):
-            items.append((array.index, array.value))
-            array = array.array
-        return items
+        return self._world_state[address]['storage'].items()
 
     def has_storage(self, address):
         """
@@ -2238,13 +2589,7 @@ class EVMWorld(Platform):
         Note that if a slot has been erased from the storage this function may
         lose any meaning.
         """
-        storage = self._world_state[address]['storage']
-        array = storage.array
-        while not isinstance(array, ArrayVariable):
-            if isinstance(array, ArrayStore):
-                return True
-            array = array.array
-        return False
+        return self._world_state[address]['storage'].is_written()
 
     def get_storage(self, address):
         """
@@ -2252,7 +2597,7 @@ class EVMWorld(Platform):
 
         :param address: account address
         :return: account storage
-        :rtype: bytearray or ArrayProxy
+        :rtype: EVMStorage
         """
         return self._world_state[address]['storage']
 
@@ -2425,7 +2770,7 @@ class EVMWorld(Platform):
         :param address: the address of the account, if known. If omitted, a new address will be generated as closely to the Yellow Paper as possible.
         :param balance: the initial balance of the account in Wei
         :param code: the runtime code of the account, if a contract
-        :param storage: storage array
+        :param storage: initial storage, an ArrayProxy or a dict of 256 bits keys to 256 bits values
         :param nonce: the nonce for the account; contracts should have a nonce greater than or equal to 1
         """
         if code is None:
@@ -2451,17 +2796,17 @@ class EVMWorld(Platform):
             # selfdestructed address, it can not be reused
             raise EthereumError('The account already exists')
 
-        if storage is None:
-            # Uninitialized values in a storage are 0 by spec
-            storage = self.constraints.new_array(index_bits=256, value_bits=256, name=f'STORAGE_{address:x}', avoid_collisions=True, default=0)
-        else:
-            if isinstance(storage, ArrayProxy):
-                if storage.index_bits != 256 or storage.value_bits != 256:
-                    raise TypeError("An ArrayProxy 256bits -> 256bits is needed")
-            else:
-                if any((k < 0 or k >= 1 << 256 for k, v in storage.items())):
-                    raise TypeError("Need a dict like object that maps 256 bits keys to 256 bits values")
+        if isinstance(storage, ArrayProxy):
+            if storage.index_bits != 256 or storage.value_bits != 256:
+                raise TypeError("An ArrayProxy 256bits -> 256bits is needed")
+            storage = EVMStorage(storage)
+        elif not isinstance(storage, EVMStorage):
+            if storage is not None and any((k < 0 or k >= 1 << 256 for k, v in storage.items())):
+                raise TypeError("Need a dict like object that maps 256 bits keys to 256 bits values")
             # Hopefully here we have a mapping from 256b to 256b
+            # Uninitialized values in a storage are 0 by spec
+            array = self.constraints.new_array(index_bits=256, value_bits=256, name=f'STORAGE_{address:x}', avoid_collisions=True, default=0)
+            storage = EVMStorage(array, storage)
 
         self._world_state[address] = {}
         self._world_state[address]['nonce'] = nonce
@@ -2659,18 +3004,18 @@ class EVMWorld(Platform):
         stream.write("%d accounts.\n" % len(blockchain.accounts))
         for account_address in blockchain.accounts:
             is_account_address_symbolic = issymbolic(account_address)
-            account_address = state.solve_one(account_address)
+            account_address = state.solve_one(account_address, constrain=True)
 
             stream.write("* %s::\n" % mevm.account_name(account_address))
             stream.write("Address: 0x%x %s\n" % (account_address, flagged(is_account_address_symbolic)))
             balance = blockchain.get_balance(account_address)
             is_balance_symbolic = issymbolic(balance)
             is_something_symbolic = is_something_symbolic or is_balance_symbolic
-            balance = state.solve_one(balance)
+            balance = state.solve_one(balance, constrain=True)
             stream.write("Balance: %d %s\n" % (balance, flagged(is_balance_symbolic)))
 
             storage = blockchain.get_storage(account_address)
-            stream.write("Storage: %s\n" % translate_to_smtlib(storage, use_bindings=True))
+            stream.write("Storage: %s\n" % translate_to_smtlib(storage.array, use_bindings=True))
 
             all_used_indexes = []
             with state.constraints as temp_cs:
@@ -2693,9 +3038,9 @@ class EVMWorld(Platform):
                 for i in all_used_indexes:
                     value = storage.get(i)
                     is_storage_symbolic = issymbolic(value)
-                    stream.write("storage[%x] = %x %s\n" % (state.solve_one(i), state.solve_one(value), flagged(is_storage_symbolic)))
+                    stream.write("storage[%x] = %x %s\n" % (state.solve_one(i, constrain=True), state.solve_one(value, constrain=True), flagged(is_storage_symbolic)))
 
-            runtime_code = state.solve_one(blockchain.get_code(account_address))
+            runtime_code = state.solve_one(blockchain.get_code(account_address), constrain=True)
             if runtime_code:
                 stream.write("Code:\n")
                 fcode = io.BytesIO(runtime_code)
@@ -2710,6 +3055,62 @@ class EVMWorld(Platform):
 _FILTER = ''.join((len(repr(chr(x))) == 3) and chr(x) or '.' for x in range(256))
 
 
+class _CanonicalTranslator(TranslatorSmtlib):
+    """
+    Renders the taints of every expression. If names is not None the
+    variables are named in the order they are found
+    """
+
+    def __init__(self, names=None, **kwargs):
+        super().__init__(**kwargs)
+        self._names = names
+
+    def _method(self, expression, *args):
+        result = super()._method(expression, *args)
+        if expression.taint:
+            result = '%s{%s}' % (result, ' '.join(sorted(map(str, expression.taint))))
+        return result
+
+    def visit_Variable(self, expression):
+        if self._names is None:
+            return expression.name
+        name = self._names.get(expression)
+        if name is None:
+            name = self._names[expression] = f'v{len(self._names)}'
+        return name
+
+
+def _render(*values, names=None):
+    """
+    Canonical text for nested sequences, sets and dicts of ints, strings,
+    bytes and expressions. Expressions are rendered by structure and taints,
+    not by identity, so it can compare values coming from different loaded
+    states.
+
+    If names is a dict, variables are renamed in the order they are found and
+    names is updated with the variable -> name mapping.
+    """
+    result = []
+    for value in values:
+        if isinstance(value, ArrayProxy):
+            value = value.array
+        if isinstance(value, Expression):
+            translator = _CanonicalTranslator(names)
+            translator.visit(value)
+            result.append(translator.result)
+        elif isinstance(value, (bytes, bytearray)):
+            result.append(binascii.hexlify(value).decode())
+        elif isinstance(value, (tuple, list)):
+            result.append('(%s)' % _render(*value, names=names))
+        elif isinstance(value, (set, frozenset, dict)):
+            # Unordered, sorted by their text without renaming
+            items = value.items() if isinstance(value, dict) else value
+            result.append('{%s}' % _render(*sorted(items, key=_render), names=names))
+        else:
+            result.append(repr(value))
+    return ' '.join(result)
+
+
 def _hexdump(src, length=16):
     lines = []
     for c in range(0, len(src), length):
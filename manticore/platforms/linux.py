@@ -2951,6 +2951,12 @@ class SLinux(Linux):
         return super().sys_getrandom(buf, size, flags)
 
     def generate_workspace_files(self):
+        with self.constraints as temp_cs:
+            return self._generate_workspace_files(temp_cs)
+
+    def _generate_workspace_files(self, constraints):
+        solver = Z3Solver.instance()
+
         def solve_to_fd(data, fd):
             def make_chr(c):
                 if isinstance(c, int):
@@ -2961,10 +2967,14 @@ class SLinux(Linux):
             try:
                 for c in data:
                     if issymbolic(c):
-                        c = Z3Solver().get_value(self.constraints, c)
+                        value = solver.get_value(constraints, c)
+                        # Pin every solved byte so all the generated files
+                        # come from the same model
+                        constraints.add(c == value)
+                        c = value
                     fd.write(make_chr(c))
             except SolverError:
-                fd.write('{SolverError}')
+                fd.write(b'{SolverError}')
 
         out = io.BytesIO()
         inn = io.BytesIO()
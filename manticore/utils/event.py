@@ -1,6 +1,7 @@
 import copy
 import inspect
 import logging
+from collections import Counter
 from itertools import takewhile
 from weakref import WeakKeyDictionary, ref
 
@@ -52,8 +53,10 @@ class Eventful(object, metaclass=EventsGatherMetaclass):
     # Maps an Eventful subclass with a set of all the events it publishes.
     __all_events__ = dict()
 
-    # Set of subscribed events - used as an optimization to only publish events that someone subscribes to
-    __sub_events__ = set()
+    # Bumped whenever a subscription or a forward changes anywhere, so each
+    # object recomputes the events subscribed to downstream of it (see
+    # _subscribed_events)
+    __sub_generation__ = 0
 
     # Set in subclass to advertise the events it plans to publish
     _published_events = set()
@@ -77,14 +80,26 @@ class Eventful(object, metaclass=EventsGatherMetaclass):
         self._signals = dict()
         # a set of sink eventful objects (see forward_events_from())
         self._forwards = WeakKeyDictionary()
+        self._init_sub_events()
         super().__init__()
 
     def __setstate__(self, state):
         """It wont get serialized by design, user is responsible to reconnect"""
         self._signals = dict()
         self._forwards = WeakKeyDictionary()
+        self._init_sub_events()
         return True
 
+    def _init_sub_events(self):
+        # Number of live subscriptions to each event made on this object - used
+        # as an optimization to only publish events that someone subscribes to
+        # here or where they are forwarded. Subscriptions are dropped when the
+        # subscriber is collected or unsubscribes, so the events of a finished
+        # analysis do not keep being published
+        self._sub_events = Counter()
+        self._sub_cache = frozenset()
+        self._sub_cache_generation = -1
+
     def __getstate__(self):
         return {}
 
@@ -97,11 +112,32 @@ class Eventful(object, metaclass=EventsGatherMetaclass):
         for name, bucket in self._signals.items():
             if robj in bucket:
                 del bucket[robj]
+                self._drop_subscription(name)
             if len(bucket) == 0:
                 remove.add(name)
         for name in remove:
             del self._signals[name]
 
+    def _drop_subscription(self, name):
+        sub_events = self._sub_events
+        sub_events[name] -= 1
+        if sub_events[name] <= 0:
+            del sub_events[name]
+        Eventful.__sub_generation__ += 1
+
+    def _subscribed_events(self):
+        """
+        The events subscribed to on this object or on the objects its events
+        are forwarded to (i.e. its manticore)
+        """
+        if self._sub_cache_generation != Eventful.__sub_generation__:
+            events = set(self._sub_events)
+            for sink in tuple(self._forwards):
+                events.update(sink._subscribed_events())
+            self._sub_cache = frozenset(events)
+            self._sub_cache_generation = Eventful.__sub_generation__
+        return self._sub_cache
+
     def _get_signal_bucket(self, name):
         # Each event name has a bucket of callback methods
         # A bucket is a dictionary obj -> set(method1, method2...)
@@ -122,10 +158,17 @@ class Eventful(object, metaclass=EventsGatherMetaclass):
     # The underscore _name is to avoid naming collisions with callback params
     def _publish(self, _name, *args, **kwargs):
         # only publish if there is at least one subscriber
-        if _name in self.__sub_events__:
+        if _name in self._subscribed_events():
             self._check_event(_name)
             self._publish_impl(_name, *args, **kwargs)
 
+    def _has_subscribers(self, _name):
+        """
+        True if some object subscribed to the event. Publishers check it to
+        avoid building expensive arguments for events nobody listens to
+        """
+        return _name in self._subscribed_events()
+
     # Separate from _publish since the recursive method call to forward an event
     # shouldn't check the event.
     def _publish_impl(self, _name, *args, **kwargs):
@@ -148,8 +191,25 @@ class Eventful(object, metaclass=EventsGatherMetaclass):
         obj, callback = method.__self__, method.__func__
         bucket = self._get_signal_bucket(name)
         robj = ref(obj, self._unref)  # see unref() for explanation
+        if robj not in bucket:
+            self._sub_events[name] += 1
+            Eventful.__sub_generation__ += 1
         bucket.setdefault(robj, set()).add(callback)
-        self.__sub_events__.add(name)
+
+    def unsubscribe(self, name, method):
+        assert inspect.ismethod(method), f'{method.__class__.__name__} is not a method'
+        obj, callback = method.__self__, method.__func__
+        bucket = self._signals.get(name, {})
+        robj = ref(obj)
+        methods = bucket.get(robj)
+        if methods is None or callback not in methods:
+            return
+        methods.remove(callback)
+        if not methods:
+            del bucket[robj]
+            self._drop_subscription(name)
+        if not bucket:
+            del self._signals[name]
 
     def forward_events_from(self, source, include_source=False):
         assert isinstance(source, Eventful), f'{source.__class__.__name__} is not Eventful'
@@ -159,7 +219,18 @@ class Eventful(object, metaclass=EventsGatherMetaclass):
         """This forwards signal to sink"""
         assert isinstance(sink, Eventful), f'{sink.__class__.__name__} is not Eventful'
         self._forwards[sink] = include_source
+        Eventful.__sub_generation__ += 1
 
     def copy_eventful_state(self, new_object: 'Eventful'):
         new_object._forwards = copy.copy(self._forwards)
-        new_object._signals = copy.copy(self._signals)
+        # The copy counts its own subscriptions, and drops them itself when
+        # the subscribers are collected
+        new_object._signals = dict()
+        new_object._sub_events = Counter()
+        for name, bucket in self._signals.items():
+            for robj, methods in bucket.items():
+                obj = robj()
+                if obj is not None:
+                    new_object._signals.setdefault(name, dict())[ref(obj, new_object._unref)] = set(methods)
+                    new_object._sub_events[name] += 1
+        Eventful.__sub_generation__ += 1
@@ -1,3 +1,5 @@
+import hashlib
+import io
 import logging
 import pickle
 import sys
@@ -72,11 +74,13 @@ def taint_with(arg, taint, value_bits=256, index_bits=256):
 
     if not issymbolic(arg):
         if isinstance(arg, int):
-            arg = BitVecConstant(value_bits, arg)
-            arg._taint = tainted_fset
+            arg = BitVecConstant(value_bits, arg, taint=tainted_fset)
         else:
             raise ValueError("type not supported")
 
+    elif arg._hash_consed:
+        # Shared expression, build a new one
+        arg = arg._replace(_taint=arg.taint | tainted_fset)
     else:
         arg = copy.copy(arg)
         arg._taint |= tainted_fset
@@ -130,6 +134,28 @@ class CacheDict(OrderedDict):
         self._hits -= purge_count
 
 
+class Page:
+    """
+    A chunk of data identified by the digest of its content. A
+    :class:`~manticore.core.workspace.Store` saves each distinct page once and
+    the states reference it. Pickled on its own a page copies its data.
+    """
+    __slots__ = ('data', 'digest')
+
+    def __init__(self, data, digest=None):
+        """
+        :param data: a bytes-like object that must not change while the page is in use
+        :param digest: the digest of data if it is already known
+        """
+        self.data = data
+        if digest is None:
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        self.digest = digest
+
+    def __reduce__(self):
+        return (self.__class__, (bytes(self.data), self.digest))
+
+
 class StateSerializer:
     """
     StateSerializer can serialize and deserialize :class:`~manticore.core.state.State` objects from and to
@@ -139,10 +165,10 @@ class StateSerializer:
     def __init__(self):
         pass
 
-    def serialize(self, state, f):
+    def serialize(self, state, f, persistent_id=None):
         raise NotImplementedError
 
-    def deserialize(self, f):
+    def deserialize(self, f, persistent_load=None):
         raise NotImplementedError
 
 
@@ -154,16 +180,28 @@ class PickleSerializer(StateSerializer):
         super().__init__()
         sys.setrecursionlimit(PickleSerializer.DEFAULT_RECURSION)
 
-    def serialize(self, state, f):
+    def serialize(self, state, f, persistent_id=None):
+        """
+        :param persistent_id: optional function returning a reference for
+                              objects stored out of band (see `pickle.Pickler.persistent_id`)
+        """
         try:
-            f.write(pickle.dumps(state, 2))
+            buf = io.BytesIO()
+            pickler = pickle.Pickler(buf, 2)
+            if persistent_id is not None:
+                pickler.persistent_id = persistent_id
+            pickler.dump(state)
+            f.write(buf.getvalue())
         except RuntimeError:
             new_limit = sys.getrecursionlimit() * 2
             if new_limit > PickleSerializer.MAX_RECURSION:
                 raise Exception(f'PickleSerializer recursion limit surpassed {PickleSerializer.MAX_RECURSION}, aborting')
             logger.info(f'Recursion soft limit {sys.getrecursionlimit()} hit, increasing')
             sys.setrecursionlimit(new_limit)
-            self.serialize(state, f)
+            self.serialize(state, f, persistent_id)
 
-    def deserialize(self, f):
-        return pickle.load(f)
+    def deserialize(self, f, persistent_load=None):
+        unpickler = pickle.Unpickler(f)
+        if persistent_load is not None:
+            unpickler.persistent_load = persistent_load
+        return unpickler.load()
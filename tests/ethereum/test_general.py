@@ -4,25 +4,29 @@ from contextlib import contextmanager
 from pathlib import Path
 
 import os
+import pickle
 import pyevmasm as EVMAsm
 import re
+import sha3
 import shutil
 import struct
 import tempfile
 
 from manticore.core.plugin import Plugin
-from manticore.core.smtlib import ConstraintSet, operators
+from manticore.core.smtlib import ConstraintSet, operators, Operators
 from manticore.core.smtlib import Z3Solver
 from manticore.core.smtlib.expression import BitVec
 from manticore.core.smtlib.visitors import to_constant
 from manticore.core.state import TerminateState
 from manticore.ethereum import ManticoreEVM, State, DetectExternalCallAndLeak, DetectIntegerOverflow, Detector, \
-    NoAliveStates, ABI, EthereumError, EVMContract
+    DetectUninitializedMemory, NoAliveStates, ABI, EthereumError, EVMContract
 from manticore.ethereum.plugins import FilterFunctions
-from manticore.ethereum.solidity import SolidityMetadata
+from manticore.ethereum.solidity import SolidityMetadata, SourceMap
 from manticore.platforms import evm
 from manticore.platforms.evm import EVMWorld, ConcretizeArgument, concretized_args, Return, Stop
+from manticore.utils import config
 from manticore.utils.deprecated import ManticoreDeprecationWarning
+from manticore.utils.helpers import taint_with
 
 solver = Z3Solver.instance()
 
@@ -407,6 +411,70 @@ class EthInstructionTests(unittest.TestCase):
         result = vm.SDIV(xx, yy)
         self.assertListEqual(list(map(evm.to_signed, solver.get_all_values(constraints, result))), [vm.SDIV(x, y)])
 
+    def test_code_analysis(self):
+        # PUSH1 4; JUMP; STOP; JUMPDEST; PUSH1 0; DUP1; RETURN
+        bytecode = bytes.fromhex('600456005b600080f3')
+        analysis = evm.CodeAnalysis.get(bytecode)
+        self.assertIs(evm.CodeAnalysis.get(bytes(bytecode)), analysis)
+        self.assertEqual(analysis.jumpdests, {4})
+        self.assertEqual(sorted(analysis.blocks), [0, 3, 4])
+        self.assertEqual(analysis.blocks[0], evm.BasicBlock(0, 2, 3 + 8))
+        self.assertEqual(analysis.blocks[4], evm.BasicBlock(4, 8, 1 + 3 + 3 + 0))
+        self.assertEqual(analysis.instruction(5).name, 'PUSH1')
+
+    def test_storage(self):
+        constraints, world, vm = self._make()
+        world.create_account(0x10, storage={1: 5})
+        self.assertTrue(world.has_storage(0x10))
+        self.assertEqual(world.get_storage_data(0x10, 1), 5)
+        self.assertEqual(world.get_storage_data(0x10, 2), 0)
+
+        key = constraints.new_bitvec(256, name='key')
+        world.set_storage_data(0x10, key, 7)
+        world.set_storage_data(0x10, 3, 9)
+        # A later concrete write is not aliased by the symbolic one
+        self.assertEqual(world.get_storage_data(0x10, 3), 9)
+        self.assertListEqual(sorted(solver.get_all_values(constraints, world.get_storage_data(0x10, 1))), [5, 7])
+        self.assertListEqual(sorted(solver.get_all_values(constraints, world.get_storage_data(0x10, key))), [7, 9])
+        self.assertEqual(world.get_storage_items(0x10), [(3, 9), (key, 7), (1, 5)])
+
+    def test_block_gas(self):
+        # PUSH1 4; JUMP; STOP; JUMPDEST; PUSH1 0; DUP1; RETURN
+        bytecode = bytes.fromhex('600456005b600080f3')
+        oog = evm.consts.oog
+        evm.consts.oog = 'block'
+        try:
+            vm = evm.EVM(ConstraintSet(), 0x222222222222222222222222222222222222200, b'', 0x111111111111111111111111111111111111100, 0, bytecode, gas=100)
+            gas = []
+            with self.assertRaises(evm.EndTx):
+                while True:
+                    vm.execute()
+                    gas.append(vm.gas)
+            # The whole block is paid at its first instruction
+            self.assertEqual(gas, [89, 89, 82, 82, 82])
+        finally:
+            evm.consts.oog = oog
+
+    def test_memory(self):
+        constraints, world, vm = self._make()
+        self.assertIsInstance(vm.data, bytes)
+        vm.MSTORE(0x20, 0x1122)
+        self.assertEqual(vm.MLOAD(0x21), 0x112200)
+        self.assertEqual(vm.read_buffer(0x3e, 4), b'\x11\x22\x00\x00')
+
+        # Symbolic values at concrete offsets keep the memory concrete
+        x = constraints.new_bitvec(256, name='x')
+        vm.MSTORE(0, x)
+        self.assertFalse(vm.memory.is_symbolic)
+        self.assertListEqual(solver.get_all_values(constraints, vm.MLOAD(0) == x), [True])
+
+        # A symbolic offset switches to a symbolic array
+        offset = constraints.new_bitvec(256, name='offset')
+        constraints.add(offset == 0x20)
+        self.assertListEqual(solver.get_all_values(constraints, vm.MLOAD(offset)), [0x1122])
+        self.assertTrue(vm.memory.is_symbolic)
+        self.assertListEqual(solver.get_all_values(constraints, vm.MLOAD(0) == x), [True])
+
 
 class EthTests(unittest.TestCase):
     def setUp(self):
@@ -417,6 +485,141 @@ class EthTests(unittest.TestCase):
         del self.mevm
         shutil.rmtree(workspace)
 
+    def test_finalize(self):
+        owner = self.mevm.create_account(balance=10**18)
+        # Returns if the first calldata word is not 0, stops otherwise
+        runtime = bytes.fromhex('600035600757005b60006000f3')
+        init = bytes.fromhex('600d600c600039600d6000f3') + runtime
+        contract = self.mevm.create_contract(owner=owner, init=init)
+        self.mevm.transaction(caller=owner, address=contract, value=0, data=self.mevm.make_symbolic_buffer(32))
+        self.assertEqual(self.mevm.count_states(), 2)
+        self.assertEqual(self.mevm.global_coverage(contract), 100.0)
+
+        self.mevm.finalize(procs=4)
+        files = os.listdir(self.mevm.workspace)
+        self.assertEqual(len([f for f in files if f.endswith('.tx')]), 2)
+        with open(os.path.join(self.mevm.workspace, 'global.summary')) as summary:
+            self.assertIn(f'{int(contract):x}: 100.00%', summary.read())
+
+    def test_merge_states(self):
+        owner = self.mevm.create_account(balance=10**18)
+        # Stops on both branches of a condition on the first calldata word
+        runtime = bytes.fromhex('600035600757005b00')
+        init = bytes.fromhex('6009600c60003960096000f3') + runtime
+        contract = self.mevm.create_contract(owner=owner, init=init)
+        cfg = config.get_group('evm')
+        cfg.merge_states = True
+        try:
+            for _ in range(2):
+                self.mevm.transaction(caller=owner, address=contract, value=0, data=self.mevm.make_symbolic_buffer(32))
+                self.assertEqual(self.mevm.count_states(), 1)
+        finally:
+            cfg.merge_states = False
+
+        # The merged state still allows both paths
+        state = next(self.mevm.ready_states)
+        word = Operators.CONCAT(256, *state.platform.transactions[-1].data)
+        self.assertTrue(state.can_be_true(word == 0))
+        self.assertTrue(state.can_be_true(word != 0))
+
+    def test_detectors_context(self):
+        self.mevm.register_detector(DetectIntegerOverflow())
+        state = next(self.mevm.ready_states)
+        state.context.update({'DetectIntegerOverflow.findings': [],
+                              'DetectIntegerOverflow.locations': {'a': 1},
+                              'evm.trace': [1]})
+        self.assertEqual(self.mevm._detectors_context(state), [('DetectIntegerOverflow.locations', {'a': 1})])
+
+    def test_skip_duplicate_states(self):
+        owner = self.mevm.create_account(balance=10**18)
+        # Stops on both branches of a condition on the first calldata word
+        runtime = bytes.fromhex('600035600757005b00')
+        init = bytes.fromhex('6009600c60003960096000f3') + runtime
+        contract = self.mevm.create_contract(owner=owner, init=init)
+        cfg = config.get_group('evm')
+        cfg.skip_duplicate_states = True
+        try:
+            for _ in range(2):
+                self.mevm.transaction(caller=owner, address=contract, value=0, data=self.mevm.make_symbolic_buffer(32))
+                self.assertEqual(self.mevm.count_ready_states(), 1)
+        finally:
+            cfg.skip_duplicate_states = False
+        # The duplicate is still there for the testcases
+        self.assertEqual(self.mevm.count_terminated_states(), 2)
+
+    def test_fingerprint(self):
+        worlds = []
+        for taint in ('A', 'B'):
+            world = evm.EVMWorld(ConstraintSet())
+            world.create_account(address=0x1000, balance=10, code=b'\x00')
+            world.set_storage_data(0x1000, 0, taint_with(7, taint))
+            worlds.append(world)
+        world, other = worlds
+        # Values that only differ in their taints
+        self.assertNotEqual(world.fingerprint(), other.fingerprint())
+        self.assertEqual(world.fingerprint([('D.locations', {2, 1})]), world.fingerprint([('D.locations', {1, 2})]))
+        self.assertNotEqual(world.fingerprint([('D.locations', {1})]), world.fingerprint())
+
+    def test_world_hash(self):
+        world = evm.EVMWorld(ConstraintSet())
+        other = evm.EVMWorld(ConstraintSet())
+        for w, name in ((world, 'X'), (other, 'Y')):
+            value = w.constraints.new_bitvec(256, name=name)
+            w.constraints.add(value > 5)
+            w.create_account(address=0x1000, balance=10, code=b'\x00')
+            w.set_storage_data(0x1000, 0, value)
+        # Same world up to variable names
+        self.assertEqual(world.world_hash(), other.world_hash())
+        other.constraints.add(other.get_storage_data(0x1000, 0) > 6)
+        self.assertNotEqual(world.world_hash(), other.world_hash())
+        other.set_balance(0x1000, 11)
+        world.set_balance(0x1000, 11)
+        self.assertNotEqual(world.world_hash(), other.world_hash())
+
+        # Taints and detectors state are part of the hash
+        world = evm.EVMWorld(ConstraintSet())
+        world.create_account(address=0x1000, balance=10, code=b'\x00')
+        world.set_storage_data(0x1000, 0, taint_with(7, 'A'))
+        before = world.world_hash()
+        world.set_storage_data(0x1000, 0, taint_with(7, 'B'))
+        self.assertNotEqual(world.world_hash(), before)
+        self.assertNotEqual(world.world_hash([('D.findings', [(0x1000, 0)])]), world.world_hash())
+
+    def test_uninitialized_memory_words(self):
+        detector = DetectUninitializedMemory()
+        self.mevm.register_detector(detector)
+        owner = self.mevm.create_account(balance=10**18)
+        # MSTORE at 0, MLOAD at 0 and MLOAD at 16
+        runtime = bytes.fromhex('60016000526000515060105100')
+        init = bytes.fromhex('600d600c600039600d6000f3') + runtime
+        contract = self.mevm.create_contract(owner=owner, init=init)
+        self.mevm.transaction(caller=owner, address=contract, value=0, data=b'')
+        self.mevm.finalize()
+        findings = [finding for address, pc, finding, at_init in self.mevm.global_findings if not at_init]
+        # Only the 16 bytes past the stored word
+        self.assertEqual(len(findings), 16)
+        self.assertTrue(all(int(f.split('offset ')[1][:-1]) >= 32 for f in findings))
+
+        self.mevm.unregister_detector(detector)
+        self.assertFalse(self.mevm._has_subscribers('did_evm_read_memory_word'))
+
+    def test_sha3_known_hashes(self):
+        state = next(iter(self.mevm.all_states))
+        data = state.constraints.new_array(index_max=4, name='DATA')
+        data[0] = 1
+        for buf in (b'\x01abc', b'\x01abd', b'\x02abc', b'\x01ab'):
+            self.mevm._on_concrete_sha3_callback(state, buf, int(sha3.keccak_256(buf).hexdigest(), 16))
+        # Only the same length pairs matching the concrete first byte
+        self.assertListEqual(sorted(self.mevm._known_sha3.candidates(data)),
+                             sorted((buf, int(sha3.keccak_256(buf).hexdigest(), 16)) for buf in (b'\x01abc', b'\x01abd')))
+
+        known_hashes = {}
+        self.mevm._on_symbolic_sha3_callback(state, data, known_hashes)
+        # Both candidates and a new example
+        self.assertEqual(len(known_hashes), 3)
+        self.assertEqual(len(self.mevm._known_sha3), 5)
+        self.assertTrue(state.must_be_true(Operators.OR(*(data == buf for buf in known_hashes))))
+
     def test_solidity_create_contract_no_args(self):
         source_code = 'contract A { constructor() {} }'
         owner = self.mevm.create_account()
@@ -1261,6 +1464,19 @@ class EthSolidityMetadataTests(unittest.TestCase):
                              ]}]),
                          '((uint256,uint256[])[2],((string),string,(uint256,uint256[2])[]))')
 
+    def test_source_map(self):
+        source_code = 'line1\nline2\nline3 abc\n'
+        # PUSH1 1 PUSH1 2 ADD
+        bytecode = bytes.fromhex('6001600201')
+        srcmap = ['0:5:0:-', '6:5', '12:3::i']
+        md = SolidityMetadata('C', source_code, bytecode, bytecode, srcmap, srcmap, {}, [], '')
+        self.assertEqual(dict(md.get_srcmap()), {0: (0, 5, 0, '-'), 2: (6, 5, 0, '-'), 4: (12, 3, 0, 'i')})
+        self.assertEqual(md.get_source_for(2), '    2  line2\n')
+        self.assertEqual(md.get_source_for(4, runtime=False), '    3  lin\n')
+        self.assertEqual(md.get_source_for(1), '')
+        self.assertEqual(md.get_source_for(100), '')
+        self.assertIsInstance(pickle.loads(pickle.dumps(md)).get_srcmap(), SourceMap)
+
     def test_abi_constructor_and_fallback_items(self):
         with disposable_mevm() as m:
             source_code = '''
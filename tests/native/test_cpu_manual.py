@@ -475,6 +475,32 @@ class SymCPUTest(unittest.TestCase):
             self.assertEqual(mem[i+0x1000], b'HGFEXWVUhgfedcba'[i:i+1])
         self.assertEqual(mem.read(0x1000,0x10), to_bytelist(b'HGFEXWVUhgfedcba'))
 
+    def test_write_bytes_events(self):
+        mem = SMemory64(ConstraintSet())
+        cpu = AMD64Cpu(mem)
+        mem.mmap(0x1000, 0x1000, 'rwx')
+        seen = []
+
+        class Listener:
+            def will_write(self, where, value, size):
+                seen.append(('will', where, mem[where]))
+
+            def did_write(self, where, value, size):
+                seen.append(('did', where, mem[where]))
+
+        listener = Listener()
+        cpu.subscribe('will_write_memory', listener.will_write)
+        cpu.subscribe('did_write_memory', listener.did_write)
+        try:
+            cpu.write_bytes(0x1000, b'AB')
+        finally:
+            cpu.unsubscribe('will_write_memory', listener.will_write)
+            cpu.unsubscribe('did_write_memory', listener.did_write)
+
+        # Each byte is written between its own events
+        self.assertEqual(seen, [('will', 0x1000, b'\x00'), ('did', 0x1000, b'A'),
+                                ('will', 0x1001, b'\x00'), ('did', 0x1001, b'B')])
+
     def test_cache_002(self):
         cs = ConstraintSet()
         mem = SMemory64(cs)
@@ -881,6 +907,28 @@ class SymCPUTest(unittest.TestCase):
         self.assertEqual(cpu.EBP, 0xffffb600)
         self.assertEqual(cpu.ESP, 0xffffc600)
 
+    def test_lazy_flags(self):
+        ''' Flags of arithmetic instructions are only computed when read
+            0x41e000:	add	rax, rbx
+            0x41e003:	cmp	rax, rbx
+        '''
+        mem = Memory64()
+        cpu = AMD64Cpu(mem)
+        mem.mmap(0x0041e000, 0x1000, 'rwx')
+        mem[0x0041e000:0x0041e006] = b'\x48\x01\xd8\x48\x39\xd8'
+        cpu.RIP = 0x41e000
+        cpu.RAX = 0xffffffffffffffff
+        cpu.RBX = 1
+        cpu.execute()
+        self.assertEqual(set(cpu.regfile._lazy_flags), {'CF', 'AF', 'ZF', 'SF', 'OF', 'PF'})
+        self.assertEqual(cpu.RAX, 0)
+        self.assertEqual((cpu.CF, cpu.ZF, cpu.SF, cpu.OF), (True, True, False, False))
+        self.assertEqual(set(cpu.regfile._lazy_flags), {'AF', 'PF'})
+
+        cpu.execute()
+        self.assertEqual(cpu.EFLAGS, 0x95)
+        self.assertFalse(cpu.regfile._lazy_flags)
+
     def test_XLATB_1(self):
         ''' Instruction XLATB_1
             Groups:
@@ -221,6 +221,26 @@ class LazyMemoryTest(unittest.TestCase):
         ret = mem._deref_can_succeed(m, 0x1000, 0x1000);
         self.assertFalse(ret)
 
+    def test_stacked_maps(self):
+        mem = LazySMemory32(ConstraintSet())
+        mem.mmap(0x1000, 0x3000, 'rwx')
+        mem.write(0x1000, b'A')
+        mem.write(0x3000, b'B')
+
+        # A smaller file map stacked at the same start hides only what it covers
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'C')
+            f.flush()
+            mem.mmapFile(0x1000, 0x1000, 'r', f.name)
+
+        self.assertEqual(mem[0x1000], b'C')
+        self.assertEqual(mem.perms(0x1000), 'r')
+        self.assertEqual(mem[0x3000], b'B')
+        self.assertEqual(mem.perms(0x3000), 'rwx')
+        self.assertIn(0x2000, mem)
+        self.assertEqual(len(mem._overlapping(0x2000, 0x2001)), 1)
+        self.assertNotEqual(mem._search(0x1000, 0x2000), 0x2000)
+
     @unittest.skip("Disabled because it takes 4+ minutes; get_all_values() isn't returning all possible addresses")
     def test_lazysymbolic_constrained_deref(self):
         cs = ConstraintSet()
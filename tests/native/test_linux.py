@@ -8,9 +8,12 @@ import os
 import shutil
 import tempfile
 
+import capstone as cs
+
 from manticore.native.cpu.abstractcpu import ConcretizeRegister
+from manticore.native.cpu.disasm import CapstoneDisasm
 from manticore.core.smtlib.solver import Z3Solver
-from manticore.core.smtlib import BitVecVariable, issymbolic
+from manticore.core.smtlib import BitVecVariable, Operators, issymbolic
 from manticore.native import Manticore
 from manticore.platforms import linux, linux_syscalls
 
@@ -77,6 +80,71 @@ class LinuxTest(unittest.TestCase):
         self.assertEqual(first_map_name, 'basic_linux_amd64')
         self.assertEqual(second_map_name, 'basic_linux_amd64')
 
+    def test_decode_cache(self):
+        cpu = self.linux.current
+        pc = cpu.PC
+        insn = cpu.decode_instruction(pc)
+        decoded = len(CapstoneDisasm._decoded)
+
+        # A reloaded cpu reuses the instructions decoded by any other cpu
+        loaded = pickle.loads(pickle.dumps(self.linux)).current
+        reloaded = loaded.decode_instruction(pc)
+        self.assertEqual(len(CapstoneDisasm._decoded), decoded)
+        self.assertEqual((reloaded.mnemonic, reloaded.op_str), (insn.mnemonic, insn.op_str))
+        self.assertIs(reloaded.operands[0].cpu, loaded)
+        self.assertIs(insn.operands[0].cpu, cpu)
+
+        # Writing over the code drops the instructions it overlaps
+        cpu.write_bytes(pc + 1, b'\x90', force=True)
+        self.assertNotIn(pc, cpu._instruction_cache)
+        cpu.write_bytes(pc, b'\x90', force=True)
+        self.assertEqual(cpu.decode_instruction(pc).mnemonic, 'nop')
+        self.assertEqual(loaded.decode_instruction(pc).mnemonic, insn.mnemonic)
+
+    def test_decode_cache_lru(self):
+        disasm = CapstoneDisasm(cs.CS_ARCH_X86, cs.CS_MODE_64)
+        size = CapstoneDisasm.cache_size
+        CapstoneDisasm.cache_size = 2
+        try:
+            CapstoneDisasm._decoded.clear()
+            disasm.disassemble_instruction(b'\x90', 0x1000)
+            disasm.disassemble_instruction(b'\x90', 0x2000)
+            disasm.disassemble_instruction(b'\x90', 0x1000)
+            # The least recently used instruction is dropped first
+            disasm.disassemble_instruction(b'\x90', 0x3000)
+            self.assertEqual([key[2] for key in CapstoneDisasm._decoded], [0x1000, 0x3000])
+        finally:
+            CapstoneDisasm.cache_size = size
+            CapstoneDisasm._decoded.clear()
+
+    def test_decode_cache_memory_changes(self):
+        cpu = self.linux.current
+        mem = cpu.memory
+        addr = mem.mmap(None, 0x1000, 'rwx')
+        mem.write(addr, b'\x90\x90')
+        self.assertEqual(cpu.decode_instruction(addr).mnemonic, 'nop')
+
+        # Writes straight to memory drop the instructions they overlap
+        mem[addr] = b'\xc3'
+        self.assertEqual(cpu.decode_instruction(addr).mnemonic, 'ret')
+        mem.write(addr, b'\x90')
+        self.assertEqual(cpu.decode_instruction(addr).mnemonic, 'nop')
+
+        # So do protection changes
+        mem.mprotect(addr, 0x1000, 'r')
+        self.assertNotIn(addr, cpu._instruction_cache)
+        mem.mprotect(addr, 0x1000, 'rwx')
+
+        # And a map unmapped and mapped again at the same address
+        self.assertEqual(cpu.decode_instruction(addr).mnemonic, 'nop')
+        mem.munmap(addr, 0x1000)
+        self.assertEqual(mem.mmap(addr, 0x1000, 'rwx'), addr)
+        mem.write(addr, b'\xc3', force=True)
+        self.assertEqual(cpu.decode_instruction(addr).mnemonic, 'ret')
+        mem.munmap(addr, 0x1000)
+        self.assertEqual(mem.mmap(addr, 0x1000, 'rwx'), addr)
+        self.assertNotIn(addr, cpu._instruction_cache)
+
     def test_aarch64_syscall_write(self):
         nr_write = 64
 
@@ -174,6 +242,19 @@ hexlify(b''.join(platform.current.read_bytes(stat, 100))))
         self.assertIn('stderr', files)
         self.assertIn('net', files)
 
+    def test_workspace_files_single_model(self):
+        platform = self.symbolic_linux_armv7
+        data = platform.constraints.new_array(index_max=4, name='STDIN')
+        value = Operators.CONCAT(32, *reversed([data[i] for i in range(4)]))
+        # Any byte can be 0 on its own, but not all of them at once
+        platform.constraints.add(Operators.UGT(value, 0x41))
+        platform.syscall_trace.append(('_read', 0, [data[i] for i in range(4)]))
+
+        files = platform.generate_workspace_files()
+        self.assertGreater(int.from_bytes(files['stdin'], 'little'), 0x41)
+        # The state itself is not constrained
+        self.assertEqual(len(platform.constraints), 1)
+
     def test_armv7_syscall_events(self):
         nr_fstat64 = 197
 
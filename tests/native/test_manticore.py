@@ -81,6 +81,31 @@ class ManticoreTest(unittest.TestCase):
         with self.assertRaises(ValueError):
             self.m.resolve("does_not_exist")
 
+    def test_fork_newest_keeps_last_child(self):
+        dirname = os.path.dirname(__file__)
+        self.m = Manticore(os.path.join(dirname, 'binaries', 'arguments_linux_amd64'), policy='newest')
+        state = self.m._get_state()
+        value = state.new_symbolic_value(8)
+        state.constrain(value.ult(3))
+        parent_id = state.id
+        self.m._save(state, state_id=parent_id)
+        # The last child gets the newest id but it is not saved
+        self.assertIs(self.m._fork(state, value), state)
+        self.assertEqual(self.m.count_ready_states(), 2)
+        self.assertEqual(list(self.m._busy_states), [state.id])
+        self.assertGreater(state.id, max(self.m._ready_states))
+        # The parent is gone from the workspace as in any fork
+        self.assertNotIn(parent_id, self.m._workspace.try_loading_workspace())
+        self.assertNotIn(state.id, self.m._workspace.try_loading_workspace())
+
+        # The kept state, which was never saved, can fork again
+        other = state.new_symbolic_value(8)
+        state.constrain(other.ult(3))
+        self.assertIs(self.m._fork(state, other), state)
+        self.assertEqual(self.m.count_ready_states(), 4)
+        self.m._save(state, state_id=state.id)
+        self.assertIn(state.id, self.m._workspace.try_loading_workspace())
+
     def test_integration_basic_stdin(self):
         import struct
         dirname = os.path.dirname(__file__)
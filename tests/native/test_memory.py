@@ -352,6 +352,42 @@ class MemoryTest(unittest.TestCase):
 
         self.assertRaises(MemoryException, mem.mmap, 0, (0x100000000 // 2)+1, 'r')
 
+    def test_search_large_address_space(self):
+        mem = SMemory64(ConstraintSet())
+        top = mem.mmap(None, 0x100000, 'rw')
+        self.assertEqual(top, 0x0000800000000000 - 0x100000)
+        # The search jumps over the maps instead of walking their pages
+        self.assertEqual(mem._search(0x1000, top + 0x1000), top - 0x1000)
+        low = mem.mmap(0x1000, 0x1000, 'r')
+        self.assertEqual(mem.mappings(), [(low, low + 0x1000, 'r', 0, ''), (top, top + 0x100000, 'rw', 0, '')])
+
+        mem.munmap(top + 0x1000, 0x1000)
+        self.assertNotIn(top + 0x1000, mem)
+        self.assertIn(top + 0x2000, mem)
+        self.assertEqual(mem.map_containing(top).end, top + 0x1000)
+        self.assertEqual(mem._search(0x1000, top + 0x1000), top + 0x1000)
+        self.assertEqual(len(mem.mappings()), 3)
+
+    def test_read_raw(self):
+        cs = ConstraintSet()
+        mem = SMemory32(cs)
+        first = mem.mmap(0x1000, 0x1000, 'rw')
+        second = mem.mmap(0x2000, 0x1000, 'r')
+        mem.write(second - 2, b'ab')
+        mem.write(second, [b'c'], force=True)
+        # Across maps, as bytes
+        self.assertEqual(mem.read_raw(second - 2, 3), b'abc')
+        self.assertEqual(mem.read(second - 2, 3), [b'a', b'b', b'c'])
+
+        mem.write(first, [cs.new_bitvec(8)])
+        self.assertIsNone(mem.read_raw(first, 2))
+        self.assertEqual(mem.read_raw(first + 1, 1), b'\x00')
+        # Overwriting the symbolic byte makes the range concrete again
+        mem.write(first, b'z')
+        self.assertEqual(mem.read_raw(first, 2), b'z\x00')
+
+        self.assertRaises(InvalidMemoryAccess, mem.read_raw, second + 0x1000 - 1, 2)
+
     def testBasicAnonMap(self):
         m = AnonMap(0x10000000, 0x2000, 'rwx')
 
@@ -1451,6 +1487,46 @@ class MemoryTest(unittest.TestCase):
         m = pickle.load(s)
         self.assertEqual(m[0x10001000], b'A')
 
+    def test_pickle_mmap_anon_pages(self):
+        m = AnonMap(0x10000000, 0x3000, 'rwx')
+        digests = [page.digest for page in m._pages()]
+        # Identical pages have the same digest
+        self.assertEqual(len(set(digests)), 1)
+
+        m[0x10001ffe:0x10002002] = b'ABCD'
+        m = pickle.loads(pickle.dumps(m))
+        pages = m._pages()
+        self.assertEqual(pages[0].digest, digests[0])
+        self.assertNotEqual(pages[1].digest, digests[1])
+        self.assertNotEqual(pages[2].digest, digests[2])
+        self.assertEqual(m[0x10001ffe:0x10002002], [b'A', b'B', b'C', b'D'])
+
+    def test_mmap_anon_symbolic(self):
+        cs = ConstraintSet()
+        a, b = cs.new_bitvec(8, name='a'), cs.new_bitvec(8, name='b')
+        m = AnonMap(0x10000000, 0x3000, 'rwx', b'XYZ')
+        m[0x10000001] = a
+        m[0x10001fff:0x10002002] = [b'A', b, b'C']
+
+        # The concrete data is not converted, symbols live on the side
+        self.assertIsInstance(m._data, bytearray)
+        self.assertEqual(len(m._overlay), 2)
+        self.assertIs(m[0x10000001], a)
+        self.assertEqual(m[0x10000000:0x10000003][0::2], [b'X', b'Z'])
+        self.assertIs(m[0x10000000:0x10000003][1], a)
+        self.assertIsNone(m.read_raw(0x10002000, 0x10002001))
+        self.assertEqual(m.read_raw(0x10002001, 0x10002002), b'C')
+
+        head, tail = pickle.loads(pickle.dumps(m)).split(0x10001000)
+        self.assertEqual(head[0x10000001].name, 'a')
+        self.assertEqual(tail[0x10002000].name, 'b')
+        self.assertEqual(tail[0x10001fff], b'A')
+
+        # Concrete writes drop the symbols they overwrite
+        m[0x10000000:0x10003000] = bytes(0x3000)
+        m[0x10000001] = 'Q'
+        self.assertFalse(m._overlay)
+        self.assertEqual(m.read_raw(0x10000000, 0x10000002), b'\x00Q')
 
     def test_pickle_mmap_file(self):
         #file mapping
@@ -1749,6 +1825,32 @@ class MemoryTest(unittest.TestCase):
         mem.read(nul, 4, force=True)
         mem.write(nul, 'hello', force=True)
 
+    def test_overlapping_maps(self):
+        mem = Memory32()
+        mem.mmap(0x1000, 0x1000, 'rw')
+        mem.mmap(0x3000, 0x1000, 'rw')
+        self.assertFalse(mem._overlaps)
+
+        # A map stacked over other maps, as LazySMemory.mmapFile does
+        big = AnonMap(0x1000, 0x3000, 'r')
+        mem._add(big)
+        self.assertTrue(mem._overlaps)
+        self.assertIs(mem.map_containing(0x2000), big)
+
+        # Unmapping it makes lookups fast again
+        mem._del(big)
+        self.assertFalse(mem._overlaps)
+        self.assertIsNone(mem._lookup(0x2000))
+        mem.write(0x1000, b'a')
+        self.assertIs(mem._last_map, mem.map_containing(0x1000))
+
+        # A map overlapping only a map that is unmapped later
+        low = AnonMap(0x3000, 0x2000, 'r')
+        mem._add(low)
+        self.assertTrue(mem._overlaps)
+        mem.munmap(0x3000, 0x1000)
+        self.assertFalse(mem._overlaps)
+
     def test_symbolic_force_access(self):
         cs = ConstraintSet()
         mem = SMemory32(cs)
@@ -1,5 +1,6 @@
 import unittest
 import os
+from unittest import mock
 
 from manticore.utils.event import Eventful
 from manticore.platforms import linux
@@ -76,6 +77,17 @@ class StateTest(unittest.TestCase):
         solved = self.state.solve_one(expr)
         self.assertEqual(solved, val)
 
+    def test_solve_one_n(self):
+        expr1 = BitVecVariable(32, 'tmp1')
+        expr2 = BitVecVariable(32, 'tmp2')
+        self.state.constrain(expr1 != expr2)
+        self.state.constrain(expr1 < 2)
+        self.state.constrain(expr2 < 2)
+        solved1, solved2 = self.state.solve_one_n(expr1, expr2)
+        self.assertNotEqual(solved1, solved2)
+        self.assertEqual(self.state.solve_one_n(expr1, 3, constrain=True), [solved1, 3])
+        self.assertEqual(self.state.solve_one(expr2), solved2)
+
     def test_solve_n(self):
         expr = BitVecVariable(32, 'tmp')
         self.state.constrain(expr > 4)
@@ -106,6 +118,16 @@ class StateTest(unittest.TestCase):
         self.assertEqual(len(solved), 1)
         self.assertIn(solved[0], range(100))
 
+    def test_policy_sampled(self):
+        expr = BitVecVariable(32, 'tmp')
+        self.state.constrain(expr.ult(200))
+        solver = self.state._solver
+        with mock.patch.object(solver, 'can_be_true_all', wraps=solver.can_be_true_all) as checks:
+            solved = self.state.concretize(expr, 'SAMPLED', maxcount=5)
+        self.assertEqual(set(solved), {0, 1, 99, 199})
+        # Only the two missing values were sampled
+        self.assertEqual([len(args[1]) for args, _ in checks.call_args_list], [2])
+
     def test_state(self):
         constraints = ConstraintSet()
         initial_state = State(constraints, FakePlatform())
@@ -1,6 +1,7 @@
 import unittest
 
 from manticore.core.smtlib import ConstraintSet
+from manticore.core.smtlib.visitors import get_variables
 from manticore.core.workspace import *
 from manticore.native.state import State
 from manticore.platforms import linux
@@ -78,6 +79,105 @@ class StateTest(unittest.TestCase):
         self.assertEqual(str(state.constraints),
                          str(self.state.constraints))
 
+    def test_workspace_shared_constraints(self):
+        workspace = Workspace('mem:')
+        a = self.state.constraints.new_bitvec(32, name='a')
+        self.state.constrain(a > 10)
+        states = []
+        for value in (11, 12):
+            with self.state as new_state:
+                new_state.constrain(a == value)
+                states.append(workspace.save_state(new_state))
+
+        # The parent constraints are saved once for both children
+        segments = [key for key in workspace._store._data if key.startswith('.constraints_')]
+        self.assertEqual(len(segments), 1)
+
+        left, right = [workspace.load_state(state_id) for state_id in states]
+        self.assertIs(left.constraints._parent, right.constraints._parent)
+        self.assertEqual(len(left.constraints), 2)
+        self.assertIn('(= a #x0000000c)', str(right.constraints))
+        # Declared variables keep their identity
+        self.assertIs(left.constraints.get_variable('a'), right.constraints.get_variable('a'))
+        self.assertTrue(left.constraints.is_declared(left.constraints._parent.get_variable('a')))
+
+    def test_workspace_shared_variables(self):
+        workspace = Workspace('mem:')
+        a = self.state.constraints.new_bitvec(32, name='a')
+        self.state.constrain(a > 10)
+        with self.state as new_state:
+            new_state.constrain(a < 20)
+            new_state.constrain(a != 15)
+            # Pickled before the constraints
+            new_state.platform.input.buffer.extend([a, a + 1])
+            state_id = workspace.save_state(new_state)
+
+        # Every reference to a parent variable loads the same object
+        state = workspace.load_state(state_id)
+        declared = state.constraints._parent.get_variable('a')
+        for data in state.platform.input.buffer:
+            self.assertIn(declared, get_variables(data))
+        for constraint in state.constraints._constraints:
+            self.assertIn(declared, get_variables(constraint))
+        self.assertEqual(len(state.constraints.related_to(declared)), 3)
+
+    def test_workspace_shared_pages(self):
+        workspace = Workspace('mem:')
+        first = workspace.save_state(self.state)
+        pages = {key for key in workspace._store._data if key.startswith('.page_')}
+        self.assertTrue(pages)
+
+        stack = self.state.cpu.STACK
+        self.state.cpu.write_bytes(stack, b'sibling')
+        second = workspace.save_state(self.state)
+        # Only the written page is new
+        new_pages = {key for key in workspace._store._data if key.startswith('.page_')} - pages
+        self.assertEqual(len(new_pages), 1)
+
+        self.assertNotEqual(workspace.load_state(first).cpu.read_bytes(stack, 7), list(b'sibling'))
+        self.assertEqual(workspace.load_state(second).cpu.read_bytes(stack, 7), [bytes([c]) for c in b'sibling'])
+
+    def test_workspace_remove_unreferenced(self):
+        workspace = Workspace('mem:')
+        store = workspace._store
+        a = self.state.constraints.new_bitvec(32, name='a')
+        self.state.constrain(a > 10)
+        states = []
+        for value in (11, 12):
+            with self.state as new_state:
+                new_state.constrain(a == value)
+                states.append(workspace.save_state(new_state))
+
+        def shared():
+            return {key for key in store._data if key.startswith(('.constraints_', '.page_'))}
+        saved = shared()
+        self.assertTrue(saved)
+
+        # Still used by the other state
+        workspace.rm_state(states[0])
+        workspace.remove_unreferenced()
+        self.assertEqual(shared(), saved)
+        self.assertEqual(workspace.load_state(states[1]).constraints.get_variable('a').name, 'a')
+
+        # Loading the last state removed it
+        workspace.remove_unreferenced()
+        self.assertEqual(shared(), set())
+        self.assertFalse([key for key in store._data if key.startswith('.refs_')])
+
+        # Saving again writes what was removed
+        with self.state as new_state:
+            workspace.load_state(workspace.save_state(new_state))
+
+    def test_filesystem_save_value(self):
+        store = FilesystemStore()
+        store.save_value('.smt_key', '1234')
+        store.save_value('.smt_key', '12')
+        store.save_value('.page_key', b'\x00\x01')
+        self.assertEqual(store.load_value('.smt_key'), '12')
+        self.assertEqual(store.load_value('.page_key', binary=True), b'\x00\x01')
+        # The temporary files were moved into place
+        self.assertEqual(sorted(store.ls('.*')), ['.page_key', '.smt_key'])
+
     def test_workspace_id_start_with_zero(self):
         workspace = Workspace('mem:')
         id_ = workspace.save_state(self.state)
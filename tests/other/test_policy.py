@@ -0,0 +1,142 @@
+import unittest
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from manticore.core.policy import Policy, ReadyQueue, Random, DepthFirst, BreadthFirst, Newest, FewestConstraints, Uncovered
+from manticore.platforms.evm import EVMWorld
+
+
+class FakeState:
+    def __init__(self, depth=0, constraints=(), platform=None):
+        self.context = {'fork_depth': depth}
+        self.constraints = constraints
+        self.platform = platform
+
+
+class FakeManticore:
+    def __init__(self):
+        self.context = {}
+
+    @contextmanager
+    def locked_context(self, key=None, value_type=None):
+        if key is None:
+            yield self.context
+        else:
+            yield self.context.setdefault(key, value_type())
+
+
+class FakeWorld(EVMWorld):
+    current_vm = None
+    current_transaction = None
+
+    def __init__(self, address, pc):
+        self.current_vm = SimpleNamespace(address=address, pc=pc)
+
+
+class ReadyQueueTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_order(self):
+        q = ReadyQueue()
+        q.push(1, 3)
+        q.push(2, 1)
+        q.push(3, 2)
+        self.assertEqual(q.size(), 3)
+        self.assertEqual([q.pop(), q.pop(), q.pop(), q.pop()], [2, 3, 1, None])
+
+    def test_ties_are_fifo(self):
+        q = ReadyQueue()
+        for state_id in (5, 4, 6):
+            q.push(state_id, 0)
+        self.assertEqual([q.pop(), q.pop(), q.pop()], [5, 4, 6])
+
+    def test_discard_and_update(self):
+        q = ReadyQueue()
+        q.push(1, 1)
+        q.push(2, 2)
+        q.push(3, 3)
+        q.discard(1)
+        q.push(3, 0)
+        self.assertEqual(q.size(), 2)
+        self.assertEqual([q.pop(), q.pop(), q.pop()], [3, 2, None])
+
+    def test_peek(self):
+        q = ReadyQueue()
+        self.assertIsNone(q.peek())
+        q.push(1, 3)
+        q.push(2, 1)
+        q.discard(2)
+        self.assertEqual(q.peek(), 3)
+        self.assertEqual(q.size(), 1)
+
+    def test_clear(self):
+        q = ReadyQueue()
+        q.push(1, 1)
+        q.clear()
+        self.assertEqual(q.size(), 0)
+        self.assertIsNone(q.pop())
+
+
+class PolicyTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_from_string(self):
+        self.assertIsInstance(Policy.from_string('random', None), Random)
+        self.assertIsInstance(Policy.from_string('-depth', None), DepthFirst)
+        self.assertIsInstance(Policy.from_string('+breadth', None), BreadthFirst)
+        with self.assertRaises(ValueError):
+            Policy.from_string('nope', None)
+
+    def test_depth_breadth(self):
+        shallow, deep = FakeState(depth=1), FakeState(depth=5)
+        depth = Policy.from_string('depth', None)
+        breadth = Policy.from_string('breadth', None)
+        self.assertLess(depth.priority(1, deep), depth.priority(2, shallow))
+        self.assertLess(breadth.priority(1, shallow), breadth.priority(2, deep))
+        # reversing breadth is exploring deeper states first
+        self.assertLess(Policy.from_string('+breadth', None).priority(1, deep),
+                        Policy.from_string('+breadth', None).priority(2, shallow))
+
+    def test_newest_and_constraints(self):
+        newest = Newest(None)
+        self.assertLess(newest.priority(10), newest.priority(2))
+        fewest = FewestConstraints(None)
+        self.assertLess(fewest.priority(1, FakeState(constraints=(1,))),
+                        fewest.priority(2, FakeState(constraints=(1, 2, 3))))
+        # States that were not loaded get a neutral priority
+        self.assertEqual(fewest.priority(3), 0)
+
+    def test_runs_before(self):
+        newest = Newest(None)
+        self.assertTrue(newest.runs_before(10, FakeState(), None))
+        self.assertTrue(newest.runs_before(10, FakeState(), newest.priority(10)))
+        self.assertFalse(newest.runs_before(2, FakeState(), newest.priority(10)))
+        depth = DepthFirst(None)
+        self.assertTrue(depth.runs_before(1, FakeState(depth=5), depth.priority(2, FakeState(depth=4))))
+
+    def test_uncovered(self):
+        m = FakeManticore()
+        uncovered = Uncovered(m)
+        world = FakeWorld(0x1000, 2)
+        self.assertEqual(uncovered.priority(1, FakeState(platform=world)), 0)
+        m.context.setdefault('evm.coverage', []).append((0x1000, 2, False))
+        self.assertEqual(uncovered.priority(1, FakeState(platform=world)), 1)
+        self.assertEqual(uncovered.priority(2, FakeState(platform=FakeWorld(0x1000, 3))), 0)
+        # A new coverage list is read again, even if it is not shorter
+        m.context = {'evm.coverage': [(0x1000, 3, False), (0x1000, 4, False)]}
+        self.assertEqual(uncovered.priority(1, FakeState(platform=world)), 0)
+        self.assertEqual(uncovered.priority(2, FakeState(platform=FakeWorld(0x1000, 3))), 1)
+        m.context = {'evm.coverage': []}
+        self.assertEqual(uncovered.priority(2, FakeState(platform=FakeWorld(0x1000, 3))), 0)
+
+        # Native states are looked up in the visited set
+        cpu = SimpleNamespace(PC=0x400000)
+        platform = SimpleNamespace(current=cpu)
+        self.assertEqual(uncovered.priority(3, FakeState(platform=platform)), 0)
+        m.context['visited'] = {0x400000}
+        self.assertEqual(uncovered.priority(3, FakeState(platform=platform)), 1)
+        self.assertEqual(uncovered.priority(4), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -76,6 +76,51 @@ class ExpressionTest(unittest.TestCase):
         b = cs.new_bitvec(32)
         cs.add(a + b > 100)
 
+    def testRelatedConstraints(self):
+        cs = ConstraintSet()
+        a, b, c, d = (cs.new_bitvec(32, name=name) for name in 'ABCD')
+        cs.add(a > b)
+        cs.add(c > 2)
+        with cs as child:
+            child.add(b > c)
+            child.add(d == 5)
+
+            related = child.to_string(related_to=a == 1)
+            self.assertIn('(bvsgt A B)', related)
+            self.assertIn('(bvsgt B C)', related)
+            self.assertIn('(bvsgt C #x00000002)', related)
+            self.assertNotIn('(declare-fun D', related)
+            self.assertEqual(child.to_string(related_to=d == 1).count('assert'), 1)
+            # Unrelated to the parent until the child is used
+            self.assertNotIn('(declare-fun B', cs.to_string(related_to=c == 1))
+
+            # The index is updated as constraints are added
+            child.add(d == a)
+            self.assertIn('(declare-fun D', child.to_string(related_to=a == 1))
+
+        cs.add(BoolConstant(False))
+        self.assertIn('(assert false)', cs.to_string(related_to=c == 1))
+
+    def testRelatedToArrayProxy(self):
+        cs = ConstraintSet()
+        array = cs.new_array(index_max=4, name='ARRAY')
+        cs.add(array == b'abcd')
+        self.assertIn('(assert', cs.to_string(related_to=array[1:3]))
+        self.assertEqual(Z3Solver.instance().get_all_values(cs, array[1:3]), [b"bc"])
+
+    def testRelatedToMany(self):
+        cs = ConstraintSet()
+        a, b, c, d = [cs.new_bitvec(32, name=name) for name in 'abcd']
+        cs.add(a > b)
+        cs.add(c == 1)
+        cs.add(b > 10)
+        cs.add(d < 5)
+        related = cs.related_to(a, c)
+        self.assertEqual(len(related), 3)
+        # Expressions are hash-consed
+        self.assertFalse(any(constraint is (d < 5) for constraint in related))
+        self.assertEqual(cs.related_to(), [])
+
     def testSolver(self):
         cs =  ConstraintSet()
         a = cs.new_bitvec(32)
@@ -339,6 +384,30 @@ class ExpressionTest(unittest.TestCase):
         cs = pickle.loads(pickle.dumps(cs))
         self.assertTrue(self.solver.check(cs))
 
+    def testHashConsing(self):
+        import pickle
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32)
+        b = cs.new_bitvec(32)
+
+        # Structurally equal operations and constants are the same object
+        self.assertIs(BitVecConstant(32, 7), BitVecConstant(32, 7))
+        self.assertIs((a + 1) * b, (a + 1) * b)
+        self.assertIsNot(a + 1, b + 1)
+        self.assertIsNot(BitVecConstant(32, 7), BitVecConstant(32, 7, taint=('T',)))
+        self.assertFalse(hasattr(a + 1, '__dict__'))
+
+        # Shared subterms are pickled once and interned again when loaded
+        x = BitVecExtract(a * b, 0, 8)
+        y = BitVecExtract(a * b, 8, 8)
+        loaded_x, loaded_y = pickle.loads(pickle.dumps((x, y)))
+        self.assertIs(loaded_x.value, loaded_y.value)
+
+        # Rewriting an expression never modifies the shared original
+        expression = (a | 0) & 1
+        self.assertEqual(translate_to_smtlib(arithmetic_simplify(expression)), translate_to_smtlib(a & 1))
+        self.assertIsInstance(expression.operands[0], BitVecOr)
+
     def testBitvector_add(self):
         cs =  ConstraintSet()
         a = cs.new_bitvec(32)
@@ -389,6 +458,32 @@ class ExpressionTest(unittest.TestCase):
         self.assertTrue(BoolConstant(True).__bool__())
         self.assertFalse(BoolConstant(False).__bool__())
 
+    def test_visit_all(self):
+        from manticore.core.smtlib.visitors import GetDepth, TranslatorSmtlib, Visitor, get_variables
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32, name='VARA')
+        b = cs.new_bitvec(32, name='VARB')
+        expressions = [a + 1, (a + 1) * b, a]
+
+        visitor = GetDepth()
+        self.assertEqual(visitor.visit_all(expressions), [2, 3, 1])
+        self.assertEqual(visitor.visit_all([]), [])
+        # The subterm a + 1 was only explored once
+        self.assertIn(a + 1, visitor._cache)
+
+        # get_variables() explores several expressions with one visitor
+        self.assertEqual(get_variables(*expressions), {a, b})
+        self.assertEqual(get_variables(), set())
+
+        translator = TranslatorSmtlib()
+        self.assertEqual(translator.visit_all(expressions[:2]),
+                         ['(bvadd VARA #x00000001)', '(bvmul (bvadd VARA #x00000001) VARB)'])
+
+        # Dispatch tables follow the expression __mro__
+        methods = GetDepth()._visit_methods(BitVecAdd)
+        self.assertEqual(methods, (GetDepth.visit_Operation, GetDepth.visit_Expression))
+        self.assertIn((GetDepth, BitVecAdd), Visitor._dispatch_tables)
+
     def test_visitors(self):
         solver = Z3Solver.instance()
         cs = ConstraintSet()
@@ -910,6 +1005,105 @@ class ExpressionTest(unittest.TestCase):
         self.assertTrue(solver.check(cs))
         self.assertEqual(solver.get_value(cs, a), -7&0xFF)
 
+    def test_incremental_session(self):
+        solver = self.solver
+        cs = ConstraintSet()
+        x = cs.new_bitvec(8)
+        y = cs.new_bitvec(8)
+        cs.add(x.ult(0x80))
+        cs.add(y == x + 1)
+
+        self.assertTrue(solver.can_be_true(cs, x == 0x10))
+        base = list(solver._frames)
+        with cs as child:
+            child.add(x.uge(0x7e))
+            self.assertItemsEqual(solver.get_all_values(child, y), [0x7f, 0x80])
+            # The parent constraints were kept in the solver
+            self.assertEqual(solver._frames[:len(base)], base)
+            self.assertFalse(solver.can_be_true(child, y == 0x10))
+        self.assertTrue(solver.can_be_true(cs, y == 0x10))
+        self.assertEqual(solver.max(cs, y), 0x80)
+        self.assertEqual(solver.min(cs, y), 1)
+
+    def test_solver_cache(self):
+        from manticore.core.smtlib.solver import SolverCache
+        from manticore.core.workspace import MemoryStore
+        solver = self.solver
+        cs = ConstraintSet()
+        x = cs.new_bitvec(32)
+        cs.add(x.ult(10))
+
+        store = MemoryStore()
+        solver._cache.clear()
+        solver.attach_cache_store(store)
+        try:
+            hits = solver._cache.hits
+            self.assertTrue(solver.can_be_true(cs, x == 9))
+            self.assertFalse(solver.can_be_true(cs, x == 10))
+            self.assertEqual(solver.max(cs, x), 9)
+            self.assertEqual(solver._cache.hits, hits)
+
+            self.assertTrue(solver.can_be_true(cs, x == 9))
+            self.assertEqual(solver.max(cs, x), 9)
+            self.assertEqual(solver._cache.hits, hits + 2)
+
+            # Other caches are not affected
+            other = SolverCache(10)
+            key = SolverCache.key('optimize', cs.to_string(related_to=x), x, 'maximize')
+            self.assertIsNone(other.get(key))
+            self.assertFalse(store._data)
+        finally:
+            solver.attach_cache_store(None)
+
+        # The results are written at once when the store is detached, and
+        # read by the caches attached to it later
+        self.assertEqual(len(store._data), 1)
+        other.attach(store)
+        self.assertEqual(other.get(key), 9)
+
+    def test_solver_cache_unknown(self):
+        solver = self.solver
+        cs = ConstraintSet()
+        x = cs.new_bitvec(32)
+        cs.add(x.ult(10))
+        solver._cache.clear()
+
+        # A timeout is reported as unsat but not remembered
+        solver._is_sat = lambda: solver._sat_status('unknown')
+        try:
+            self.assertFalse(solver.can_be_true(cs, x == 9))
+        finally:
+            del solver._is_sat
+        self.assertTrue(solver.can_be_true(cs, x == 9))
+
+    def test_solver_pool(self):
+        from manticore.core.smtlib.solver import SolverPool
+        cs = ConstraintSet()
+        x = cs.new_bitvec(32)
+        cs.add(x.ult(10))
+        pool = SolverPool(size=2)
+        pool._cache.clear()
+
+        expressions = [x == i for i in range(8, 13)] + [True, False]
+        expected = [self.solver.can_be_true(cs, e) for e in expressions]
+        self.assertEqual(expected, [True, True, False, False, False, True, False])
+        self.assertEqual(pool.can_be_true_all(cs, expressions), expected)
+
+        # A dead z3 is replaced transparently
+        pool._cache.clear()
+        pool._solvers[0]._proc.kill()
+        pool._solvers[0]._proc.wait()
+        self.assertEqual(pool.can_be_true_all(cs, expressions), expected)
+
+        # A timeout is reported as unsat but not remembered
+        pool._cache.clear()
+        pool._answer = lambda solver: solver._recv() and None
+        try:
+            self.assertEqual(pool.can_be_true_all(cs, expressions[:2]), [False, False])
+        finally:
+            del pool._answer
+        self.assertEqual(pool.can_be_true_all(cs, expressions[:2]), expected[:2])
+
     def test_check_solver_min(self):
         self.solver._received_version = '(:version "4.4.1")'
         self.assertTrue(self.solver._solver_version() == Version(major=4, minor=4, patch=1))
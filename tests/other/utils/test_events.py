@@ -70,3 +70,44 @@ class ManticoreDriver(unittest.TestCase):
 
         b.do_stuff()
         self.assertSequenceEqual(c.received, [(1, 'a'), (2, 'b')])
+
+    def test_subscription_counts(self):
+        a = A()
+        b = B(a)
+        c = C()
+        self.assertFalse(a._has_subscribers('eventA'))
+
+        b.subscribe('eventA', c.callback)
+        b.subscribe('eventA', c.callback)
+        self.assertTrue(a._has_subscribers('eventA'))
+
+        b.unsubscribe('eventA', c.callback)
+        self.assertFalse(a._has_subscribers('eventA'))
+        a.do_stuff()
+        self.assertSequenceEqual(c.received, [])
+
+        # Collected subscribers do not keep the event published
+        b.subscribe('eventA', c.callback)
+        del c
+        self.assertFalse(a._has_subscribers('eventA'))
+
+    def test_subscriptions_are_scoped(self):
+        a, other = A(), A()
+        b, other_b = B(a), B(other)
+        c = C()
+
+        # Subscribing to one tree does not publish the events of another
+        b.subscribe('eventA', c.callback)
+        self.assertTrue(a._has_subscribers('eventA'))
+        self.assertFalse(other._has_subscribers('eventA'))
+        self.assertFalse(other_b._has_subscribers('eventA'))
+
+        # A copy counts the subscriptions it got on its own
+        copied = B(A())
+        b.copy_eventful_state(copied)
+        self.assertTrue(copied._has_subscribers('eventA'))
+        copied.unsubscribe('eventA', c.callback)
+        self.assertFalse(copied._has_subscribers('eventA'))
+        self.assertTrue(b._has_subscribers('eventA'))
+        b.unsubscribe('eventA', c.callback)
+        self.assertFalse(a._has_subscribers('eventA'))